@@ -5,232 +5,4318 @@ import sys
 import datetime
 import time
 import os
+import threading
+import queue
+import concurrent.futures
+import asyncio
+import re
+import random
+import collections
+import uuid
+import itertools
+import socket
+import bisect
+import http.server
 
 import stomp.utils
+import zlib
+import struct
+import mmap
+import math
+import hashlib
+import multiprocessing
+import signal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 logger = logging.getLogger(__name__)
 amqclientversion = "2.0.3"
 
+ACK_MODES = ("auto", "client", "client-individual")
+
+
+def parse_subscription(sub, default_prefetch=1):
+    """
+    Normalizes a subscription entry into a subscription spec dictionary.
+
+    A subscription can be given either as a destination string (legacy form, client ack
+    with a prefetch size of default_prefetch) or as a dictionary with the following keys:
+        destination (str): Queue or topic name. Mandatory.
+        prefetch (int, optional): activemq.prefetchSize of the subscription.
+        ack (str, optional): One of auto, client or client-individual. Default is client.
+        selector (str, optional): JMS selector applied by the broker.
+        headers (dict, optional): Extra headers sent with the SUBSCRIBE frame.
+
+    Returns:
+        dict: The normalized spec, or None if the destination is empty.
+    """
+    if isinstance(sub, str):
+        sub = {"destination": sub}
+    if not isinstance(sub, dict):
+        raise ValueError("Invalid subscription %r" % (sub,))
+
+    destination = sub.get("destination", "")
+    if destination is None or len(destination) == 0:
+        return None
+
+    ack = sub.get("ack", "client")
+    if ack not in ACK_MODES:
+        raise ValueError("Invalid ack mode %r for %s" % (ack, destination))
+
+    spec = dict(sub)
+    spec["destination"] = destination
+    spec["ack"] = ack
+    spec["prefetch"] = int(sub.get("prefetch", default_prefetch))
+    spec["selector"] = sub.get("selector")
+    spec["headers"] = dict(sub.get("headers") or {})
+    return spec
+
+
+def is_topic(destination):
+    """
+    Returns True for the topic destinations, whose messages are not redelivered once dispatched.
+    """
+    return destination.startswith(("/topic/", "/temp-topic/"))
+
+
+##################################################################################
+# Codecs
+##################################################################################
+
+def json_encode(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj)
+
+
+def json_decode(body):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def text_decode(body):
+    if isinstance(body, str):
+        return body
+    return bytes(body).decode("utf-8")
+
+
+def raw_decode(body):
+    if isinstance(body, str):
+        return memoryview(body.encode("utf-8"))
+    return memoryview(body)
+
+
+# name: (encoder, decoder, content-type)
+CODECS = {
+    "text": (None, text_decode, None),
+    "raw": (None, raw_decode, None),
+    "json": (json_encode, json_decode, "application/json"),
+}
+if msgpack is not None:
+    CODECS["msgpack"] = (msgpack.packb, lambda body: msgpack.unpackb(body, raw=False), "application/x-msgpack")
+
+# content-encoding: (compressor, decompressor)
+COMPRESSIONS = {"zlib": (zlib.compress, zlib.decompress)}
+if lz4 is not None:
+    COMPRESSIONS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+
+
+def parse_codec(codec):
+    """
+    Validates a codec name and returns it as a (codec, compression) tuple.
+
+    A codec is one of text (default, bodies decoded as strings), raw (bodies passed as
+    memoryviews without decoding), json (orjson when installed) or msgpack (when installed),
+    optionally followed by a compression: json+zlib, raw+lz4...
+    """
+    name, _, compression = (codec or "text").partition("+")
+    if name not in CODECS:
+        raise ValueError("Unknown or unavailable codec %r" % (name,))
+    if compression and compression not in COMPRESSIONS:
+        raise ValueError("Unknown or unavailable compression %r" % (compression,))
+    return name, compression or None
+
+
+def encode_payload(message, codec, headers=None):
+    """
+    Encodes a message with a (codec, compression) tuple.
+
+    Returns:
+        tuple: (body, headers). content-type and content-encoding headers are added when needed.
+    """
+    encoder, decoder, content_type = CODECS[codec[0]]
+    body = message if encoder is None else encoder(message)
+    if content_type is None and codec[1] is None:
+        return body, headers
+    headers = dict(headers) if headers is not None else {}
+    if content_type is not None:
+        headers.setdefault("content-type", content_type)
+    if codec[1] is not None:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        body = COMPRESSIONS[codec[1]][0](body)
+        headers["content-encoding"] = codec[1]
+    return body, headers
+
+
+def decode_payload(body, headers, codec):
+    """
+    Decodes a message body with a (codec, compression) tuple. Compressed bodies are
+    recognized by their content-encoding header, whatever the compression of the codec.
+    """
+    encoding = headers.get("content-encoding")
+    if encoding in COMPRESSIONS and not isinstance(body, str):
+        body = COMPRESSIONS[encoding][1](body)
+    return CODECS[codec[0]][1](body)
+
+
+def parse_endpoints(server):
+    """
+    Returns the broker endpoints of a server dictionary as a list of (ip, port) tuples.
+
+    The optional "hosts" entry lists the brokers of a network of brokers, either as
+    (ip, port) tuples, {"ip": ..., "port": ...} dictionaries or "ip:port" strings.
+    Without it, the single ip and port entries are used.
+    """
+    endpoints = []
+    for host in server.get("hosts", [(server.get("ip"), server.get("port"))]):
+        if isinstance(host, dict):
+            host = (host["ip"], host["port"])
+        elif isinstance(host, str):
+            host = host.rsplit(":", 1)
+        endpoints.append((host[0], int(host[1])))
+    return endpoints
+
+
+def probe_endpoint(endpoint, timeout=1.0):
+    """
+    Returns the TCP connect time of an endpoint in seconds, or None if it is unreachable.
+    """
+    start = time.monotonic()
+    try:
+        sock = socket.create_connection(endpoint, timeout=timeout)
+    except OSError:
+        return None
+    sock.close()
+    return time.monotonic() - start
+
+
+class AMQSendError(Exception):
+    """
+    Raised by the future of a confirmed send when the broker rejects the message.
+    """
+
+
+# Errors that reconnecting does not fix: configuration, credentials or protocol bugs.
+FATAL_ERRORS = (r"authenticat", r"not authori[sz]ed", r"user ?name", r"password", r"security",
+                r"invalid selector", r"unknown stomp action", r"invalid (frame|header|command)",
+                r"unsupported protocol")
+
+
+def classify_error(frame, fatal_errors=FATAL_ERRORS):
+    """
+    Classifies an ERROR frame from its message header and body.
+
+    Args:
+        frame: The stomp.utils.Frame of the error, or a (command, headers, body) tuple.
+        fatal_errors (list): Regular expressions (case insensitive) of the fatal errors.
+
+    Returns:
+        str: fatal when the error matches one of fatal_errors, recoverable otherwise.
+    """
+    if isinstance(frame, tuple):
+        headers, body = frame[1], frame[2]
+    else:
+        headers, body = frame.headers, frame.body
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        body = bytes(body).decode("utf-8", "replace")
+    text = "%s %s" % (headers.get("message", ""), body or "")
+    for pattern in fatal_errors:
+        if re.search(pattern, text, re.IGNORECASE):
+            return "fatal"
+    return "recoverable"
+
+
+RECONNECT_DEFAULTS = {"initial": 0.5, "max": 30.0, "factor": 2.0, "jitter": 0.2, "attempts": 0}
+
+
+def reconnect_delay(reconnect, attempt):
+    """
+    Returns the delay in seconds before a reconnection attempt: exponential backoff capped
+    to reconnect["max"], randomized by +/- reconnect["jitter"] to avoid reconnection storms.
+    """
+    delay = min(reconnect["max"], reconnect["initial"] * reconnect["factor"] ** (attempt - 1))
+    return delay * (1 + random.uniform(-reconnect["jitter"], reconnect["jitter"]))
+
+
+##################################################################################
+# AMQ Message View
+##################################################################################
+
+MESSAGEVIEW_DEFAULTS = {"maxsize": 0, "oversize": "reject"}
+NOT_DECODED = object()
+
+
+class AMQMessageTooLarge(ValueError):
+    """
+    Raised when the body of a message view larger than its maxsize is accessed.
+    """
+
+
+class AMQMessage():
+    """
+    AMQMessage is the view of a received message passed to the callbacks instead of the decoded
+    body when the server dictionary contains a "messageview" entry. The body is only decoded
+    (decompressed, parsed with the codec of the subscription) when accessed, so that the messages
+    routed or dropped on their headers and size cost no decoding.
+
+    Bodies larger than maxsize bytes (0 for no limit) cannot be decoded: with the reject policy,
+    accessing them raises AMQMessageTooLarge, with the stream policy they can only be read in
+    chunks. Sending a view (send_message, dead letters) sends its raw body unchanged.
+
+    Attributes:
+        destination (str): Destination of the message.
+        headers (dict): Headers of the message.
+        raw (bytes): Body as received.
+        size (int): Size of the raw body in bytes.
+        body: Decoded body, decoded on first access.
+
+    Methods:
+        chunks(size=65536): Returns an iterator on the decompressed body, size bytes at a time,
+            without decoding it.
+    """
+
+    __slots__ = ("destination", "headers", "raw", "decoder", "maxsize", "oversize", "decoded")
+
+    def __init__(self, destination, headers, raw, decoder, maxsize=0, oversize="reject"):
+        self.destination = destination
+        self.headers = headers
+        self.raw = raw
+        self.decoder = decoder
+        self.maxsize = maxsize
+        self.oversize = oversize
+        self.decoded = NOT_DECODED
+
+    @property
+    def size(self):
+        return len(self.raw)
+
+    def oversized(self):
+        return self.maxsize > 0 and len(self.raw) > self.maxsize
+
+    @property
+    def body(self):
+        if self.decoded is NOT_DECODED:
+            if self.oversized():
+                raise AMQMessageTooLarge("Message of %d bytes larger than %d bytes%s." % (
+                    len(self.raw), self.maxsize, ", read it with chunks()" if self.oversize == "stream" else ""))
+            self.decoded = self.decoder(self.raw, self.headers)
+        return self.decoded
+
+    def chunks(self, size=65536):
+        if self.oversized() and self.oversize == "reject":
+            raise AMQMessageTooLarge("Message of %d bytes larger than %d bytes." % (len(self.raw), self.maxsize))
+        raw = self.raw.encode("utf-8") if isinstance(self.raw, str) else self.raw
+        encoding = self.headers.get("content-encoding")
+        if encoding == "zlib":
+            return self.decompressed_chunks(memoryview(raw), size)
+        if encoding in COMPRESSIONS:
+            raw = COMPRESSIONS[encoding][1](raw)
+        view = memoryview(raw)
+        return (view[start:start + size] for start in range(0, len(view), size))
+
+    def decompressed_chunks(self, view, size):
+        decompressor = zlib.decompressobj()
+        for start in range(0, len(view), size):
+            data = decompressor.decompress(view[start:start + size], size)
+            while data:
+                yield data
+                data = decompressor.decompress(decompressor.unconsumed_tail, size)
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def __repr__(self):
+        return "<AMQMessage %s %d bytes>" % (self.destination, len(self.raw))
+
+
+##################################################################################
+# AMQ Metrics
+##################################################################################
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class AMQHistogram():
+    """
+    Fixed bucket latency histogram, in seconds.
+
+    Updates are plain list and float operations without lock: under the GIL a concurrent
+    update can at worst be lost, which is acceptable for monitoring.
+    """
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else float("inf")
+        return float("inf")
+
+
+def escape_label(value):
+    """
+    Escapes an OpenMetrics label value.
+    """
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class AMQMetrics():
+    """
+    AMQMetrics collects the throughput and latency statistics of one or several clients.
+
+    Per destination it tracks the number and size of the received and sent messages, the
+    callback latency, the ack latency (time between the reception and the acknowledgement of
+    a message) and the send latency. Reconnection durations are tracked globally.
+
+    The statistics are exported in the Prometheus text format by render, either through the
+    lifesign (summary) or by a local HTTP server (start_http_server).
+
+    Methods:
+        observe_received(destination, size): Counts a received message.
+        observe_sent(destination, count, size, seconds): Counts sent messages and the time spent sending.
+        observe_callback(destination, seconds): Records a callback duration.
+        observe_ack(destination, seconds): Records an ack latency.
+        observe_reconnect(seconds): Records a reconnection duration.
+        summary(): Returns a compact dictionary for the lifesign.
+        render(): Returns the metrics in the Prometheus/OpenMetrics text format.
+        start_http_server(port, host): Serves render on http://host:port/metrics.
+        stop_http_server(): Stops the HTTP server.
+    """
+
+    def __init__(self):
+        self.destinations = {}
+        self.reconnects = AMQHistogram()
+        self.lastsummary = (time.monotonic(), {})
+        self.httpserver = None
+
+    def destination(self, destination):
+        stats = self.destinations.get(destination)
+        if stats is None:
+            stats = self.destinations.setdefault(destination, {
+                "received": 0, "receivedbytes": 0, "sent": 0, "sentbytes": 0,
+                "callback": AMQHistogram(), "ack": AMQHistogram(), "send": AMQHistogram()})
+        return stats
+
+    def observe_received(self, destination, size):
+        stats = self.destination(destination)
+        stats["received"] += 1
+        stats["receivedbytes"] += size
+
+    def observe_sent(self, destination, count, size, seconds):
+        stats = self.destination(destination)
+        stats["sent"] += count
+        stats["sentbytes"] += size
+        stats["send"].observe(seconds)
+
+    def observe_callback(self, destination, seconds):
+        self.destination(destination)["callback"].observe(seconds)
+
+    def observe_ack(self, destination, seconds):
+        self.destination(destination)["ack"].observe(seconds)
+
+    def observe_reconnect(self, seconds):
+        self.reconnects.observe(seconds)
+
+    def summary(self):
+        now = time.monotonic()
+        last, lastcounts = self.lastsummary
+        elapsed = max(now - last, 0.001)
+        res = {}
+        counts = {}
+        for destination, stats in list(self.destinations.items()):
+            counts[destination] = stats["received"] + stats["sent"]
+            res[destination] = {
+                "rate": round((counts[destination] - lastcounts.get(destination, 0)) / elapsed, 3),
+                "received": stats["received"],
+                "receivedbytes": stats["receivedbytes"],
+                "sent": stats["sent"],
+                "sentbytes": stats["sentbytes"],
+                "callbackp50": stats["callback"].quantile(0.5),
+                "callbackp99": stats["callback"].quantile(0.99),
+                "ackp99": stats["ack"].quantile(0.99),
+                "sendp99": stats["send"].quantile(0.99)
+            }
+        self.lastsummary = (now, counts)
+        return {"destinations": res, "reconnects": self.reconnects.count,
+                "reconnectseconds": round(self.reconnects.sum, 3)}
+
+    def render(self):
+        lines = []
+
+        def counter(name, help, field):
+            lines.append("# HELP amq_%s %s" % (name, help))
+            lines.append("# TYPE amq_%s counter" % name)
+            for destination, stats in list(self.destinations.items()):
+                lines.append('amq_%s_total{destination="%s"} %d' % (name, escape_label(destination), stats[field]))
+
+        def histogram(name, help, histograms):
+            lines.append("# HELP amq_%s_seconds %s" % (name, help))
+            lines.append("# TYPE amq_%s_seconds histogram" % name)
+            for labels, hist in histograms:
+                total = 0
+                for index, count in enumerate(hist.counts):
+                    total += count
+                    bound = "%g" % LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else "+Inf"
+                    lines.append('amq_%s_seconds_bucket{%sle="%s"} %d' % (name, labels, bound, total))
+                lines.append("amq_%s_seconds_sum{%s} %f" % (name, labels.rstrip(","), hist.sum))
+                lines.append("amq_%s_seconds_count{%s} %d" % (name, labels.rstrip(","), hist.count))
+
+        counter("received_messages", "Messages received.", "received")
+        counter("received_bytes", "Payload bytes received.", "receivedbytes")
+        counter("sent_messages", "Messages sent.", "sent")
+        counter("sent_bytes", "Payload bytes sent.", "sentbytes")
+        items = list(self.destinations.items())
+        for field, help in (("callback", "Callback duration."), ("ack", "Time between reception and ack."),
+                            ("send", "Time spent writing messages.")):
+            histogram(field, help, [('destination="%s",' % escape_label(destination), stats[field])
+                                    for destination, stats in items])
+        histogram("reconnect", "Reconnection duration.", [("", self.reconnects)])
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def start_http_server(self, port, host="127.0.0.1"):
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("#=- Metrics: " + format, *args)
+
+        self.httpserver = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        self.httpserver.daemon_threads = True
+        threading.Thread(target=self.httpserver.serve_forever, name="amq-metrics", daemon=True).start()
+        logger.info("#=- Metrics available on http://%s:%d/metrics", host, self.httpserver.server_address[1])
+
+    def stop_http_server(self):
+        if self.httpserver is not None:
+            self.httpserver.shutdown()
+            self.httpserver.server_close()
+            self.httpserver = None
+
+
+def create_metrics(server):
+    """
+    Creates the AMQMetrics of a server dictionary "metrics" entry: True, or a dictionary
+    with the port (and host) of the HTTP endpoint. Returns None when metrics are disabled.
+    """
+    config = server.get("metrics")
+    if not config:
+        return None
+    metrics = AMQMetrics()
+    if isinstance(config, dict) and "port" in config:
+        metrics.start_http_server(config["port"], config.get("host", "127.0.0.1"))
+    return metrics
+
+
+##################################################################################
+# AMQ Life Signer
+##################################################################################
+
+LIFESIGN_COUNTERS = ("errors", "internalerrors", "heartbeaterrors", "messages", "connections", "dropped", "retried",
+                     "deadlettered")
+
+
+class AMQLifeSigner():
+    """
+    AMQLifeSigner sends the lifesign of a client from a background thread.
+
+    Every interval seconds it sends a compact delta lifesign: the counter increments since the
+    previous beat, the message rate and the top destinations by number of messages. A beat
+    is skipped when nothing changed, and every full intervals the complete lifesign of
+    generate_life_sign is sent instead, with "full" set to True.
+
+    Configured by the module dictionary: lifesigninterval (seconds), lifesignfull (number of
+    intervals between two full lifesigns, 12 by default) and lifesigntop (number of destinations
+    of the delta lifesigns, 10 by default).
+
+    Args:
+        client: The AMQClient or AMQClientPool sending the lifesigns.
+        interval (float): Seconds between two beats.
+        full (int): Number of intervals between two full lifesigns.
+        top (int): Number of destinations reported in the delta lifesigns.
+
+    Attributes:
+        variables (dict): Extra keys added to every lifesign.
+        skipped (int): Number of beats skipped because nothing changed.
+
+    Methods:
+        generate_delta(lifesign): Returns the delta lifesign, or None when nothing changed.
+        beat(): Sends one delta or full lifesign.
+        stop(): Stops the timer thread.
+    """
+
+    def __init__(self, client, interval, full=12, top=10):
+        self.client = client
+        self.interval = interval
+        self.full = max(1, int(full))
+        self.top = top
+        self.variables = {}
+        self.skipped = 0
+        self.beats = 0
+        self.previous = None
+        self.previoustime = time.monotonic()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="amq-lifesign", daemon=True)
+        self.thread.start()
+
+    def delta_counters(self, current, previous):
+        res = {}
+        for key, value in current.items():
+            delta = value - previous.get(key, 0)
+            if delta < 0:
+                # The counters of the listener restart after a reconnection.
+                delta = value
+            if delta > 0:
+                res[key] = delta
+        return dict(sorted(res.items(), key=lambda entry: -entry[1])[:self.top])
+
+    def generate_delta(self, lifesign):
+        previous = self.previous
+        elapsed = max(time.monotonic() - self.previoustime, 0.001)
+        delta = {
+            "error": "OK",
+            "type": "lifesign",
+            "eventtype": "lifesign",
+            "module": lifesign["module"],
+            "version": lifesign["version"],
+            "alive": 1,
+            "full": False,
+            "interval": round(elapsed, 3),
+            "received": self.delta_counters(lifesign["received"], previous["received"]),
+            "sent": self.delta_counters(lifesign["sent"], previous["sent"])
+        }
+        changed = len(delta["received"]) > 0 or len(delta["sent"]) > 0
+        for key in LIFESIGN_COUNTERS:
+            value = lifesign.get(key, 0) - previous.get(key, 0)
+            if value != 0:
+                delta[key] = value
+                changed = True
+        if lifesign.get("flowcontrol") != previous.get("flowcontrol"):
+            delta["throttle"] = lifesign["throttle"]
+            delta["flowcontrol"] = lifesign["flowcontrol"]
+            changed = True
+        if not changed:
+            return None
+        delta["rate"] = round((sum(lifesign["received"].values()) + sum(lifesign["sent"].values())
+                               - sum(previous["received"].values()) - sum(previous["sent"].values())) / elapsed, 3)
+        return delta
+
+    def beat(self):
+        lifesign = self.client.generate_life_sign()
+        if self.previous is None or self.beats % self.full == 0:
+            payload = dict(lifesign)
+            payload["full"] = True
+        else:
+            payload = self.generate_delta(lifesign)
+        self.beats += 1
+        if payload is None:
+            self.skipped += 1
+            return
+        # The lifesign dictionaries are shared with the client, keep a copy for the next delta.
+        self.previous = dict(lifesign, received=dict(lifesign["received"]), sent=dict(lifesign["sent"]))
+        self.previoustime = time.monotonic()
+        payload.update(self.variables)
+        self.client.send_message(self.client.module["lifesign"], json_encode(payload))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                logger.error("#=- Unable to send life sign: %s", e)
+
+    def stop(self):
+        self.stopped.set()
+
+
+##################################################################################
+# AMQ Ack Batcher
+##################################################################################
+
+class AMQAckBatcher():
+    """
+    AMQAckBatcher groups the acknowledgements of client ack subscriptions.
+
+    With ack='client' an ACK frame is cumulative: it acknowledges the message and all the
+    messages received before it on the same subscription. The batcher therefore only keeps
+    the last message id of each subscription and sends a single ACK every size messages or
+    when the oldest pending message is older than interval milliseconds.
+
+    Args:
+        amqconn: The AMQ client owning the stomp connection.
+        size (int): Number of messages acknowledged per ACK frame.
+        interval (int): Maximum time in milliseconds a message stays unacknowledged.
+
+    Methods:
+        add(message_id, subscription_id, destination): Registers a message to acknowledge.
+        flush(): Sends the pending acknowledgements of all the subscriptions.
+        clear(): Forgets the pending acknowledgements (used when the connection is lost).
+        pending(): Returns the number of pending acknowledgements per destination.
+        stop(): Flushes and stops the timer thread.
+    """
+
+    def __init__(self, amqconn, size=100, interval=1000):
+        self.internal_conn = amqconn
+        self.size = max(1, int(size))
+        self.interval = max(1, int(interval)) / 1000.0
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="amq-ackbatcher", daemon=True)
+        self.thread.start()
+
+    def add(self, message_id, subscription_id, destination):
+        with self.lock:
+            entry = self.subscriptions.get(subscription_id)
+            if entry is None:
+                entry = [message_id, 0, destination, time.monotonic()]
+                self.subscriptions[subscription_id] = entry
+            entry[0] = message_id
+            entry[1] += 1
+            if entry[1] >= self.size:
+                self._send(subscription_id, entry)
+
+    def _send(self, subscription_id, entry):
+        del self.subscriptions[subscription_id]
+        try:
+            self.internal_conn.conn.ack(entry[0], subscription_id)
+        except Exception as e:
+            logger.error("#=- Unable to send cumulative ack for %s: %s", entry[2], e)
+
+    def flush(self, older_than=None):
+        with self.lock:
+            now = time.monotonic()
+            for subscription_id, entry in list(self.subscriptions.items()):
+                if older_than is None or now - entry[3] >= older_than:
+                    self._send(subscription_id, entry)
+
+    def clear(self):
+        with self.lock:
+            self.subscriptions = {}
+
+    def pending(self):
+        res = {}
+        with self.lock:
+            for entry in self.subscriptions.values():
+                res[entry[2]] = res.get(entry[2], 0) + entry[1]
+        return res
+
+    def run(self):
+        while not self.stopped.wait(self.interval / 2):
+            self.flush(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+
+##################################################################################
+# AMQ Dispatcher
+##################################################################################
+
+class AMQDispatcher():
+    """
+    AMQDispatcher runs the message callbacks outside of the stomp.py receiver thread.
+
+    Messages are sharded by key (the subscription id) over a fixed number of workers, so
+    messages of a subscription are handled one at a time and in order. Each worker owns a
+    bounded queue: when it is full, submit blocks the receiver thread, which stops reading
+    the socket and lets the broker prefetch window throttle the delivery.
+
+    The prefetch window only throttles the client ack modes. Auto ack and early ack messages keep
+    coming while the receiver thread is blocked, delaying the heartbeats and receipts until the
+    broker or the client drops the connection: use a client ack mode, or a flow control pausedepth
+    lower than the queue size so that these subscriptions are paused before the queue fills up.
+
+    Args:
+        workers (int): Number of workers.
+        queuesize (int): Maximum number of queued messages per worker.
+        mode (str): thread to run the callbacks in the worker threads, process to run them in
+            one child process per worker (the callback and its arguments must then be picklable,
+            memoryview bodies are copied to bytes).
+
+    Attributes:
+        abandoned (int): Number of queued jobs dropped because stop timed out.
+
+    Methods:
+        submit(key, function, *args): Queues a job on the worker owning key.
+        call(callback, *args): Runs a callback in the execution context of the current worker.
+        depth(): Returns the number of queued jobs.
+        stop(timeout): Waits for the queued jobs to complete and stops the workers. The jobs still
+            queued after timeout seconds are abandoned.
+    """
+
+    def __init__(self, workers=4, queuesize=100, mode="thread"):
+        if mode not in ("thread", "process"):
+            raise ValueError("Invalid dispatcher mode %r" % (mode,))
+        self.mode = mode
+        self.queuesize = max(1, int(queuesize))
+        self.local = threading.local()
+        self.queues = []
+        self.threads = []
+        self.executors = []
+        self.saturated = 0
+        self.abandoned = 0
+        self.stopped = False
+        self.expired = False
+        for i in range(max(1, int(workers))):
+            self.queues.append(queue.Queue(maxsize=self.queuesize))
+            executor = None
+            if mode == "process":
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+            self.executors.append(executor)
+            thread = threading.Thread(target=self.run, args=(i,), name="amq-worker-%d" % i, daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def submit(self, key, function, *args):
+        if self.expired:
+            self.abandoned += 1
+            return
+        shardqueue = self.queues[hash(key) % len(self.queues)]
+        try:
+            shardqueue.put_nowait((function, args))
+        except queue.Full:
+            self.saturated += 1
+            logger.debug("#=- Worker queue full. Waiting.")
+            shardqueue.put((function, args))
+
+    def call(self, callback, *args):
+        executor = getattr(self.local, "executor", None)
+        if executor is None:
+            return callback(*args)
+        return executor.submit(callback, *[picklable(arg) for arg in args]).result()
+
+    def depth(self):
+        return sum(shardqueue.qsize() for shardqueue in self.queues)
+
+    def run(self, index):
+        self.local.executor = self.executors[index]
+        shardqueue = self.queues[index]
+        while True:
+            job = shardqueue.get()
+            try:
+                if job is None:
+                    return
+                if self.expired:
+                    self.abandoned += 1
+                else:
+                    job[0](*job[1])
+            except Exception as e:
+                logger.error("#=- Worker job failed: %s", e, exc_info=True)
+            finally:
+                shardqueue.task_done()
+            # stop could not queue the sentinel in a full queue
+            if self.stopped and shardqueue.empty():
+                return
+
+    def stop(self, timeout=None):
+        if not self.stopped:
+            self.stopped = True
+            for shardqueue in self.queues:
+                try:
+                    shardqueue.put_nowait(None)
+                except queue.Full:
+                    pass
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        if any(thread.is_alive() for thread in self.threads):
+            # The running callbacks complete, the queued messages are left unacked for the broker.
+            self.expired = True
+            logger.warning("#=- Dispatcher stopped with %d queued jobs.", self.depth())
+        for executor in self.executors:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+
+def picklable(arg):
+    """
+    Copies the memoryview bodies of the raw codec, alone or in a batch, to bytes so that they
+    can be sent to a process worker.
+    """
+    if isinstance(arg, memoryview):
+        return arg.tobytes()
+    if isinstance(arg, list):
+        return [picklable(item) for item in arg]
+    return arg
+
+
+##################################################################################
+# AMQ Message Batcher
+##################################################################################
+
+class AMQMessageBatcher():
+    """
+    AMQMessageBatcher collects the received messages of each subscription and hands them to the
+    batch callback as lists, batch_callback(destination, messages, headers), messages and headers
+    being lists of the same length.
+
+    A batch is handed over when it contains size messages or when its first message is older
+    than interval milliseconds. Once the callback returns, a client ack subscription receives
+    a single cumulative ACK for the last message of the batch (one ACK per message with
+    client-individual). If the callback raises, the batch is NACKed so that the broker
+    redelivers it.
+
+    Args:
+        amqconn: The AMQ client owning the stomp connection.
+        callback (callable): The batch callback.
+        size (int): Maximum number of messages per batch.
+        interval (int): Maximum time in milliseconds a message waits for its batch.
+
+    Methods:
+        add(subscription_id, destination, message, headers, mustack, duplicate=False): Adds a message to
+            the batch of its subscription. Duplicates are only acknowledged with the batch.
+        flush(older_than=None): Hands over the batches, or only those older than older_than seconds.
+        clear(subscription_id=None): Drops the collected batches of a subscription, or all of them
+            (used when the connection is lost).
+        pending(): Returns the number of collected messages per destination.
+        stop(): Hands over the collected batches and stops the timer thread.
+    """
+
+    def __init__(self, amqconn, callback, size=100, interval=1000):
+        self.internal_conn = amqconn
+        self.callback = callback
+        self.size = max(1, int(size))
+        self.interval = max(1, int(interval)) / 1000.0
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.batchcount = 0
+        self.failed = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="amq-batcher", daemon=True)
+        self.thread.start()
+
+    def add(self, subscription_id, destination, message, headers, mustack, duplicate=False):
+        with self.lock:
+            batch = self.batches.get(subscription_id)
+            if batch is None:
+                spec = self.internal_conn.subscriptions.get(subscription_id)
+                batch = {"destination": spec["destination"] if spec is not None else destination,
+                         "messages": [], "headers": [], "acks": [], "mustack": mustack, "start": time.monotonic(),
+                         "generation": self.internal_conn.generation(subscription_id)}
+                self.batches[subscription_id] = batch
+            # The duplicates are only acknowledged, in order with the batch.
+            batch["acks"].append(headers)
+            if not duplicate:
+                batch["messages"].append(message)
+                batch["headers"].append(headers)
+            if len(batch["acks"]) >= self.size:
+                self._hand_over(subscription_id)
+
+    def _hand_over(self, subscription_id):
+        # Called with the lock held, which keeps the batches of a subscription in order.
+        batch = self.batches.pop(subscription_id)
+        self.batchcount += 1
+        dispatcher = self.internal_conn.dispatcher
+        if dispatcher is not None:
+            dispatcher.submit(subscription_id, self.process, subscription_id, batch)
+        else:
+            self.process(subscription_id, batch)
+
+    def process(self, subscription_id, batch):
+        if batch["mustack"] and batch["generation"] != self.internal_conn.generation(subscription_id):
+            logger.debug("#=- Subscription changed. Batch dropped.")
+            if self.internal_conn.flowcontroller is not None:
+                self.internal_conn.flowcontroller.message_dropped(subscription_id, len(batch["messages"]))
+            return
+        metrics = self.internal_conn.metrics
+        callbackstart = time.monotonic()
+        success = True
+        try:
+            dispatcher = self.internal_conn.dispatcher
+            if len(batch["messages"]) == 0:
+                pass
+            elif dispatcher is not None:
+                dispatcher.call(self.callback, batch["destination"], batch["messages"], batch["headers"])
+            else:
+                self.callback(batch["destination"], batch["messages"], batch["headers"])
+        except Exception as e:
+            success = False
+            self.failed += 1
+            self.internal_conn.listener.globalerrors += 1
+            logger.error("#=- Batch callback failed on %d messages of %s: %s", len(batch["messages"]),
+                         batch["destination"], e, exc_info=True)
+        callbackduration = time.monotonic() - callbackstart
+        if metrics is not None:
+            metrics.observe_callback(batch["destination"], callbackduration)
+        if self.internal_conn.flowcontroller is not None:
+            self.internal_conn.flowcontroller.message_handled(subscription_id, callbackduration,
+                                                              len(batch["messages"]))
+
+        deduplicator = self.internal_conn.deduplicator
+        if success and deduplicator is not None:
+            for headers in batch["headers"]:
+                key = deduplicator.key(headers)
+                if key is not None:
+                    deduplicator.add(key)
+        if not batch["mustack"]:
+            return
+        if batch["generation"] != self.internal_conn.generation(subscription_id):
+            logger.debug("#=- Connection changed. Batch will be redelivered.")
+            return
+        try:
+            if self.internal_conn.ack_mode(subscription_id) == "client":
+                # ACK and NACK are cumulative in client mode.
+                tosend = batch["acks"][-1:]
+            else:
+                tosend = batch["acks"]
+            for headers in tosend:
+                if success:
+                    self.internal_conn.ack_message(headers)
+                else:
+                    self.internal_conn.conn.nack(headers["message-id"], subscription_id)
+        except Exception as e:
+            logger.error("#=- Unable to acknowledge the batch of %s: %s", batch["destination"], e)
+
+    def flush(self, older_than=None):
+        with self.lock:
+            now = time.monotonic()
+            for subscription_id, batch in list(self.batches.items()):
+                if older_than is None or now - batch["start"] >= older_than:
+                    self._hand_over(subscription_id)
+
+    def clear(self, subscription_id=None):
+        with self.lock:
+            if subscription_id is None:
+                dropped, self.batches = self.batches, {}
+            else:
+                batch = self.batches.pop(subscription_id, None)
+                dropped = {subscription_id: batch} if batch is not None else {}
+        flowcontroller = self.internal_conn.flowcontroller
+        if flowcontroller is not None:
+            for key, batch in dropped.items():
+                flowcontroller.message_dropped(key, len(batch["messages"]))
+
+    def pending(self):
+        res = {}
+        with self.lock:
+            for batch in self.batches.values():
+                res[batch["destination"]] = res.get(batch["destination"], 0) + len(batch["messages"])
+        return res
+
+    def run(self):
+        while not self.stopped.wait(min(self.interval / 2, 0.5)):
+            self.flush(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+
+##################################################################################
+# AMQ Flow Controller
+##################################################################################
+
+FLOWCONTROL_DEFAULTS = {"high": 500, "low": 50, "highdepth": 1000, "lowdepth": 100, "pausedepth": 0,
+                        "min": 1, "max": 0, "factor": 2, "interval": 1000}
+THROTTLE_STATES = ("normal", "throttled", "paused")
+
+
+class AMQFlowController():
+    """
+    AMQFlowController adapts the prefetch of the subscriptions to the speed of the consumer.
+
+    Every interval milliseconds it computes, per subscription, the average callback latency of
+    the period and the depth (messages received but not handled yet). When the latency is above
+    the high watermark or the depth above highdepth, the subscription is resubscribed with its
+    prefetch divided by factor (down to min). When both are below the low watermarks, the prefetch
+    is multiplied by factor (up to max, the configured prefetch by default). When pausedepth is set
+    and reached, the subscription is unsubscribed until the depth falls below lowdepth. Pausing is
+    the only throttle of auto ack and early ack subscriptions, which the prefetch does not limit.
+
+    Resubscribing makes the broker redeliver the unacknowledged messages of the subscription: the
+    messages received before are dropped by the listener instead of being handled twice. Topics
+    do not redeliver, and do not keep the messages published while unsubscribed: the topic
+    subscriptions are never resubscribed or paused.
+
+    Args:
+        amqconn: The AMQ client owning the subscriptions.
+        config (dict): Watermarks, overriding FLOWCONTROL_DEFAULTS. Latencies are in milliseconds.
+
+    Methods:
+        message_received(subscription_id): Counts a message entering the client.
+        message_handled(subscription_id, seconds, count=1): Counts handled messages and their callback latency.
+        message_dropped(subscription_id, count=1): Counts messages dropped because they are redelivered.
+        evaluate(): Applies the watermarks once.
+        state(): Returns the throttle state and the prefetch per destination.
+        throttle(): Returns the most restrictive state of the subscriptions.
+        remove(subscription_id): Forgets the statistics of a removed subscription.
+        stop(): Stops the timer thread.
+    """
+
+    def __init__(self, amqconn, config):
+        self.internal_conn = amqconn
+        self.config = dict(FLOWCONTROL_DEFAULTS)
+        self.config.update(config)
+        self.lock = threading.Lock()
+        self.depths = collections.Counter()
+        self.latencies = {}
+        self.states = {}
+        self.maxprefetch = {}
+        self.changes = 0
+        for subscription_id, spec in amqconn.subscriptions.items():
+            self.maxprefetch[subscription_id] = self.config["max"] or spec["prefetch"]
+            self.states[subscription_id] = "normal"
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="amq-flowcontrol", daemon=True)
+        self.thread.start()
+
+    def message_received(self, subscription_id):
+        with self.lock:
+            self.depths[subscription_id] += 1
+
+    def message_handled(self, subscription_id, seconds, count=1):
+        with self.lock:
+            self.depths[subscription_id] = max(0, self.depths[subscription_id] - count)
+            entry = self.latencies.setdefault(subscription_id, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += count
+
+    def message_dropped(self, subscription_id, count=1):
+        with self.lock:
+            self.depths[subscription_id] = max(0, self.depths[subscription_id] - count)
+
+    def remove(self, subscription_id):
+        with self.lock:
+            self.depths.pop(subscription_id, None)
+            self.latencies.pop(subscription_id, None)
+        self.states.pop(subscription_id, None)
+        self.maxprefetch.pop(subscription_id, None)
+
+    def evaluate(self):
+        config = self.config
+        with self.lock:
+            latencies = self.latencies
+            self.latencies = {}
+            depths = dict(self.depths)
+        for subscription_id, spec in list(self.internal_conn.subscriptions.items()):
+            entry = latencies.get(subscription_id)
+            latency = entry[0] * 1000 / entry[1] if entry else 0.0
+            depth = depths.get(subscription_id, 0)
+            state = self.states.get(subscription_id, "normal")
+            maxprefetch = self.maxprefetch.setdefault(subscription_id, config["max"] or spec["prefetch"])
+
+            if is_topic(spec["destination"]):
+                continue
+            if state == "paused":
+                if depth <= config["lowdepth"]:
+                    logger.info("#=- Resuming %s (depth %d).", spec["destination"], depth)
+                    self.internal_conn.resume_subscription(subscription_id)
+                    self.changes += 1
+                else:
+                    continue
+            elif config["pausedepth"] and depth >= config["pausedepth"]:
+                logger.warning("#=- Pausing %s (depth %d).", spec["destination"], depth)
+                self.internal_conn.pause_subscription(subscription_id)
+                self.states[subscription_id] = "paused"
+                self.changes += 1
+                continue
+            elif spec["ack"] == "auto" or self.internal_conn.earlyack:
+                # The broker does not limit the unacknowledged messages, only pausing helps.
+                pass
+            elif latency > config["high"] or depth > config["highdepth"]:
+                prefetch = max(config["min"], spec["prefetch"] // config["factor"])
+                if prefetch != spec["prefetch"]:
+                    logger.info("#=- Throttling %s: prefetch %d (latency %.1fms depth %d).", spec["destination"],
+                                prefetch, latency, depth)
+                    self.internal_conn.resubscribe(subscription_id, prefetch)
+                    self.changes += 1
+            elif latency < config["low"] and depth < config["lowdepth"] and spec["prefetch"] < maxprefetch:
+                prefetch = min(maxprefetch, spec["prefetch"] * config["factor"])
+                logger.info("#=- Releasing %s: prefetch %d (latency %.1fms depth %d).", spec["destination"],
+                            prefetch, latency, depth)
+                self.internal_conn.resubscribe(subscription_id, prefetch)
+                self.changes += 1
+            self.states[subscription_id] = "throttled" if spec["prefetch"] < maxprefetch else "normal"
+
+    def state(self):
+        res = {}
+        for subscription_id, spec in list(self.internal_conn.subscriptions.items()):
+            res[spec["destination"]] = {"state": self.states.get(subscription_id, "normal"),
+                                        "prefetch": spec["prefetch"]}
+        return res
+
+    def throttle(self):
+        states = [self.states.get(subscription_id, "normal") for subscription_id in self.internal_conn.subscriptions]
+        return max(states + ["normal"], key=THROTTLE_STATES.index)
+
+    def run(self):
+        while not self.stopped.wait(self.config["interval"] / 1000.0):
+            try:
+                self.evaluate()
+            except Exception as e:
+                logger.error("#=- Flow control failed: %s", e, exc_info=True)
+
+    def stop(self):
+        self.stopped.set()
+
+
+##################################################################################
+# AMQ Retry
+##################################################################################
+
+class AMQTimerWheel():
+    """
+    AMQTimerWheel is a hashed timer wheel: a single thread runs the scheduled jobs with a
+    resolution of tick seconds, whatever the number of pending jobs.
+
+    Args:
+        tick (float): Resolution in seconds.
+        slots (int): Number of slots of the wheel. Delays longer than tick * slots take several turns.
+
+    Methods:
+        schedule(delay, function, *args): Runs function(*args) in about delay seconds.
+        pending(): Returns the number of scheduled jobs.
+        stop(): Stops the wheel thread, dropping the pending jobs.
+    """
+
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = [[] for i in range(slots)]
+        self.position = 0
+        self.count = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="amq-timerwheel", daemon=True)
+        self.thread.start()
+
+    def schedule(self, delay, function, *args):
+        ticks = max(1, int(round(delay / self.tick)))
+        with self.lock:
+            # [remaining turns, function, args]
+            self.slots[(self.position + ticks) % len(self.slots)].append([(ticks - 1) // len(self.slots),
+                                                                         function, args])
+            self.count += 1
+
+    def pending(self):
+        return self.count
+
+    def advance(self):
+        with self.lock:
+            self.position = (self.position + 1) % len(self.slots)
+            slot = self.slots[self.position]
+            due = [entry for entry in slot if entry[0] == 0]
+            self.slots[self.position] = [entry for entry in slot if entry[0] > 0]
+            for entry in self.slots[self.position]:
+                entry[0] -= 1
+            self.count -= len(due)
+        for entry in due:
+            try:
+                entry[1](*entry[2])
+            except Exception as e:
+                logger.error("#=- Timer job failed: %s", e, exc_info=True)
+
+    def run(self):
+        nexttick = time.monotonic() + self.tick
+        while not self.stopped.wait(max(0.0, nexttick - time.monotonic())):
+            nexttick += self.tick
+            self.advance()
+
+    def stop(self):
+        self.stopped.set()
+
+
+RETRY_DEFAULTS = {"attempts": 3, "mode": "delay", "delay": 1.0, "factor": 2.0, "max": 60.0, "dlq": None,
+                  "countheader": "redelivery-count"}
+DLQ_REMOVED_HEADERS = ("message-id", "subscription", "destination", "ack", "content-length", "redelivered",
+                       "expires", "timestamp")
+
+
+class AMQRetrier():
+    """
+    AMQRetrier applies the retry policies of the subscriptions when a callback raises.
+
+    A policy is the "retry" key of a subscription spec, or the "retry" server entry for all the
+    subscriptions (see RETRY_DEFAULTS):
+        attempts (int): Number of attempts, the first delivery included, before giving up.
+        mode (str): delay to call the callback again after a backoff (delay seconds multiplied by
+            factor at each attempt, up to max), without acknowledging the message in the meantime.
+            nack to NACK the message so that the broker redelivers it. ActiveMQ Classic handles a
+            STOMP NACK as a poison ack and moves the message to its own dead letter queue
+            (ActiveMQ.DLQ by default) instead of redelivering it.
+            The client ack mode is cumulative: the ack of the next message would acknowledge a
+            delayed one, and the ack of a dead letter would acknowledge the messages received
+            before it. Client ack subscriptions only accept nack policies without dlq.
+        dlq (str): Destination receiving the messages that failed all their attempts, with
+            dlq-original-destination, dlq-original-message-id, dlq-error, dlq-exception and
+            dlq-attempts headers. The message is acknowledged once the broker confirmed the
+            forward. Without dlq, the message is acknowledged and dropped.
+        countheader (str): Header carrying the broker redelivery count. When the broker does not
+            provide one, the NACKed messages are counted by the client.
+
+    Args:
+        amqconn: The AMQ client.
+        policy (dict, optional): Default policy of the subscriptions.
+
+    Attributes:
+        retried (dict): Number of retries per destination.
+        deadlettered (dict): Number of messages forwarded to a DLQ per destination.
+        exhausted (int): Number of messages dropped after their last attempt, without DLQ.
+        scheduled (int): Number of delayed retries held in the timer wheel of the client.
+
+    Methods:
+        policy(subscription_id): Returns the retry policy of a subscription, or None.
+        spec_policy(spec): Returns the retry policy of a subscription spec, or None.
+        failed(destination, message, headers, error, attempt, generation, mustack): Applies the policy
+            of a failed message. Returns True if the message must not be acknowledged now.
+        succeeded(headers): Forgets the attempts of a message.
+        stats(): Returns the retry counters for the lifesign.
+    """
+
+    def __init__(self, amqconn, policy=None):
+        self.internal_conn = amqconn
+        self.default = policy
+        self.retried = {}
+        self.deadlettered = {}
+        self.exhausted = 0
+        self.attempts = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.scheduled = 0
+
+    def policy(self, subscription_id):
+        return self.spec_policy(self.internal_conn.subscriptions.get(subscription_id))
+
+    def spec_policy(self, spec):
+        policy = spec.get("retry") if spec is not None else None
+        if policy is None:
+            policy = self.default
+        if policy is None:
+            return None
+        res = dict(RETRY_DEFAULTS)
+        res.update(policy)
+        return res
+
+    def redeliveries(self, policy, headers):
+        count = headers.get(policy["countheader"])
+        if count is not None:
+            try:
+                return int(count)
+            except ValueError:
+                pass
+        with self.lock:
+            local = self.attempts.get(headers.get("message-id"), 0)
+        if local == 0 and headers.get("redelivered") == "true":
+            return 1
+        return local
+
+    def failed(self, destination, message, headers, error, attempt, generation, mustack):
+        subscription_id = headers.get("subscription")
+        policy = self.policy(subscription_id)
+        if policy is None:
+            return False
+        total = attempt + self.redeliveries(policy, headers)
+        if total < policy["attempts"]:
+            self.retried[destination] = self.retried.get(destination, 0) + 1
+            if policy["mode"] == "nack" and mustack:
+                self.nack(headers, generation)
+            else:
+                delay = min(policy["max"], policy["delay"] * (policy["factor"] ** (total - 1)))
+                logger.info("#=- Retrying message of %s in %.1fs (attempt %d/%d).", destination, delay,
+                            total + 1, policy["attempts"])
+                self.scheduled += 1
+                self.internal_conn.timer_wheel().schedule(delay, self.retry, destination, message, headers, mustack,
+                                                          generation, attempt + 1)
+            return True
+        self.succeeded(headers)
+        if policy["dlq"] is None:
+            logger.error("#=- Message of %s failed %d times. Dropped.", destination, total)
+            self.exhausted += 1
+            return False
+        return self.dead_letter(policy["dlq"], destination, message, headers, error, total, generation, mustack)
+
+    def nack(self, headers, generation):
+        if generation != self.internal_conn.generation(headers.get("subscription")):
+            return
+        with self.lock:
+            messageid = headers.get("message-id")
+            self.attempts[messageid] = self.attempts.pop(messageid, 0) + 1
+            while len(self.attempts) > 10000:
+                self.attempts.popitem(last=False)
+        if self.internal_conn.ackbatcher is not None:
+            # A NACK is cumulative in client mode, the handled messages must be acknowledged first.
+            self.internal_conn.ackbatcher.flush()
+        self.internal_conn.conn.nack(headers["message-id"], headers.get("subscription"))
+
+    def retry(self, destination, message, headers, mustack, generation, attempt):
+        self.scheduled -= 1
+        listener = self.internal_conn.listener
+        dispatcher = self.internal_conn.dispatcher
+        if dispatcher is not None:
+            dispatcher.submit(headers.get("subscription"), listener.process_message, destination, message, headers,
+                              mustack, generation, None, attempt)
+        else:
+            listener.process_message(destination, message, headers, mustack, generation, None, attempt)
+
+    def dead_letter(self, dlq, destination, message, headers, error, attempts, generation, mustack):
+        logger.error("#=- Message of %s failed %d times. Forwarded to %s.", destination, attempts, dlq)
+        dlqheaders = {key: value for key, value in headers.items() if key not in DLQ_REMOVED_HEADERS}
+        dlqheaders.update({"dlq-original-destination": destination,
+                           "dlq-original-message-id": headers.get("message-id", ""),
+                           "dlq-error": str(error)[:1000], "dlq-exception": type(error).__name__,
+                           "dlq-attempts": attempts, "dlq-time": datetime.datetime.now().isoformat()})
+        self.deadlettered[destination] = self.deadlettered.get(destination, 0) + 1
+        if not mustack:
+            self.internal_conn.send_message(dlq, message, dlqheaders)
+            return False
+
+        def forwarded(future):
+            if future.exception() is not None:
+                logger.error("#=- Unable to forward to %s: %s. Message will be redelivered.", dlq,
+                             future.exception())
+            elif generation == self.internal_conn.generation(headers.get("subscription")):
+                self.internal_conn.ack_message(headers)
+
+        self.internal_conn.send_confirmed(dlq, message, dlqheaders).add_done_callback(forwarded)
+        return True
+
+    def succeeded(self, headers):
+        if self.attempts:
+            with self.lock:
+                self.attempts.pop(headers.get("message-id"), None)
+
+    def stats(self):
+        return {"retried": dict(self.retried), "deadlettered": dict(self.deadlettered),
+                "exhausted": self.exhausted, "scheduled": self.scheduled}
+
+
+##################################################################################
+# AMQ Outbox
+##################################################################################
+
+OUTBOX_DEFAULTS = {"directory": "outbox", "segmentsize": 16 * 1024 * 1024, "fsync": "interval", "interval": 100,
+                   "maxdisk": 1024 * 1024 * 1024, "window": 100}
+FSYNC_POLICIES = ("always", "interval", "never")
+# payload length, crc32, flags, destination length, headers length
+JOURNAL_RECORD = struct.Struct("<IIBHI")
+JOURNAL_STR_BODY = 1
+
+
+class AMQOutboxFull(AMQSendError):
+    """
+    Raised by send_message when the outbox journal reached its maximum disk usage.
+    """
+
+
+class AMQJournal():
+    """
+    AMQJournal is an append only journal of messages stored in memory-mapped segment files.
+
+    Segments are preallocated files of segmentsize bytes named outbox-<index>.seg. Each record is
+    a JOURNAL_RECORD header followed by the destination, the JSON headers and the body, and is
+    checked with a crc32 when the journal is opened again: a torn write ends the segment.
+    A commit thread flushes the written segments (group commit), writes the checkpoint file of
+    the first unconfirmed record and removes the segments that only contain confirmed records.
+
+    Args:
+        directory (str): Directory of the segments, created if needed.
+        segmentsize (int): Size of the segments in bytes, and so the maximum size of a record.
+        fsync (str): always (append returns once the record is flushed), interval (flushed every
+            interval milliseconds) or never (left to the operating system).
+        interval (int): Commit interval in milliseconds.
+        maxdisk (int): Maximum disk usage in bytes.
+
+    Attributes:
+        head (tuple): (segment, offset) of the first unconfirmed record.
+        tail (tuple): (segment, offset) where the next record is written.
+        count (int): Number of unconfirmed records.
+
+    Methods:
+        append(destination, body, headers=None): Writes a record. Raises AMQOutboxFull when maxdisk is reached.
+        read(position): Returns (next position, destination, body, headers) of the record at position,
+            or None at the tail.
+        next_record(position): Same as read without the lock, stops at the first invalid record.
+        truncate(position, count): Confirms count records, up to position.
+        depth(): Returns the number of unconfirmed records.
+        disk_usage(): Returns the size of the segments in bytes.
+        commit(): Flushes the written segments and removes the confirmed ones.
+        close(): Commits and closes the segments.
+    """
+
+    def __init__(self, directory, segmentsize=OUTBOX_DEFAULTS["segmentsize"], fsync="interval", interval=100,
+                 maxdisk=OUTBOX_DEFAULTS["maxdisk"]):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Invalid fsync policy %r" % (fsync,))
+        self.directory = directory
+        self.segmentsize = segmentsize
+        self.fsync = fsync
+        self.interval = interval / 1000.0
+        self.maxdisk = maxdisk
+        self.segments = {}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.dirty = set()
+        self.appended = 0
+        self.committed = 0
+        self.closed = False
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+        self.checkpointed = self.head
+        self.thread = threading.Thread(target=self.run, name="amq-journal", daemon=True)
+        self.thread.start()
+
+    def segment_path(self, index):
+        return os.path.join(self.directory, "outbox-%012d.seg" % index)
+
+    def open_segment(self, index):
+        path = self.segment_path(index)
+        with open(path, "a+b") as file:
+            if os.fstat(file.fileno()).st_size < self.segmentsize:
+                file.truncate(self.segmentsize)
+            self.segments[index] = mmap.mmap(file.fileno(), self.segmentsize)
+
+    def recover(self):
+        indexes = sorted(int(name[7:-4]) for name in os.listdir(self.directory)
+                         if name.startswith("outbox-") and name.endswith(".seg"))
+        head = (indexes[0], 0) if indexes else (0, 0)
+        try:
+            with open(os.path.join(self.directory, "checkpoint")) as file:
+                segment, offset = [int(value) for value in file.read().split()]
+            if segment in indexes:
+                head = (segment, offset)
+        except (OSError, ValueError):
+            pass
+        for index in indexes:
+            if index < head[0]:
+                os.remove(self.segment_path(index))
+            else:
+                self.open_segment(index)
+        if not self.segments:
+            self.open_segment(head[0])
+        self.head = head
+        self.tail = head
+        self.count = 0
+        while True:
+            record = self.next_record(self.tail)
+            if record is None:
+                break
+            self.tail = record[0]
+            self.count += 1
+        if self.count > 0:
+            logger.info("#=- Outbox journal recovered %d unconfirmed messages.", self.count)
+
+    def record_at(self, position):
+        segment = self.segments.get(position[0])
+        if segment is None or position[1] + JOURNAL_RECORD.size > self.segmentsize:
+            return None
+        length, crc, flags, destinationlength, headerslength = JOURNAL_RECORD.unpack_from(segment, position[1])
+        end = position[1] + JOURNAL_RECORD.size + length
+        if length == 0 or end > self.segmentsize:
+            return None
+        data = segment[position[1] + 8:end]
+        if zlib.crc32(data) != crc:
+            return None
+        return end, flags, destinationlength, headerslength, data[JOURNAL_RECORD.size - 8:]
+
+    def read(self, position):
+        with self.lock:
+            if position == self.tail:
+                return None
+            return self.next_record(position)
+
+    def next_record(self, position):
+        record = self.record_at(position)
+        if record is None:
+            # End of the segment: the next record starts the next one.
+            if position[0] + 1 not in self.segments:
+                return None
+            position = (position[0] + 1, 0)
+            record = self.record_at(position)
+            if record is None:
+                return None
+        end, flags, destinationlength, headerslength, payload = record
+        destination = payload[:destinationlength].decode("utf-8")
+        headers = json.loads(payload[destinationlength:destinationlength + headerslength])
+        body = payload[destinationlength + headerslength:]
+        if flags & JOURNAL_STR_BODY:
+            body = body.decode("utf-8")
+        return (position[0], end), destination, body, headers
+
+    def append(self, destination, body, headers=None):
+        flags = 0
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+            flags |= JOURNAL_STR_BODY
+        destination = destination.encode("utf-8")
+        headers = json.dumps(headers or {}).encode("utf-8")
+        meta = JOURNAL_RECORD.pack(0, 0, flags, len(destination), len(headers))[8:]
+        data = b"".join((meta, destination, headers, body))
+        size = 8 + len(data)
+        if size > self.segmentsize:
+            raise ValueError("Message of %d bytes larger than the outbox segments." % size)
+        record = struct.pack("<II", len(data) - len(meta), zlib.crc32(data)) + data
+        with self.condition:
+            if self.closed:
+                raise AMQSendError("Outbox journal closed.")
+            segment, offset = self.tail
+            if offset + size > self.segmentsize:
+                if (len(self.segments) + 1) * self.segmentsize > self.maxdisk:
+                    raise AMQOutboxFull("Outbox journal full (%d bytes)." % self.disk_usage())
+                segment, offset = segment + 1, 0
+                self.open_segment(segment)
+            self.segments[segment][offset:offset + size] = record
+            self.tail = (segment, offset + size)
+            self.count += 1
+            self.appended += 1
+            self.dirty.add(segment)
+            ticket = self.appended
+            if self.fsync == "always":
+                self.condition.notify_all()
+                while self.committed < ticket and not self.closed:
+                    self.condition.wait()
+
+    def truncate(self, position, count):
+        with self.lock:
+            self.head = position
+            self.count -= count
+
+    def depth(self):
+        return self.count
+
+    def disk_usage(self):
+        return len(self.segments) * self.segmentsize
+
+    def commit(self):
+        with self.lock:
+            ticket = self.appended
+            dirty = [self.segments[index] for index in self.dirty if index in self.segments]
+            self.dirty.clear()
+            head = self.head
+            removed = [index for index in self.segments if index < head[0]]
+            removedsegments = [self.segments.pop(index) for index in removed]
+        if self.fsync != "never":
+            for segment in dirty:
+                segment.flush()
+        if head != self.checkpointed:
+            path = os.path.join(self.directory, "checkpoint")
+            with open(path + ".tmp", "w") as file:
+                file.write("%d %d\n" % head)
+            os.replace(path + ".tmp", path)
+            self.checkpointed = head
+        for index, segment in zip(removed, removedsegments):
+            segment.close()
+            os.remove(self.segment_path(index))
+        with self.condition:
+            self.committed = ticket
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.closed:
+                    return
+                if self.fsync != "always" or self.committed == self.appended:
+                    self.condition.wait(self.interval)
+            try:
+                self.commit()
+            except Exception as e:
+                logger.error("#=- Outbox journal commit failed: %s", e, exc_info=True)
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.commit()
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments = {}
+
+
+class AMQOutbox():
+    """
+    AMQOutbox spools the sent messages to an AMQJournal and forwards them in order once connected.
+
+    The forwarder thread sends the journal records with a receipt header, at most window of them
+    unconfirmed, and truncates the journal when the broker confirms them. After a reconnection the
+    unconfirmed records are sent again: the delivery is at least once. Messages rejected by the
+    broker are logged, counted and dropped from the journal.
+
+    Args:
+        amqconn: The AMQ client sending the messages.
+        config (dict): Journal directory, segmentsize, fsync policy, commit interval, maxdisk and
+            window (see OUTBOX_DEFAULTS).
+
+    Methods:
+        send(destination, message, headers=None): Appends an encoded message to the journal.
+        forward(): Sends the next records.
+        receipt_received(receipt): Confirms a record. Returns False if the receipt is not an outbox one.
+        receipt_error(receipt, message): Drops a record rejected by the broker. Returns False if unknown.
+        depth(): Returns the number of unconfirmed messages.
+        stop(): Stops the forwarder and closes the journal.
+    """
+
+    def __init__(self, amqconn, config):
+        self.internal_conn = amqconn
+        self.config = dict(OUTBOX_DEFAULTS)
+        self.config.update(config)
+        self.journal = AMQJournal(self.config["directory"], self.config["segmentsize"], self.config["fsync"],
+                                  self.config["interval"], self.config["maxdisk"])
+        self.prefix = "%s-outbox-" % amqconn.module["name"]
+        self.receiptcounter = itertools.count(1)
+        self.lock = threading.Lock()
+        # receipt: [next position, confirmed]
+        self.inflight = collections.OrderedDict()
+        self.cursor = self.journal.head
+        self.connection = None
+        self.forwarded = 0
+        self.rejected = 0
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="amq-outbox", daemon=True)
+        self.thread.start()
+
+    def send(self, destination, message, headers=None):
+        self.journal.append(destination, message, headers)
+        self.wakeup.set()
+
+    def forward(self):
+        conn = self.internal_conn
+        if not conn.connected or conn.conn is None:
+            return
+        while not self.stopped.is_set():
+            with self.lock:
+                if self.connection != conn.connections:
+                    # The receipts of the previous connection are lost, the records are sent again.
+                    self.connection = conn.connections
+                    self.inflight.clear()
+                    self.cursor = self.journal.head
+                if len(self.inflight) >= self.config["window"]:
+                    return
+                record = self.journal.read(self.cursor)
+                if record is None:
+                    return
+                position, destination, body, headers = record
+                receipt = "%s%d" % (self.prefix, next(self.receiptcounter))
+                headers["receipt"] = receipt
+                self.inflight[receipt] = [position, False]
+                self.cursor = position
+            # Not under the lock: the receiver thread confirms the receipts meanwhile.
+            try:
+                conn.conn.send(body=body, destination=destination, headers=headers)
+            except Exception as e:
+                logger.error("#=- Unable to forward the outbox: %s", e)
+                conn.start_reconnect()
+                return
+
+    def confirm(self, receipt):
+        with self.lock:
+            entry = self.inflight.get(receipt)
+            if entry is None:
+                return
+            entry[1] = True
+            position = None
+            count = 0
+            while self.inflight and next(iter(self.inflight.values()))[1]:
+                position = self.inflight.popitem(last=False)[1][0]
+                count += 1
+            if count > 0:
+                self.forwarded += count
+                self.journal.truncate(position, count)
+        self.wakeup.set()
+
+    def receipt_received(self, receipt):
+        if receipt is None or not receipt.startswith(self.prefix):
+            return False
+        self.confirm(receipt)
+        return True
+
+    def receipt_error(self, receipt, message):
+        if receipt is None or not receipt.startswith(self.prefix):
+            return False
+        logger.error("#=- Outbox message rejected by the broker: %s", message)
+        self.rejected += 1
+        self.confirm(receipt)
+        return True
+
+    def depth(self):
+        return self.journal.depth()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(0.1)
+            self.wakeup.clear()
+            try:
+                self.forward()
+            except Exception as e:
+                logger.error("#=- Outbox forwarder failed: %s", e, exc_info=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+        self.journal.close()
+
+
+##################################################################################
+# AMQ Deduplicator
+##################################################################################
+
+DEDUP_DEFAULTS = {"header": "message-id", "mode": "lru", "size": 100000, "window": 0, "errorrate": 0.001}
+
+
+class AMQBloomFilter():
+    """
+    AMQBloomFilter is a fixed size Bloom filter sized for capacity keys with a false positive
+    rate of errorrate.
+
+    Methods:
+        add(key): Adds a key.
+        __contains__(key): Returns True if the key was probably added, False if it was not.
+    """
+
+    def __init__(self, capacity, errorrate=0.001):
+        self.bits = max(8, int(-capacity * math.log(errorrate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + index * second) % self.bits for index in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        array = self.array
+        return all(array[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class AMQDeduplicator():
+    """
+    AMQDeduplicator remembers the keys (message-id or another header) of the handled messages so that
+    their redeliveries are acknowledged without calling the callback again.
+
+    Keys are only remembered once their message reached the ack step: a message whose callback failed
+    and that the broker redelivers is not a duplicate. The memory is bounded by size:
+        lru: the size most recently handled keys, optionally forgotten after window seconds. Exact.
+        bloom: two rotating Bloom filters of size keys each (the last size to 2 * size keys), with
+            errorrate false positives, that is messages wrongly skipped. Uses a few bytes per key.
+
+    Args:
+        config (dict): header, mode, size, window and errorrate (see DEDUP_DEFAULTS).
+
+    Attributes:
+        hits (int): Number of duplicates detected.
+        misses (int): Number of new keys checked.
+        evictions (int): Number of keys forgotten because of the size or the window.
+
+    Methods:
+        key(headers): Returns the key of a message, None if it has no key header.
+        seen(key): Returns True if a key was handled.
+        add(key): Remembers a handled key.
+        entries(): Returns the number of remembered keys.
+        stats(): Returns the statistics for the lifesign.
+    """
+
+    def __init__(self, config):
+        self.config = dict(DEDUP_DEFAULTS)
+        self.config.update(config)
+        if self.config["mode"] not in ("lru", "bloom"):
+            raise ValueError("Invalid dedup mode %r" % (self.config["mode"],))
+        self.header = self.config["header"]
+        self.size = int(self.config["size"])
+        self.window = self.config["window"]
+        self.lock = threading.Lock()
+        self.keys = collections.OrderedDict()
+        self.current = self.previous = None
+        if self.config["mode"] == "bloom":
+            self.current = AMQBloomFilter(self.size, self.config["errorrate"])
+            self.previous = AMQBloomFilter(self.size, self.config["errorrate"])
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, headers):
+        return headers.get(self.header)
+
+    def seen(self, key):
+        with self.lock:
+            if self.current is not None:
+                found = key in self.current or key in self.previous
+            else:
+                added = self.keys.get(key)
+                found = added is not None and (not self.window or time.monotonic() - added < self.window)
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found
+
+    def add(self, key):
+        with self.lock:
+            if self.current is not None:
+                if self.current.count >= self.size:
+                    self.evictions += self.previous.count
+                    self.previous = self.current
+                    self.current = AMQBloomFilter(self.size, self.config["errorrate"])
+                self.current.add(key)
+                return
+            now = time.monotonic()
+            keys = self.keys
+            keys[key] = now
+            keys.move_to_end(key)
+            while len(keys) > self.size:
+                keys.popitem(last=False)
+                self.evictions += 1
+            if self.window:
+                while keys and now - next(iter(keys.values())) >= self.window:
+                    keys.popitem(last=False)
+                    self.evictions += 1
+
+    def entries(self):
+        if self.current is not None:
+            return self.current.count + self.previous.count
+        return len(self.keys)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": self.entries()}
+
+
+##################################################################################
+# AMQ Router
+##################################################################################
+
+def split_destination(destination):
+    """
+    Splits a destination into its type prefix and its dot separated elements:
+    /topic/PRICE.STOCK gives ["/topic", "PRICE", "STOCK"].
+    """
+    prefix, _, name = destination.rpartition("/")
+    return [prefix] + name.split(".")
+
+
+class AMQRouter():
+    """
+    AMQRouter dispatches the received messages to handlers by destination and header values.
+
+    A route has a destination pattern (ActiveMQ wildcards: * for one element, > for all the
+    remaining ones) and optional header conditions, each one a value or a callable(value)
+    returning True when the header matches. The patterns are compiled into a trie; the routes of
+    each destination are cached in a table indexed by the first header value condition of the
+    routes, so that a message only checks the routes that can match it, whatever the number of
+    routes. The first matching route in registration order handles the message, like an if/elif
+    chain. The messages matching no route go to the default callback.
+
+    Args:
+        default (callable, optional): Callback of the messages matching no route.
+
+    Attributes:
+        hits (dict): Number of messages handled per route name.
+        unrouted (int): Number of messages matching no route.
+
+    Methods:
+        add(pattern, handler, headers=None, name=None): Registers a route and returns its name.
+        remove(name): Removes a route. Returns False if unknown.
+        table(destination): Returns the (indexed, unindexed) routes of a destination.
+        match(destination, headers): Returns the route handling a message, or None.
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+        self.trie = {"children": {}, "routes": []}
+        self.routes = {}
+        self.tables = {}
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.unrouted = 0
+
+    def add(self, pattern, handler, headers=None, name=None):
+        conditions = {}
+        for header, condition in (headers or {}).items():
+            conditions[header] = condition if callable(condition) else str(condition)
+        if name is None:
+            name = pattern + "".join("[%s=%s]" % (header, condition if not callable(condition) else "?")
+                                     for header, condition in sorted(conditions.items()))
+        keys = sorted(header for header, condition in conditions.items() if not callable(condition))
+        route = {"order": next(self.order), "name": name, "pattern": pattern, "handler": handler,
+                 "headers": conditions, "key": (keys[0], conditions[keys[0]]) if keys else None}
+        with self.lock:
+            if name in self.routes:
+                raise ValueError("Route %r already registered" % (name,))
+            node = self.trie
+            for element in split_destination(pattern):
+                node = node["children"].setdefault(element, {"children": {}, "routes": []})
+            node["routes"].append(route)
+            self.routes[name] = route
+            self.hits[name] = 0
+            self.tables = {}
+        return name
+
+    def remove(self, name):
+        with self.lock:
+            route = self.routes.pop(name, None)
+            if route is None:
+                return False
+            node = self.trie
+            for element in split_destination(route["pattern"]):
+                node = node["children"][element]
+            node["routes"].remove(route)
+            self.hits.pop(name, None)
+            self.tables = {}
+        return True
+
+    def collect(self, node, elements, index, routes):
+        children = node["children"]
+        if ">" in children:
+            routes.extend(children[">"]["routes"])
+        if index == len(elements):
+            routes.extend(node["routes"])
+            return
+        if elements[index] in children:
+            self.collect(children[elements[index]], elements, index + 1, routes)
+        if "*" in children:
+            self.collect(children["*"], elements, index + 1, routes)
+
+    def table(self, destination):
+        table = self.tables.get(destination)
+        if table is None:
+            routes = []
+            with self.lock:
+                self.collect(self.trie, split_destination(destination), 0, routes)
+                routes.sort(key=lambda route: route["order"])
+                indexed = {}
+                unindexed = []
+                for route in routes:
+                    if route["key"] is None:
+                        unindexed.append(route)
+                    else:
+                        indexed.setdefault(route["key"][0], {}).setdefault(route["key"][1], []).append(route)
+                table = (indexed, unindexed)
+                if len(self.tables) >= 10000:
+                    self.tables = {}
+                self.tables[destination] = table
+        return table
+
+    def match(self, destination, headers):
+        indexed, unindexed = self.table(destination)
+        best = None
+        for header, values in indexed.items():
+            for route in values.get(headers.get(header), ()):
+                if best is not None and route["order"] > best["order"]:
+                    break
+                if self.accepts(route, headers):
+                    best = route
+                    break
+        for route in unindexed:
+            if best is not None and route["order"] > best["order"]:
+                break
+            if self.accepts(route, headers):
+                best = route
+                break
+        return best
+
+    def accepts(self, route, headers):
+        for header, condition in route["headers"].items():
+            value = headers.get(header)
+            if callable(condition):
+                if not condition(value):
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    def __call__(self, destination, message, headers):
+        route = self.match(destination, headers)
+        if route is None:
+            with self.lock:
+                self.unrouted += 1
+            if self.default is not None:
+                return self.default(destination, message, headers)
+            logger.debug("#=- No route for %s.", destination)
+            return None
+        with self.lock:
+            if route["name"] in self.hits:
+                self.hits[route["name"]] += 1
+        return route["handler"](destination, message, headers)
+
+
+##################################################################################
+# AMQ Listener
+##################################################################################
+
+class AMQListener(stomp.ConnectionListener):
+    """
+    AMQListener is a listener class for handling STOMP protocol events in a message queue client.
+
+    Args:
+        amqconn: The AMQ connection object, used for acknowledging messages and handling errors.
+        callback: A callable to process received messages. It should accept (destination, message, headers).
+
+    Attributes:
+        internal_conn: Reference to the AMQ connection object.
+        callback: The message processing callback function.
+        globalerrors: Counter for global errors encountered.
+        errors: Counter for errors received via the on_error handler.
+        globalmessages: Counter for total messages received.
+        received: Dictionary tracking the number of messages received per destination.
+        inprogress: Number of callbacks running in the receiver thread.
+        drained: Number of messages left to the broker for redelivery during a shutdown.
+        expected: True once the connection is closed on purpose, by the client or by the broker after
+            an ERROR frame. The endpoint is then not marked as failed.
+        states: Ack mode, early ack and generation per subscription id, cached until the subscriptions change.
+
+    Methods:
+        on_error(frame):
+            Handles error frames received from the STOMP server. Logs the error, increments error counters, and notifies the connection, which reconnects or shuts down depending on the error.
+        on_receipt(frame):
+            Resolves the confirmed send matching the receipt.
+        on_heartbeat_timeout():
+            Handles heartbeat timeout events. Logs a warning and notifies the connection.
+        on_disconnected():
+            Notifies the connection when the socket of the current connection is unexpectedly lost.
+        subscription_state(subscription_id):
+            Computes and caches the state of a subscription. Returns None if it was removed.
+        duplicate_received(subscription_id, headers, mustack, generation):
+            Acknowledges a duplicate in order with the other messages of its subscription, on receipt
+            with early ack.
+        acknowledge(headers, generation):
+            Acknowledges a message unless its subscription changed.
+        on_message(frame):
+            Handles incoming messages. Replies of the requests are handed to the client. Optionally acknowledges early, logs and tracks message statistics and hands the message to process_message, on the dispatcher when one is configured, or to the message batcher in batch mode.
+        process_message(destination, message, headers, mustack, generation, receivedtime=None, attempt=1):
+            Invokes the callback, handles exceptions, and acknowledges the message if not early ack.
+            Failed messages are retried or dead lettered when the subscription has a retry policy.
+            Unacknowledged messages of a replaced connection or subscription (see AMQClient.generation)
+            are dropped, as the broker redelivers them.
+    """
+
+    def __init__(self, amqconn,  callback):
+        self.internal_conn = amqconn
+        self.callback = callback
+        self.globalerrors = 0
+        self.errors = 0
+        self.globalmessages = 0
+        self.received = {}
+        self.inprogress = 0
+        self.drained = 0
+        self.expected = False
+        # Resolved once per connection, on_message is the hot path.
+        self.debug = logger.isEnabledFor(logging.DEBUG)
+        if amqconn.messageview is not None:
+            self.decode = amqconn.message_view
+        else:
+            self.decode = None if amqconn.autodecode else amqconn.decode_message
+        self.states = {}
+
+    def on_error(self,  frame:stomp.utils.Frame):
+        logger.error('#=- Received an error "%s"' % frame)
+        self.errors += 1
+        # The broker closes the connection after an ERROR frame.
+        self.expected = True
+        if self.internal_conn.receipt_error(frame):
+            return
+        self.internal_conn.error_received(frame)
+
+    def on_receipt(self, frame:stomp.utils.Frame):
+        self.internal_conn.receipt_received(frame.headers.get("receipt-id"))
+
+    def on_heartbeat_timeout(self):
+        logger.warning("#=- HEART BEAT TIMEOUT ERROR")
+        self.internal_conn.heartbeat_timeout()
+
+    def on_disconnected(self):
+        if self.expected:
+            logger.debug("#=- Connection closed.")
+        elif self.internal_conn.listener is self and not self.internal_conn.closing:
+            logger.warning("#=- Disconnected from the broker.")
+            self.internal_conn.listener_disconnect()
+
+    def subscription_state(self, subscription_id):
+        conn = self.internal_conn
+        spec = conn.subscriptions.get(subscription_id)
+        if spec is None:
+            return None
+        mustack = spec["ack"] != "auto"
+        state = (mustack, mustack and conn.earlyack, (conn.connections, spec["generation"]))
+        self.states[subscription_id] = state
+        return state
+
+    def on_message(self,  frame:stomp.utils.Frame):
+        headers = frame.headers
+        subscription_id = headers.get("subscription")
+        conn = self.internal_conn
+        state = self.states.get(subscription_id)
+        if state is None:
+            if subscription_id is not None and subscription_id == conn.replysubscription:
+                conn.reply_received(frame.body, headers)
+                return
+            state = self.subscription_state(subscription_id)
+            if state is None:
+                # Unsubscribed while the message was in flight, the broker redelivers it.
+                logger.debug("#=- Message of a removed subscription (%s) dropped.", subscription_id)
+                return
+        mustack, earlyack, generation = state
+        if mustack and not earlyack and conn.draining:
+            # Shutting down: the broker redelivers the message to another consumer.
+            self.drained += 1
+            return
+        if conn.deduplicator is not None:
+            key = conn.deduplicator.key(headers)
+            if key is not None and conn.deduplicator.seen(key):
+                self.duplicate_received(subscription_id, headers, mustack, generation)
+                return
+        body = frame.body
+        message = body if self.decode is None else self.decode(body, headers)
+        if earlyack:
+            if self.debug:
+                logger.debug("Early ack")
+            conn.ack_message(headers)
+
+        destination = headers.get("destination", "NA")
+        if self.debug:
+            logger.debug("#=->>>> Message received (%s) PAYLOAD=%d", destination, len(body))
+
+        received = self.received
+        try:
+            received[destination] += 1
+        except KeyError:
+            received[destination] = 1
+        self.globalmessages += 1
+
+        receivedtime = None
+        metrics = conn.metrics
+        if metrics is not None:
+            receivedtime = time.monotonic()
+            metrics.observe_received(destination, len(body))
+
+        if conn.flowcontroller is not None:
+            conn.flowcontroller.message_received(subscription_id)
+
+        if conn.batcher is not None:
+            conn.batcher.add(subscription_id, destination, message, headers, mustack and not earlyack)
+            return
+
+        dispatcher = conn.dispatcher
+        if dispatcher is not None:
+            dispatcher.submit(subscription_id, self.process_message, destination, message, headers,
+                              mustack, generation, receivedtime)
+        else:
+            self.process_message(destination, message, headers, mustack, generation, receivedtime)
+
+    def duplicate_received(self, subscription_id, headers, mustack, generation):
+        if self.debug:
+            logger.debug("#=- Duplicate %s skipped.", headers.get("message-id"))
+        conn = self.internal_conn
+        if mustack and conn.earlyack:
+            # Acknowledged on receipt, as the other messages of the subscription.
+            conn.ack_message(headers)
+        elif conn.batcher is not None:
+            conn.batcher.add(subscription_id, headers.get("destination", "NA"), None, headers, mustack, True)
+        elif not mustack:
+            return
+        elif conn.dispatcher is not None:
+            # Behind the queued messages of the subscription, the client acks are cumulative.
+            conn.dispatcher.submit(subscription_id, self.acknowledge, headers, generation)
+        else:
+            self.acknowledge(headers, generation)
+
+    def acknowledge(self, headers, generation):
+        conn = self.internal_conn
+        if generation == conn.generation(headers.get("subscription")):
+            conn.ack_message(headers)
+
+    def process_message(self, destination, message, headers, mustack, generation, receivedtime=None, attempt=1):
+        conn = self.internal_conn
+        subscription_id = headers.get("subscription")
+        mustack = mustack and not conn.earlyack
+        if mustack and generation != conn.generation(subscription_id) and not is_topic(destination):
+            # The subscription was replaced while the message was queued, the broker redelivers it.
+            # Topics do not: their messages are handled, without an ack.
+            logger.debug("#=- Subscription changed. Message dropped.")
+            if conn.flowcontroller is not None:
+                conn.flowcontroller.message_dropped(subscription_id)
+            return
+        callbackstart = time.monotonic() if conn.metrics is not None or conn.flowcontroller is not None else 0.0
+        retrying = False
+        self.inprogress += 1
+        try:
+            if self.callback is not None:
+                if conn.dispatcher is not None:
+                    conn.dispatcher.call(self.callback, destination, message, headers)
+                else:
+                    self.callback(destination, message, headers)
+            else:
+                logger.warning("#=- No call back defined")
+
+        except Exception as e:
+            self.globalerrors += 1
+
+            logger.error(f"ERROR:{e}", exc_info=True)
+            err = sys.exc_info()
+            errstr = str(err[0]) + str(err[1]) + str(err[2])
+            logger.error(f"ERROR:{errstr}" )
+            if conn.retrier is not None:
+                retrying = conn.retrier.failed(destination, message, headers, e, attempt, generation, mustack)
+        finally:
+            self.inprogress -= 1
+
+        metrics = conn.metrics
+        if metrics is not None or conn.flowcontroller is not None:
+            callbackduration = time.monotonic() - callbackstart
+            if metrics is not None:
+                metrics.observe_callback(destination, callbackduration)
+            if conn.flowcontroller is not None:
+                conn.flowcontroller.message_handled(subscription_id, callbackduration)
+
+        if retrying:
+            return
+        if attempt > 1:
+            conn.retrier.succeeded(headers)
+        if conn.deduplicator is not None:
+            key = conn.deduplicator.key(headers)
+            if key is not None:
+                conn.deduplicator.add(key)
+        if mustack:
+            if generation == conn.generation(subscription_id):
+                conn.ack_message(headers)
+                if metrics is not None and receivedtime is not None:
+                    metrics.observe_ack(destination, time.monotonic() - receivedtime)
+            else:
+                logger.debug("#=- Connection changed. Message not acknowledged.")
+        if self.debug:
+            logger.debug("#=-<<<< Message handled")
+
+
+class AMQClient():
+    """
+    AMQClient is a client for connecting to an AMQ (ActiveMQ) server using the STOMP protocol.
+    This class manages the connection lifecycle, subscriptions, message sending, and heartbeat monitoring.
+    It supports automatic reconnection, error handling, and sending periodic life sign messages.
+    Args:
+        server (dict): Server connection parameters (ip, port, login, password, etc.).
+        module (dict): Module information (name, version, lifesign queue, etc.).
+        subscription (list): List of subscription destinations (queues/topics). Each entry is either
+            a destination string or a subscription spec dictionary (see parse_subscription).
+        callback (callable, optional): Callback function for message handling, or an AMQRouter.
+        heart_beat_receive_scale (float, optional): Heartbeat receive scale factor. Default is 2.0.
+        listener_class (type, optional): Listener class to handle incoming messages. Default is AMQListener.
+        metrics (AMQMetrics, optional): Metrics shared with other clients. By default the client creates
+            its own when the server dictionary contains a "metrics" entry (see create_metrics).
+        batch_callback (callable, optional): Callback receiving the messages in batches,
+            batch_callback(destination, messages, headers). Replaces callback when set.
+    Attributes:
+        starttime (datetime): Timestamp when the client was started.
+        heart_beat_receive_scale (float): Heartbeat receive scale factor.
+        listener_class (type): Listener class used for message handling.
+        conn (stomp.Connection): STOMP connection object.
+        sent (dict): Counter of sent messages per destination.
+        debug (bool): True if debug logging was enabled when the connection was created.
+        subscription (list): List of subscription destinations given to the constructor.
+        subscriptions (dict): Normalized subscription specs keyed by subscription id. The ids are never
+            reused, the reconnections subscribe the current set.
+        callback (callable): Callback function for message handling.
+        server (dict): Server connection parameters.
+        module (dict): Module information.
+        heartbeaterrors (int): Number of heartbeat errors encountered.
+        connections (int): Number of connection attempts.
+        earlyack (bool): Whether early acknowledgment is enabled.
+        ackbatcher (AMQAckBatcher): Groups the acks of client ack subscriptions when the server
+            dictionary contains an "ackbatch" entry ({"size": messages, "interval": milliseconds}).
+        dispatcher (AMQDispatcher): Runs the callbacks in a worker pool when the server dictionary
+            contains a "dispatcher" entry ({"workers": 4, "queue": 100, "mode": "thread"}).
+        retrier (AMQRetrier): Retries the failed messages and forwards them to a dead letter queue,
+            configured by the "retry" server entry and the "retry" key of the subscription specs
+            (see RETRY_DEFAULTS).
+        flowcontroller (AMQFlowController): Adapts the prefetch of the subscriptions to the callback
+            latency and pauses them when the client falls behind, configured by the "flowcontrol" server
+            entry (see FLOWCONTROL_DEFAULTS).
+        batcher (AMQMessageBatcher): Collects the messages for the batch callback, configured by the
+            "batch" server entry ({"size": messages, "interval": milliseconds}). The prefetch of the
+            subscriptions is raised to the batch size.
+        reconnect (dict): Reconnection backoff (initial and max delays in seconds, factor, jitter
+            ratio and maximum attempts, 0 meaning forever), overridden by the "reconnect" server entry.
+        connected (bool): False while the reconnect supervisor is running.
+        draining (bool): True during a shutdown. Received messages that need an ack are left to the broker.
+        recoverederrors (int): Number of recoverable ERROR frames.
+        sendbuffer (deque): Messages sent while disconnected, replayed once reconnected. Its size
+            is set by the "sendbuffer" server entry (10000 by default).
+        dropped (int): Number of buffered messages dropped because the buffer was full.
+        codec (tuple): Default codec of the messages ("codec" server entry, see parse_codec).
+        codecs (dict): Codecs per destination, from the "codecs" server entry and the "codec" key of the
+            subscription specs.
+        autodecode (bool): Whether stomp.py decodes the bodies, True when every codec is text and the
+            message views are disabled.
+        messageview (dict): When the "messageview" server entry is set (True or {"maxsize": bytes,
+            "oversize": "reject" or "stream"}), the callbacks receive AMQMessage views decoded on demand
+            instead of the decoded bodies.
+        metrics (AMQMetrics): Throughput and latency statistics, None when disabled.
+        lifesigner (AMQLifeSigner): Sends the lifesigns in the background when the module dictionary
+            contains a "lifesigninterval" entry.
+        endpoints (list): Broker (ip, port) endpoints (see parse_endpoints).
+        endpoint (tuple): Endpoint of the current connection.
+        unhealthy (dict): Time of the last failure of each endpoint. Failed endpoints are tried last
+            during "failoverpenalty" seconds (30 by default).
+        latencies (dict): Last probed connect time of each endpoint.
+        receipts (dict): Confirmed sends waiting for their RECEIPT, keyed by receipt id.
+        requests (dict): Requests waiting for their reply, keyed by correlation id.
+        replyqueue (str): Temporary queue receiving the replies, subscribed by the first request.
+        timerwheel (AMQTimerWheel): Runs the request timeouts and the delayed retries, created when needed.
+        window (BoundedSemaphore): Limits the number of unconfirmed sends ("confirmwindow" server
+            entry, 100 by default).
+        deduplicator (AMQDeduplicator): Acknowledges the redeliveries of the handled messages without calling
+            the callback, configured by the "dedup" server entry (see DEDUP_DEFAULTS).
+        router (AMQRouter): Dispatches the messages to the handlers registered with route, the callback
+            receiving the messages matching no route. None until the first route is added.
+        outbox (AMQOutbox): Spools send_message, send_encoded and send_many to a memory-mapped journal
+            forwarded in order once connected, configured by the "outbox" server entry (see OUTBOX_DEFAULTS).
+        listener (AMQListener): Listener instance for handling messages.
+    Methods:
+        disconnect(timeout=None): Disconnects from the AMQ server. Waits at most timeout seconds
+            ("shutdowntimeout" server entry by default) for the running callbacks, the queued messages
+            are abandoned to the broker.
+        create_connection(): Establishes a new connection and subscribes to destinations.
+        rank_endpoints(): Probes the connect latency of the endpoints ("probetimeout" server entry) and
+            returns them fastest healthy first.
+        subscribe(destination, **options): Subscribes to a destination at runtime (options are the keys of
+            the subscription specs, see parse_subscription) and returns the subscription id. Returns the
+            existing id if the destination is already subscribed with the same selector.
+        unsubscribe(destination): Removes the subscriptions of a destination, or a subscription id, and
+            returns the number of removed subscriptions.
+        register_subscription(spec): Assigns the next id to a normalized spec and registers it.
+        remove_subscription(subscription_id): Unsubscribes and forgets a subscription.
+        subscribe_spec(spec): Sends the SUBSCRIBE frame of a normalized subscription spec.
+        generation(subscription_id): Returns the connection and subscription generation. Messages are only
+            acknowledged if it did not change since they were received.
+        resubscribe(subscription_id, prefetch): Replaces a subscription with a new prefetch.
+        pause_subscription(subscription_id): Unsubscribes until resume_subscription is called.
+        resume_subscription(subscription_id): Subscribes again a paused subscription.
+        ack_mode(subscription_id): Returns the ack mode of a subscription.
+        route(pattern, handler, headers=None, name=None): Sends the messages of the destinations matching
+            pattern (ActiveMQ wildcards) whose headers match the header conditions to handler, and returns
+            the route name. The first matching route handles the message (see AMQRouter). Raises a
+            ValueError with a batch callback or a process dispatcher.
+        unroute(name): Removes a route.
+        ack_message(headers): Acknowledges a message, through the ack batcher when enabled.
+        send_life_sign(variables=None): Sends a life sign message to the configured queue.
+        generate_life_sign(): Generates a dictionary with life sign information.
+        encode_message(destination, message, headers=None): Encodes a message with the codec of its destination.
+        decode_message(body, headers): Decodes a received body with the codec of its subscription.
+        message_view(body, headers): Returns the AMQMessage view of a received body.
+        send_message(destination, message, headers=None): Sends a message to a destination.
+        send_encoded(destination, message, headers=None): Sends a message already encoded by encode_message.
+        send_batch(destination, messages, headers=None, transaction=False): Sends many messages to a destination.
+        send_many(messages, transaction=False): Sends a list of (destination, message, headers) tuples in a
+            single socket write, optionally wrapped in a STOMP transaction. Transactions raise a ValueError
+            with the outbox, which forwards the messages one by one.
+        write_frames(data): Writes already encoded frames on the connection.
+        request(destination, message, timeout=30, headers=None): Sends a request with reply-to and correlation-id
+            headers and returns a concurrent.futures.Future resolved with the (message, headers) of the reply,
+            or failed with a TimeoutError after timeout seconds.
+        reply(headers, message, replyheaders=None): Answers a request received by the callback.
+        timer_wheel(): Returns the timer wheel of the client.
+        send_confirmed(destination, message, headers=None, timeout=None): Sends a message with a receipt
+            header and returns a concurrent.futures.Future resolved when the broker confirms it.
+            Blocks while the confirm window is full. Unconfirmed messages are resent after a reconnect.
+        receipt_received(receipt): Resolves a confirmed send.
+        receipt_error(frame): Fails the confirmed send an ERROR frame refers to. Returns False if none.
+        fail_confirmed(reason): Fails all the unconfirmed sends.
+        buffer_message(destination, message, headers): Buffers a message until the connection is back.
+        replay_buffer(): Resends the unconfirmed messages, sends the buffered messages in order and marks
+            the client as connected.
+        heartbeat_timeout(): Handles heartbeat timeout events and triggers reconnection.
+        endpoint_failed(): Marks the current endpoint as unhealthy so that the next connection fails over.
+        error_received(frame): Reconnects after a recoverable ERROR frame, calls general_error otherwise
+            (see classify_error and the "fatalerrors" server entry, extra regular expressions). During a
+            shutdown, the errors never start another one: a fatal error only stops the reconnections.
+        general_error(): Handles unrecoverable errors: shuts down within "shutdowntimeout" seconds (5 by
+            default) and exits the process, unless the "exitonerror" server entry is False.
+        shutdown(timeout=30): Stops the consumption, lets the in-flight messages be handled and acknowledged,
+            flushes the buffered and unconfirmed sends and disconnects, within timeout seconds. Returns True
+            if everything was drained in time.
+        listener_disconnect(): Handles listener disconnect events and triggers reconnection.
+        start_reconnect(): Starts the reconnect supervisor thread unless it is already running.
+        reconnect_and_listen(): Reconnects with exponential backoff, then replays the buffered messages.
+    """
+
+    def __init__(self, server, module, subscription, callback=None,heart_beat_receive_scale=2.0,
+                 listener_class=AMQListener, metrics=None, batch_callback=None):
+        
+        logger.debug("#=-" * 20)
+        logger.debug("#=- Starting AMQ Connection%s", amqclientversion)
+        logger.debug("#=-" * 20)
+        logger.debug("#=- Module       :%s", module["name"])
+        logger.debug("#=- Brokers      :%s", parse_endpoints(server))
+        logger.debug("#=- Login        :%s", server["login"])
+        logger.debug("#=- Password     :%s", "*" * len(server["password"]))
+        logger.debug("#=- Subscription :%s", subscription)
+        logger.debug("#=- Beat         :%s", heart_beat_receive_scale)
+        logger.debug("#=- Listener     :%s", listener_class)
+        
+        self.starttime = datetime.datetime.now()
+        self.heart_beat_receive_scale=heart_beat_receive_scale
+        self.listener_class = listener_class
+
+        self.conn = None
+        self.debug = logger.isEnabledFor(logging.DEBUG)
+        self.sent = {}
+        self.subscription = subscription
+        self.callback = callback
+        self.router = callback if isinstance(callback, AMQRouter) else None
+        self.server = server
+        self.module = module
+        self.heartbeaterrors = 0
+        self.connections = 0
+        self.earlyack=False
+
+        if "earlyack" in server:
+            logger.info("Early ack set to true.")
+            self.earlyack=server["earlyack"]
+
+        self.subscriptions = {}
+        self.subscriptionlock = threading.RLock()
+        self.subscriptionids = itertools.count(1)
+        self.subscribed = False
+
+        self.batcher = None
+        if batch_callback is not None:
+            batch = server.get("batch", {})
+            self.batcher = AMQMessageBatcher(self, batch_callback, batch.get("size", 100), batch.get("interval", 1000))
+
+        self.dispatcher = None
+        if "dispatcher" in server:
+            dispatcher = server["dispatcher"]
+            if dispatcher.get("mode") == "process" and server.get("messageview"):
+                raise ValueError("Message views cannot be sent to process workers, use the thread dispatcher mode.")
+            if dispatcher.get("mode") == "process" and self.router is not None:
+                raise ValueError("Routers cannot be sent to process workers, use the thread dispatcher mode.")
+            self.dispatcher = AMQDispatcher(dispatcher.get("workers", 4), dispatcher.get("queue", 100),
+                                            dispatcher.get("mode", "thread"))
+
+        self.reconnect = dict(RECONNECT_DEFAULTS)
+        self.reconnect.update(server.get("reconnect", {}))
+        self.reconnectlock = threading.Lock()
+        self.reconnectthread = None
+        self.closing = False
+        self.draining = False
+        self.connected = False
+        self.recoverederrors = 0
+        self.fatalerrors = list(FATAL_ERRORS) + list(server.get("fatalerrors", []))
+        self.shutdowntimeout = server.get("shutdowntimeout", 5)
+        self.exitonerror = server.get("exitonerror", True)
+        self.sendlock = threading.Lock()
+        self.sendbuffer = collections.deque(maxlen=server.get("sendbuffer", 10000))
+        self.dropped = 0
+        self.receipts = {}
+        self.receiptlock = threading.Lock()
+        self.receiptcounter = itertools.count(1)
+        self.window = threading.BoundedSemaphore(server.get("confirmwindow", 100))
+        self.requests = {}
+        self.requestlock = threading.Lock()
+        self.requestcounter = itertools.count(1)
+        self.requesttimeouts = 0
+        self.replyqueue = None
+        self.replysubscription = None
+        self.timerwheel = None
+
+        self.ownmetrics = metrics is None
+        self.metrics = create_metrics(server) if metrics is None else metrics
+
+        self.codec = parse_codec(server.get("codec"))
+        self.codecs = {}
+        for destination, codec in server.get("codecs", {}).items():
+            self.codecs[destination] = parse_codec(codec)
+        self.subscriptioncodecs = {}
+
+        self.endpoints = parse_endpoints(server)
+        self.endpoint = None
+        self.unhealthy = {}
+        self.latencies = {}
+        self.failoverpenalty = server.get("failoverpenalty", 30)
+        self.probetimeout = server.get("probetimeout", 1.0)
+
+        self.ackbatcher = None
+        if "ackbatch" in server:
+            ackbatch = server["ackbatch"]
+            self.ackbatcher = AMQAckBatcher(self, ackbatch.get("size", 100), ackbatch.get("interval", 1000))
+
+        self.retrier = None
+        if "retry" in server:
+            self.retrier = AMQRetrier(self, server["retry"])
+
+        for sub in subscription:
+            spec = parse_subscription(sub, server.get("prefetch", 1))
+            if spec is not None:
+                self.register_subscription(spec)
+        # stomp.py only decodes the bodies when all the messages are plain text
+        self.messageview = None
+        if server.get("messageview"):
+            self.messageview = dict(MESSAGEVIEW_DEFAULTS)
+            if isinstance(server["messageview"], dict):
+                self.messageview.update(server["messageview"])
+            if self.messageview["oversize"] not in ("reject", "stream"):
+                raise ValueError("Invalid oversize policy %r" % (self.messageview["oversize"],))
+        # The message views decode the bodies themselves.
+        self.autodecode = self.messageview is None and all(codec == ("text", None)
+                                                           for codec in [self.codec] + list(self.codecs.values()))
+
+        self.flowcontroller = None
+        if "flowcontrol" in server:
+            self.flowcontroller = AMQFlowController(self, server["flowcontrol"])
+
+        self.outbox = None
+        if "outbox" in server:
+            self.outbox = AMQOutbox(self, server["outbox"])
+
+        self.deduplicator = None
+        if "dedup" in server:
+            self.deduplicator = AMQDeduplicator(server["dedup"])
+
+        logger.debug("#=- Subscription :%s", subscription)
+        logger.debug("#=- Early Ack    :%s", self.earlyack)
+        logger.debug("#=-" * 20)
+        
+        self.create_connection()
+        self.connected = True
+
+        self.lifesigner = None
+        if "lifesign" in module and "lifesigninterval" in module:
+            self.lifesigner = AMQLifeSigner(self, module["lifesigninterval"], module.get("lifesignfull", 12),
+                                            module.get("lifesigntop", 10))
+
+    def disconnect(self, timeout=None):
+        logger.info("#=- Disconnecting...")
+        self.closing = True
+        if self.lifesigner is not None:
+            self.lifesigner.stop()
+        if self.flowcontroller is not None:
+            self.flowcontroller.stop()
+        if self.timerwheel is not None:
+            self.timerwheel.stop()
+        if self.batcher is not None:
+            self.batcher.stop()
+        if self.dispatcher is not None:
+            self.dispatcher.stop(self.shutdowntimeout if timeout is None else timeout)
+        if self.ackbatcher is not None:
+            self.ackbatcher.stop()
+        if self.outbox is not None:
+            # The unconfirmed messages stay in the journal.
+            self.outbox.stop()
+        try:
+            self.conn.disconnect()
+        except Exception as e:
+            logger.debug("#=- Unable to send DISCONNECT: %s", e)
+        self.fail_confirmed("Client disconnected.")
+        self.fail_requests("Client disconnected.")
+        if self.metrics is not None and self.ownmetrics:
+            self.metrics.stop_http_server()
+
+    def shutdown(self, timeout=30):
+        logger.info("#=- Shutting down within %.1fs...", timeout)
+        deadline = time.monotonic() + timeout
+
+        def remaining():
+            return max(0.0, deadline - time.monotonic())
+
+        def wait_until(predicate):
+            while not predicate() and remaining() > 0:
+                time.sleep(0.01)
+            return predicate()
+
+        self.draining = True
+        if self.lifesigner is not None:
+            self.lifesigner.stop()
+        if self.flowcontroller is not None:
+            self.flowcontroller.stop()
+        # Auto ack messages are acknowledged on delivery: stop them first. The acks of the other
+        # subscriptions need their subscription, they are unsubscribed by the DISCONNECT.
+        for spec in list(self.subscriptions.values()):
+            if spec["ack"] == "auto" and not spec["paused"] and self.connected:
+                try:
+                    self.conn.unsubscribe(id=spec["id"])
+                except Exception as e:
+                    logger.debug("#=- Unable to unsubscribe %s: %s", spec["destination"], e)
+
+        if self.batcher is not None:
+            self.batcher.stop()
+        drained = True
+        if self.dispatcher is not None:
+            self.dispatcher.stop(remaining())
+            drained = self.dispatcher.depth() == 0
+        drained = wait_until(lambda: self.listener.inprogress <= 0) and drained
+        if self.ackbatcher is not None:
+            self.ackbatcher.stop()
+        if not self.closing:
+            # The reconnect supervisor replays the buffered and unconfirmed sends.
+            drained = wait_until(lambda: self.connected and len(self.sendbuffer) == 0 and len(self.receipts) == 0
+                                 and (self.outbox is None or self.outbox.depth() == 0)) and drained
+        else:
+            drained = drained and len(self.sendbuffer) == 0 and len(self.receipts) == 0
+        if not drained:
+            logger.warning("#=- Shutdown deadline reached: %d buffered, %d unconfirmed, %d queued.",
+                           len(self.sendbuffer), len(self.receipts),
+                           self.dispatcher.depth() if self.dispatcher is not None else 0)
+        self.disconnect()
+        logger.info("#=- Shutdown complete (%d messages left to the broker).", self.listener.drained)
+        return drained
+
+    def create_connection(self):
+        logger.info("#=- Creating connection.")
+        heartbeats = (10000, 20000)
+
+        if "heartbeats" in self.server:
+            heartbeats = self.server["heartbeats"]
+
+        lasterror = None
+        for endpoint in self.rank_endpoints():
+            self.conn = stomp.Connection(
+                [endpoint], heartbeats=heartbeats,heart_beat_receive_scale=self.heart_beat_receive_scale,
+                reconnect_attempts_max=3 if len(self.endpoints) == 1 else 1, auto_decode=self.autodecode)
+
+            with self.subscriptionlock:
+                self.subscribed = False
+                self.debug = logger.isEnabledFor(logging.DEBUG)
+                self.listener = self.listener_class(self, self.callback)
+            self.conn.set_listener('simplelistener', self.listener)
+            logger.debug("#=- Starting connection to %s:%s...", endpoint[0], endpoint[1])
+            try:
+                self.conn.connect(self.server["login"],
+                                  self.server["password"],
+                                  wait=True,
+                                  headers={"client-id": self.module["name"]})
+            except Exception as e:
+                logger.error("#=- Unable to connect to %s:%s: %s", endpoint[0], endpoint[1], e)
+                self.unhealthy[endpoint] = time.monotonic()
+                lasterror = e
+                continue
+            self.endpoint = endpoint
+            break
+        else:
+            raise lasterror
+        logger.debug("#=- Login passed.")
+
+        self.connections+=1
+
+        with self.subscriptionlock:
+            for spec in self.subscriptions.values():
+                if not spec["paused"]:
+                    self.subscribe_spec(spec)
+            self.subscribed = True
+        if self.replyqueue is not None:
+            self.conn.subscribe(destination=self.replyqueue, id=self.replysubscription, ack="auto")
+
+    def rank_endpoints(self):
+        if len(self.endpoints) == 1:
+            return self.endpoints
+        now = time.monotonic()
+        healthy = []
+        failed = []
+        for endpoint in self.endpoints:
+            if now - self.unhealthy.get(endpoint, -self.failoverpenalty) < self.failoverpenalty:
+                failed.append(endpoint)
+                continue
+            latency = probe_endpoint(endpoint, self.probetimeout)
+            self.latencies[endpoint] = latency
+            if latency is None:
+                failed.append(endpoint)
+            else:
+                healthy.append((latency, endpoint))
+        healthy.sort(key=lambda entry: entry[0])
+        logger.debug("#=- Broker latencies: %s", healthy)
+        return [entry[1] for entry in healthy] + failed
+
+    def subscribe_spec(self, spec):
+        logger.debug("#=- Subscribing to:%s (id=%s ack=%s prefetch=%d)", spec["destination"], spec["id"],
+                     spec["ack"], spec["prefetch"])
+        headers = dict(spec["headers"])
+        headers["activemq.prefetchSize"] = spec["prefetch"]
+        if spec["selector"]:
+            headers["selector"] = spec["selector"]
+        self.conn.subscribe(destination=spec["destination"], id=spec["id"], ack=spec["ack"], headers=headers)
+
+    def register_subscription(self, spec):
+        if spec.get("retry") is not None and self.retrier is None:
+            self.retrier = AMQRetrier(self, self.server.get("retry"))
+        if self.retrier is not None and spec["ack"] == "client":
+            policy = self.retrier.spec_policy(spec)
+            if policy is not None and (policy["mode"] != "nack" or policy["dlq"] is not None):
+                raise ValueError("%s: client acks are cumulative, delayed retries and dead letter queues "
+                                 "need client-individual acks." % (spec["destination"],))
+        spec["id"] = str(next(self.subscriptionids))
+        spec["generation"] = 0
+        spec["paused"] = False
+        if self.batcher is not None and spec["ack"] != "auto" and spec["prefetch"] < self.batcher.size:
+            spec["prefetch"] = self.batcher.size
+        if spec.get("codec") is not None:
+            self.subscriptioncodecs[spec["id"]] = self.codecs[spec["destination"]] = parse_codec(spec["codec"])
+        if self.ackbatcher is not None and spec["ack"] == "client" and spec["prefetch"] < self.ackbatcher.size:
+            logger.warning("#=- Prefetch of %s (%d) is lower than the ack batch size (%d). "
+                           "Acks will only be sent by the batch timer.", spec["destination"],
+                           spec["prefetch"], self.ackbatcher.size)
+        if self.retrier is not None:
+            dlq = (spec.get("retry") or self.server.get("retry") or {}).get("dlq")
+            if dlq is not None and dlq not in self.codecs and spec["destination"] in self.codecs:
+                # Dead letters keep the codec of their subscription.
+                self.codecs[dlq] = self.codecs[spec["destination"]]
+        self.subscriptions[spec["id"]] = spec
+        if self.dispatcher is not None and (spec["ack"] == "auto" or self.earlyack) \
+                and not 0 < self.server.get("flowcontrol", {}).get("pausedepth", 0) < self.dispatcher.queuesize:
+            logger.warning("#=- %s is not throttled by its prefetch: a full dispatcher queue blocks the receiver "
+                           "thread. Use a client ack mode or a flowcontrol pausedepth lower than the queue size.",
+                           spec["destination"])
+        return spec
+
+    def subscribe(self, destination, **options):
+        options["destination"] = destination
+        spec = parse_subscription(options, self.server.get("prefetch", 1))
+        if spec is None:
+            raise ValueError("Invalid subscription destination %r" % (destination,))
+        codec = parse_codec(spec["codec"]) if spec.get("codec") is not None \
+            else self.codecs.get(destination, self.codec)
+        if self.autodecode and codec != ("text", None):
+            raise ValueError("Codec %s of %s needs a binary connection: declare it in the codecs server entry."
+                             % ("+".join(part for part in codec if part), destination))
+        with self.subscriptionlock:
+            for existing in self.subscriptions.values():
+                if existing["destination"] == destination and existing["selector"] == spec["selector"]:
+                    return existing["id"]
+            spec = self.register_subscription(spec)
+            if self.subscribed:
+                try:
+                    self.subscribe_spec(spec)
+                except Exception as e:
+                    # The reconnection subscribes the registered subscriptions.
+                    logger.warning("#=- Unable to subscribe to %s: %s", destination, e)
+        logger.info("#=- Subscribed to %s (id=%s).", destination, spec["id"])
+        return spec["id"]
+
+    def unsubscribe(self, destination):
+        with self.subscriptionlock:
+            ids = [subscription_id for subscription_id, spec in self.subscriptions.items()
+                   if destination in (subscription_id, spec["destination"])]
+            for subscription_id in ids:
+                self.remove_subscription(subscription_id)
+        return len(ids)
+
+    def remove_subscription(self, subscription_id):
+        with self.subscriptionlock:
+            spec = self.subscriptions.get(subscription_id)
+            if spec is None:
+                return
+            if self.ackbatcher is not None:
+                # The acks of the subscription must reach the broker before it is removed.
+                self.ackbatcher.flush()
+            if self.subscribed and not spec["paused"]:
+                try:
+                    self.conn.unsubscribe(id=subscription_id)
+                except Exception as e:
+                    logger.warning("#=- Unable to unsubscribe from %s: %s", spec["destination"], e)
+            del self.subscriptions[subscription_id]
+            self.subscriptioncodecs.pop(subscription_id, None)
+            self.listener.states.clear()
+            if self.batcher is not None:
+                self.batcher.clear(subscription_id)
+            if self.flowcontroller is not None:
+                self.flowcontroller.remove(subscription_id)
+        logger.info("#=- Unsubscribed from %s (id=%s).", spec["destination"], subscription_id)
+
+    def generation(self, subscription_id):
+        spec = self.subscriptions.get(subscription_id)
+        return self.connections, spec["generation"] if spec is not None else None
+
+    def replace_subscription(self, subscription_id, prefetch=None, paused=False):
+        with self.subscriptionlock:
+            spec = self.subscriptions.get(subscription_id)
+            if spec is None:
+                return
+            if self.ackbatcher is not None:
+                # The acks of the old subscription must reach the broker before it is removed.
+                self.ackbatcher.flush()
+            if not spec["paused"]:
+                self.conn.unsubscribe(id=subscription_id)
+            spec["generation"] += 1
+            self.listener.states.clear()
+            if self.batcher is not None:
+                self.batcher.clear(subscription_id)
+            if prefetch is not None:
+                spec["prefetch"] = prefetch
+            spec["paused"] = paused
+            if not paused:
+                self.subscribe_spec(spec)
+
+    def resubscribe(self, subscription_id, prefetch):
+        self.replace_subscription(subscription_id, prefetch)
+
+    def pause_subscription(self, subscription_id):
+        self.replace_subscription(subscription_id, paused=True)
+
+    def resume_subscription(self, subscription_id):
+        self.replace_subscription(subscription_id)
+
+    def route(self, pattern, handler, headers=None, name=None):
+        if self.batcher is not None:
+            raise ValueError("Routes are not available with a batch callback.")
+        if self.dispatcher is not None and self.dispatcher.mode == "process":
+            raise ValueError("Routers cannot be sent to process workers, use the thread dispatcher mode.")
+        if self.router is None:
+            # The callback handles the messages matching no route.
+            self.router = AMQRouter(self.callback)
+            self.callback = self.listener.callback = self.router
+        return self.router.add(pattern, handler, headers, name)
+
+    def unroute(self, name):
+        return self.router is not None and self.router.remove(name)
+
+    def ack_message(self, headers):
+        subscription_id = headers["subscription"]
+        if self.ackbatcher is not None and self.ack_mode(subscription_id) == "client":
+            self.ackbatcher.add(headers["message-id"], subscription_id, headers.get("destination", "NA"))
+        else:
+            self.conn.ack(headers["message-id"], subscription_id)
+
+    def ack_mode(self, subscription_id):
+        spec = self.subscriptions.get(subscription_id)
+        if spec is None:
+            return "client"
+        return spec["ack"]
+
+    def send_life_sign(self,variables=None):
+        if(self.listener != None):
+            logger.debug("#=- Send Module Life Sign.")
+            if("lifesign" in self.module):
+                lifesignstruct = self.generate_life_sign()
+
+                if variables !=None:
+                    for key in variables:
+                        lifesignstruct[key]=variables[key]
+
+                self.send_message(self.module["lifesign"], json_encode(lifesignstruct))
+            else:
+                logger.error(
+                    "Unable to send life sign. Target queue not defined in module parameters.")
+        else:
+            logger.error("#=- Unable to send life sign. No listener defined.")
+
+    def generate_life_sign(self):
+        return {
+            "error": "OK",
+            "type": "lifesign",
+            "eventtype": "lifesign",
+            "module": self.module["name"],
+            "version": self.module["version"],
+            "alive": 1,
+            "errors": self.listener.globalerrors,
+            "internalerrors": self.listener.errors,
+            "heartbeaterrors": self.heartbeaterrors,
+            "messages": self.listener.globalmessages,
+            "received": self.listener.received,
+            "sent": self.sent,
+            "pendingacks": self.ackbatcher.pending() if self.ackbatcher is not None else {},
+            "queued": self.dispatcher.depth() if self.dispatcher is not None else 0,
+            "batched": self.batcher.pending() if self.batcher is not None else {},
+            "throttle": self.flowcontroller.throttle() if self.flowcontroller is not None else "normal",
+            "flowcontrol": self.flowcontroller.state() if self.flowcontroller is not None else {},
+            "buffered": len(self.sendbuffer),
+            "dropped": self.dropped,
+            "inflight": len(self.receipts),
+            "recoverederrors": self.recoverederrors,
+            "requests": len(self.requests),
+            "requesttimeouts": self.requesttimeouts,
+            "subscriptions": len(self.subscriptions),
+            "outbox": self.outbox.depth() if self.outbox is not None else 0,
+            "outboxdisk": self.outbox.journal.disk_usage() if self.outbox is not None else 0,
+            "outboxrejected": self.outbox.rejected if self.outbox is not None else 0,
+            "routes": dict(self.router.hits) if self.router is not None else {},
+            "unrouted": self.router.unrouted if self.router is not None else 0,
+            "dedup": self.deduplicator.stats() if self.deduplicator is not None else {},
+            "duplicates": self.deduplicator.hits if self.deduplicator is not None else 0,
+            "retried": sum(self.retrier.retried.values()) if self.retrier is not None else 0,
+            "deadlettered": sum(self.retrier.deadlettered.values()) if self.retrier is not None else 0,
+            "retry": self.retrier.stats() if self.retrier is not None else {},
+            "broker": "%s:%s" % self.endpoint if self.endpoint is not None else "",
+            "metrics": self.metrics.summary() if self.metrics is not None and self.ownmetrics else {},
+            "amqclientversion": amqclientversion,
+            "starttimets": self.starttime.timestamp(),
+            "starttime": str(self.starttime),
+            "connections": self.connections
+        }
+
+    def encode_message(self, destination, message, headers=None):
+        if isinstance(message, AMQMessage):
+            # Forwarded as received.
+            headers = dict(headers) if headers is not None else {}
+            for key in ("content-type", "content-encoding"):
+                if key in message.headers:
+                    headers.setdefault(key, message.headers[key])
+            return message.raw, headers
+        codec = self.codecs.get(destination, self.codec)
+        if codec[0] == "text" and codec[1] is None:
+            return message, headers
+        return encode_payload(message, codec, headers)
+
+    def message_view(self, body, headers):
+        return AMQMessage(headers.get("destination", "NA"), headers, body, self.decode_message,
+                          self.messageview["maxsize"], self.messageview["oversize"])
+
+    def decode_message(self, body, headers):
+        codec = self.subscriptioncodecs.get(headers.get("subscription"))
+        if codec is None:
+            codec = self.codecs.get(headers.get("destination"), self.codec)
+        if isinstance(body, str) and codec[0] == "text":
+            return body
+        return decode_payload(body, headers, codec)
+
+    def send_message(self, destination, message, headers=None):
+        message, headers = self.encode_message(destination, message, headers)
+        self.send_encoded(destination, message, headers)
+
+    def send_encoded(self, destination, message, headers=None):
+        if self.debug:
+            logger.debug("#=- Send Message to %s. LEN=%d", destination, len(message))
+        sent = self.sent
+        try:
+            sent[destination] += 1
+        except KeyError:
+            sent[destination] = 1
+
+        if self.outbox is not None:
+            self.outbox.send(destination, message, headers)
+            return
+
+        if not self.connected:
+            with self.sendlock:
+                if not self.connected:
+                    self.buffer_message(destination, message, headers)
+                    return
+
+        try:
+            if self.metrics is not None:
+                sendstart = time.monotonic()
+                self.conn.send(body=message, destination=destination, headers=headers)
+                self.metrics.observe_sent(destination, 1, len(message), time.monotonic() - sendstart)
+            else:
+                self.conn.send(
+                    body=message, destination=destination, headers=headers)
+        except Exception as e:
+            logger.error("#=- Error raised while sending: %s. Message buffered.", e)
+            with self.sendlock:
+                self.buffer_message(destination, message, headers)
+            self.start_reconnect()
+
+    def send_batch(self, destination, messages, headers=None, transaction=False):
+        self.send_many([(destination, message, headers) for message in messages], transaction)
+
+    def send_many(self, messages, transaction=False):
+        if transaction and self.outbox is not None:
+            raise ValueError("Transactions cannot be sent through the outbox.")
+        if len(messages) == 0:
+            return
+        messages = [(destination,) + self.encode_message(destination, message, headers)
+                    for destination, message, headers in messages]
+        data, counts = encode_send_frames(messages, transaction)
+        logger.debug("#=- Send %d Messages. LEN=%d", len(messages), len(data))
+        for destination, count in counts.items():
+            self.sent[destination] = self.sent.get(destination, 0) + count
+
+        if self.outbox is not None:
+            for destination, message, headers in messages:
+                self.outbox.send(destination, message, headers)
+            return
+
+        if not self.connected:
+            with self.sendlock:
+                if not self.connected:
+                    for destination, message, headers in messages:
+                        self.buffer_message(destination, message, headers)
+                    return
+
+        try:
+            sendstart = time.monotonic()
+            self.write_frames(data)
+            if self.metrics is not None:
+                elapsed = time.monotonic() - sendstart
+                for destination, message, headers in messages:
+                    self.metrics.observe_sent(destination, 1, len(message), elapsed / len(messages))
+        except Exception as e:
+            logger.error("#=- Error raised while sending a batch: %s. Messages buffered.", e)
+            with self.sendlock:
+                for destination, message, headers in messages:
+                    self.buffer_message(destination, message, headers)
+            self.start_reconnect()
+
+    def write_frames(self, data):
+        transport = self.conn.transport
+        # stomp.py 9 writes the TLS connections from the receiver thread, through send_queue. stomp.py 8
+        # has neither flag (blocking is None) nor queue.
+        if getattr(transport, "blocking", None) is False:
+            transport.send_queue.put(data)
+        else:
+            transport.send(data)
+
+    def buffer_message(self, destination, message, headers):
+        if len(self.sendbuffer) == self.sendbuffer.maxlen:
+            self.dropped += 1
+        self.sendbuffer.append((destination, message, headers))
+
+    def send_confirmed(self, destination, message, headers=None, timeout=None):
+        # Encoded first: a codec error must not hold a slot of the window.
+        message, headers = self.encode_message(destination, message, headers)
+        if not self.window.acquire(timeout=timeout):
+            raise TimeoutError("Too many unconfirmed messages in flight.")
+        receipt = "%s-%d" % (self.module["name"], next(self.receiptcounter))
+        frameheaders = dict(headers) if headers is not None else {}
+        frameheaders["receipt"] = receipt
+        future = concurrent.futures.Future()
+        with self.receiptlock:
+            self.receipts[receipt] = (future, destination, message, frameheaders)
+        self.sent[destination] = self.sent.get(destination, 0) + 1
+
+        # While disconnected, the message is sent by replay_buffer.
+        if self.connected:
+            try:
+                self.conn.send(body=message, destination=destination, headers=frameheaders)
+            except Exception as e:
+                logger.error("#=- Error raised while sending: %s. Message will be resent.", e)
+                self.start_reconnect()
+        return future
+
+    def timer_wheel(self):
+        with self.requestlock:
+            if self.timerwheel is None:
+                self.timerwheel = AMQTimerWheel()
+            return self.timerwheel
+
+    def request(self, destination, message, timeout=30, headers=None):
+        with self.requestlock:
+            if self.replyqueue is None:
+                self.replyqueue = "/temp-queue/%s-%s" % (self.module["name"], uuid.uuid4().hex)
+                self.replysubscription = "reply"
+                logger.debug("#=- Subscribing to the reply queue %s", self.replyqueue)
+                if self.connected:
+                    self.conn.subscribe(destination=self.replyqueue, id=self.replysubscription, ack="auto")
+            correlationid = "%s-%d" % (self.replyqueue[12:], next(self.requestcounter))
+            future = concurrent.futures.Future()
+            self.requests[correlationid] = (future, destination)
+        self.timer_wheel().schedule(timeout, self.request_expired, correlationid, timeout)
+        requestheaders = dict(headers) if headers is not None else {}
+        requestheaders["reply-to"] = self.replyqueue
+        requestheaders["correlation-id"] = correlationid
+        self.send_message(destination, message, requestheaders)
+        return future
+
+    def reply(self, headers, message, replyheaders=None):
+        replyheaders = dict(replyheaders) if replyheaders is not None else {}
+        replyheaders["correlation-id"] = headers.get("correlation-id", "")
+        # The reply uses the codec of the request.
+        codec = self.codecs.get(headers.get("destination"), self.codec)
+        if codec != ("text", None):
+            message, replyheaders = encode_payload(message, codec, replyheaders)
+        self.send_encoded(headers["reply-to"], message, replyheaders)
+
+    def reply_received(self, body, headers):
+        with self.requestlock:
+            entry = self.requests.pop(headers.get("correlation-id"), None)
+        if entry is None:
+            logger.debug("#=- Late or unknown reply %s.", headers.get("correlation-id"))
+            return
+        try:
+            codec = self.codecs.get(entry[1], self.codec)
+            if not (isinstance(body, str) and codec[0] == "text"):
+                body = decode_payload(body, headers, codec)
+            entry[0].set_result((body, headers))
+        except Exception as e:
+            entry[0].set_exception(e)
+
+    def request_expired(self, correlationid, timeout):
+        with self.requestlock:
+            entry = self.requests.pop(correlationid, None)
+        if entry is not None:
+            self.requesttimeouts += 1
+            entry[0].set_exception(TimeoutError("No reply from %s within %.1fs." % (entry[1], timeout)))
+
+    def fail_requests(self, reason):
+        with self.requestlock:
+            entries = list(self.requests.values())
+            self.requests = {}
+        for entry in entries:
+            if not entry[0].done():
+                entry[0].set_exception(ConnectionError(reason))
+
+    def receipt_received(self, receipt):
+        if self.outbox is not None and self.outbox.receipt_received(receipt):
+            return
+        with self.receiptlock:
+            entry = self.receipts.pop(receipt, None)
+        if entry is not None:
+            self.window.release()
+            if not entry[0].done():
+                entry[0].set_result(receipt)
+
+    def receipt_error(self, frame):
+        receipt = frame.headers.get("receipt-id")
+        if self.outbox is not None and self.outbox.receipt_error(receipt, frame.headers.get("message")):
+            # The broker closes the connection after an ERROR frame.
+            self.start_reconnect()
+            return True
+        with self.receiptlock:
+            entry = self.receipts.pop(receipt, None)
+        if entry is None:
+            return False
+        self.window.release()
+        entry[0].set_exception(AMQSendError(frame.headers.get("message", "Message rejected by the broker.")))
+        # The broker closes the connection after an ERROR frame.
+        self.start_reconnect()
+        return True
+
+    def fail_confirmed(self, reason):
+        with self.receiptlock:
+            entries = list(self.receipts.values())
+            self.receipts = {}
+        for entry in entries:
+            self.window.release()
+            if not entry[0].done():
+                entry[0].set_exception(ConnectionError(reason))
+
+    def replay_buffer(self):
+        with self.receiptlock:
+            unconfirmed = list(self.receipts.values())
+        if len(unconfirmed) > 0:
+            logger.info("#=- Resending %d unconfirmed messages.", len(unconfirmed))
+        for future, destination, message, headers in unconfirmed:
+            self.conn.send(body=message, destination=destination, headers=headers)
+
+        with self.sendlock:
+            if len(self.sendbuffer) > 0:
+                logger.info("#=- Replaying %d buffered messages.", len(self.sendbuffer))
+            while len(self.sendbuffer) > 0:
+                destination, message, headers = self.sendbuffer[0]
+                self.conn.send(body=message, destination=destination, headers=headers)
+                self.sendbuffer.popleft()
+            self.connected = True
+
+    def heartbeat_timeout(self):
+        self.heartbeaterrors += 1
+        self.endpoint_failed()
+        self.start_reconnect()
+
+    def endpoint_failed(self):
+        if self.endpoint is not None:
+            self.unhealthy[self.endpoint] = time.monotonic()
+
+    def error_received(self, frame):
+        recoverable = classify_error(frame, self.fatalerrors) == "recoverable"
+        if recoverable:
+            self.recoverederrors += 1
+        if self.draining:
+            # The running shutdown completes, within its deadline.
+            if recoverable:
+                logger.warning("#=- Recoverable error while shutting down. Reconnecting to flush the sends.")
+                self.start_reconnect()
+            else:
+                logger.error("#=- Fatal error while shutting down. The sends are not flushed.")
+                with self.reconnectlock:
+                    self.closing = True
+            return
+        if recoverable:
+            logger.warning("#=- Recoverable error. Reconnecting.")
+            # The broker closes the connection after an ERROR frame.
+            self.start_reconnect()
+            return
+        self.general_error()
+
+    def general_error(self):
+        logger.error("#=- General Error. Shutting down")
+        with self.reconnectlock:
+            if self.closing or self.draining:
+                # Already shutting down.
+                return
+            # Reconnecting would hit the same error.
+            self.closing = True
+        # Not in the receiver thread, which must keep reading the receipts.
+        threading.Thread(target=self.shutdown_and_exit, name="amq-shutdown", daemon=True).start()
+
+    def shutdown_and_exit(self):
+        try:
+            self.shutdown(self.shutdowntimeout)
+        except Exception as e:
+            logger.error("#=- Shutdown failed: %s", e)
+        if self.exitonerror:
+            logger.error("#=- Exiting")
+            os._exit(1)
+
+    def listener_disconnect(self):
+        self.endpoint_failed()
+        self.start_reconnect()
+
+    def start_reconnect(self):
+        with self.reconnectlock:
+            if self.closing:
+                return
+            self.connected = False
+            if self.reconnectthread is not None and self.reconnectthread.is_alive():
+                return
+            self.reconnectthread = threading.Thread(target=self.reconnect_and_listen, name="amq-reconnect",
+                                                    daemon=True)
+            self.reconnectthread.start()
+
+    def reconnect_and_listen(self):
+        reconnectstart = time.monotonic()
+        if self.ackbatcher is not None:
+            # Try to deliver the acks of the old session, the broker redelivers the rest.
+            self.ackbatcher.flush()
+            self.ackbatcher.clear()
+        if self.batcher is not None:
+            # The broker redelivers the messages of the incomplete batches.
+            self.batcher.clear()
+        # The temporary reply queue disappears with the connection.
+        self.fail_requests("Connection lost.")
+        self.listener.expected = True
+        try:
+            self.conn.disconnect()
+        except Exception:
+            logger.debug("#=- Unable to disconnect the previous connection.")
+
+        attempt = 0
+        while not self.closing:
+            attempt += 1
+            if 0 < self.reconnect["attempts"] < attempt:
+                logger.error("#=- Giving up reconnection after %d attempts.", attempt - 1)
+                return
+            delay = reconnect_delay(self.reconnect, attempt)
+            if attempt == 1 and len(self.endpoints) > 1:
+                # Fail over to another broker right away.
+                delay = 0
+            logger.debug("#=- Reconnecting: Attempt %d in %.2fs", attempt, delay)
+            time.sleep(delay)
+            try:
+                self.create_connection()
+                self.replay_buffer()
+                logger.info("#=- Reconnected in %.2fs.", time.monotonic() - reconnectstart)
+                if self.metrics is not None:
+                    self.metrics.observe_reconnect(time.monotonic() - reconnectstart)
+                return
+            except Exception as e:
+                logger.error("#=- Reconnect attempt failed: %s" % e)
+
+
+##################################################################################
+# AMQ Client Pool
+##################################################################################
+
+def merge_counters(target, counters):
+    """
+    Adds the values of a counter dictionary to another one.
+    """
+    for key, value in counters.items():
+        target[key] = target.get(key, 0) + value
+    return target
+
+
+def aggregate_life_signs(module, starttime, lifesigns, metrics=None):
+    """
+    Sums the counters of the lifesigns of several clients into a module lifesign. The main
+    values of each client are listed in "pool".
+    """
+    lifesign = {
+        "error": "OK",
+        "type": "lifesign",
+        "eventtype": "lifesign",
+        "module": module["name"],
+        "version": module["version"],
+        "alive": 1,
+        "received": {},
+        "sent": {},
+        "pendingacks": {},
+        "batched": {},
+        "routes": {},
+        "flowcontrol": {},
+        "metrics": metrics.summary() if metrics is not None else {},
+        "amqclientversion": amqclientversion,
+        "starttimets": starttime.timestamp(),
+        "starttime": str(starttime),
+        "pool": []
+    }
+    for key in ("errors", "internalerrors", "heartbeaterrors", "messages", "queued", "buffered", "dropped",
+                "inflight", "connections", "retried", "deadlettered", "requests", "requesttimeouts",
+                "subscriptions", "outbox", "outboxdisk", "outboxrejected", "unrouted", "duplicates"):
+        lifesign[key] = sum(client[key] for client in lifesigns)
+    for client in lifesigns:
+        for key in ("received", "sent", "pendingacks", "batched", "routes"):
+            merge_counters(lifesign[key], client[key])
+        lifesign["flowcontrol"].update(client["flowcontrol"])
+        lifesign["pool"].append({"module": client["module"], "broker": client["broker"],
+                                 "connections": client["connections"],
+                                 "heartbeaterrors": client["heartbeaterrors"], "messages": client["messages"],
+                                 "sent": sum(client["sent"].values()), "buffered": client["buffered"],
+                                 "inflight": client["inflight"]})
+    lifesign["throttle"] = max([client["throttle"] for client in lifesigns] + ["normal"],
+                               key=THROTTLE_STATES.index)
+    return lifesign
+
+
+class AMQClientPool():
+    """
+    AMQClientPool spreads the work of a module over several AMQClient connections.
+
+    Each connection has its own socket, receiver thread, heartbeats and reconnect supervisor.
+    Subscriptions are spread over the connections in round robin, and sends are routed either
+    by destination hash (a destination always uses the same connection, which keeps messages
+    of a destination in order) or in round robin.
+
+    Args:
+        Same as AMQClient. The pool is configured by the server dictionary:
+            connections (int): Number of connections. Default is 2.
+            routing (str): hash (default) or roundrobin.
+            The outbox journal of each connection is in its own directory, connection-<number> below
+            the configured one.
+    Attributes:
+        clients (list): The pooled AMQClient instances. Their client-id is the module name
+            followed by the connection index.
+        metrics (AMQMetrics): Metrics shared by the pooled clients, None when disabled.
+        lifesigner (AMQLifeSigner): Sends the pool lifesigns in the background (see AMQClient).
+    Methods:
+        Same sending and lifesign methods as AMQClient.
+        client_for(destination): Returns the AMQClient used to send to a destination.
+        subscribe(destination, **options): Subscribes the connection with the fewest subscriptions.
+        route(pattern, handler, headers=None, name=None): Adds a route to all the connections.
+        unroute(name): Removes a route from all the connections.
+        unsubscribe(destination): Unsubscribes a destination from all the connections.
+    """
+
+    def __init__(self, server, module, subscription, callback=None, heart_beat_receive_scale=2.0,
+                 listener_class=AMQListener, batch_callback=None):
+        size = max(1, int(server.get("connections", 2)))
+        self.routing = server.get("routing", "hash")
+        if self.routing not in ("hash", "roundrobin"):
+            raise ValueError("Invalid routing %r" % (self.routing,))
+        logger.debug("#=- Starting AMQ Pool of %d connections (%s routing)", size, self.routing)
+
+        self.starttime = datetime.datetime.now()
+        self.server = server
+        self.module = module
+        self.subscription = subscription
+
+        subscriptions = [[] for i in range(size)]
+        for index, sub in enumerate([sub for sub in subscription if parse_subscription(sub) is not None]):
+            subscriptions[index % size].append(sub)
+
+        self.metrics = create_metrics(server)
+        self.clients = []
+        try:
+            for index in range(size):
+                clientmodule = dict(module)
+                clientmodule["name"] = "%s-%d" % (module["name"], index + 1)
+                clientmodule.pop("lifesigninterval", None)
+                clientserver = server
+                if "outbox" in server:
+                    # A journal cannot be shared by several connections.
+                    clientserver = dict(server, outbox=dict(server["outbox"]))
+                    clientserver["outbox"]["directory"] = os.path.join(
+                        server["outbox"].get("directory", OUTBOX_DEFAULTS["directory"]), "connection-%d" % (index + 1))
+                self.clients.append(AMQClient(clientserver, clientmodule, subscriptions[index], callback,
+                                              heart_beat_receive_scale, listener_class, self.metrics,
+                                              batch_callback))
+        except Exception:
+            self.disconnect()
+            raise
+        self.roundrobin = itertools.cycle(self.clients)
+
+        self.lifesigner = None
+        if "lifesign" in module and "lifesigninterval" in module:
+            self.lifesigner = AMQLifeSigner(self, module["lifesigninterval"], module.get("lifesignfull", 12),
+                                            module.get("lifesigntop", 10))
+
+    def subscribe(self, destination, **options):
+        for client in self.clients:
+            for spec in list(client.subscriptions.values()):
+                if spec["destination"] == destination and spec["selector"] == options.get("selector"):
+                    return client.subscribe(destination, **options)
+        client = min(self.clients, key=lambda client: len(client.subscriptions))
+        return client.subscribe(destination, **options)
+
+    def route(self, pattern, handler, headers=None, name=None):
+        for client in self.clients:
+            name = client.route(pattern, handler, headers, name)
+        return name
+
+    def unroute(self, name):
+        return all([client.unroute(name) for client in self.clients])
+
+    def unsubscribe(self, destination):
+        # Subscription ids are only unique per connection.
+        removed = 0
+        for client in self.clients:
+            for subscription_id, spec in list(client.subscriptions.items()):
+                if spec["destination"] == destination:
+                    client.remove_subscription(subscription_id)
+                    removed += 1
+        return removed
+
+    def client_for(self, destination):
+        if self.routing == "roundrobin":
+            return next(self.roundrobin)
+        return self.clients[hash(destination) % len(self.clients)]
+
+    def disconnect(self):
+        if getattr(self, "lifesigner", None) is not None:
+            self.lifesigner.stop()
+        for client in self.clients:
+            try:
+                client.disconnect()
+            except Exception as e:
+                logger.error("#=- Unable to disconnect %s: %s", client.module["name"], e)
+        if self.metrics is not None:
+            self.metrics.stop_http_server()
+
+    def send_message(self, destination, message, headers=None):
+        self.client_for(destination).send_message(destination, message, headers)
+
+    def send_confirmed(self, destination, message, headers=None, timeout=None):
+        return self.client_for(destination).send_confirmed(destination, message, headers, timeout)
+
+    def send_batch(self, destination, messages, headers=None, transaction=False):
+        self.client_for(destination).send_batch(destination, messages, headers, transaction)
+
+    def request(self, destination, message, timeout=30, headers=None):
+        return self.client_for(destination).request(destination, message, timeout, headers)
+
+    def reply(self, headers, message, replyheaders=None):
+        self.client_for(headers["reply-to"]).reply(headers, message, replyheaders)
+
+    def send_many(self, messages, transaction=False):
+        if len(messages) == 0:
+            return
+        if transaction:
+            # A transaction cannot span several connections.
+            self.client_for(messages[0][0]).send_many(messages, True)
+            return
+        batches = {}
+        for entry in messages:
+            batches.setdefault(id(self.client_for(entry[0])), []).append(entry)
+        for client in self.clients:
+            if id(client) in batches:
+                client.send_many(batches[id(client)])
+
+    def send_life_sign(self, variables=None):
+        logger.debug("#=- Send Module Life Sign.")
+        if "lifesign" in self.module:
+            lifesignstruct = self.generate_life_sign()
+            if variables is not None:
+                lifesignstruct.update(variables)
+            self.send_message(self.module["lifesign"], json_encode(lifesignstruct))
+        else:
+            logger.error("Unable to send life sign. Target queue not defined in module parameters.")
+
+    def generate_life_sign(self):
+        return aggregate_life_signs(self.module, self.starttime,
+                                    [client.generate_life_sign() for client in self.clients], self.metrics)
+
 
 ##################################################################################
-# AMQ Listener
+# AMQ Supervisor
 ##################################################################################
 
-class AMQListener(stomp.ConnectionListener):
+RESTART_DEFAULTS = {"initial": 1.0, "max": 60.0, "factor": 2.0, "jitter": 0.2, "attempts": 0, "stable": 60.0}
+# Server entries that belong to the consumers, not to the lifesign connection of the supervisor.
+WORKER_ENTRIES = ("outbox", "dedup", "batch", "dispatcher", "flowcontrol", "metrics", "ackbatch", "retry")
+
+
+def worker_server(server, index):
     """
-    AMQListener is a listener class for handling STOMP protocol events in a message queue client.
+    Returns the server dictionary of a worker: the outbox journal and the metrics endpoint
+    cannot be shared by several processes, each worker gets its own directory and port.
+    """
+    server = dict(server)
+    if "outbox" in server:
+        server["outbox"] = dict(server["outbox"])
+        server["outbox"]["directory"] = os.path.join(server["outbox"].get("directory", OUTBOX_DEFAULTS["directory"]),
+                                                     "worker-%d" % (index + 1))
+    if isinstance(server.get("metrics"), dict) and "port" in server["metrics"]:
+        server["metrics"] = dict(server["metrics"])
+        server["metrics"]["port"] += index
+    return server
+
+
+def run_worker(index, server, module, subscription, callback, batch_callback, heart_beat_receive_scale,
+               listener_class, lifesigns, stop, interval):
+    """
+    Body of a worker process of AMQSupervisor: runs an AMQClient named <module name>-<index + 1>
+    and reports its lifesign every interval seconds until stop is set or SIGTERM is received.
+    """
+    # The handler only sets a flag: a lock taken by a signal handler can deadlock.
+    signals = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: signals.append(signum))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    workermodule = dict(module)
+    workermodule["name"] = "%s-%d" % (module["name"], index + 1)
+    workermodule.pop("lifesigninterval", None)
+    workermodule.setdefault("version", "")
+    conn = AMQClient(worker_server(server, index), workermodule, subscription, callback, heart_beat_receive_scale,
+                     listener_class, batch_callback=batch_callback)
+    try:
+        nextreport = 0.0
+        while not signals and not stop.is_set():
+            if time.monotonic() >= nextreport:
+                nextreport = time.monotonic() + interval
+                try:
+                    lifesigns.put((index, os.getpid(), conn.generate_life_sign()))
+                except Exception as e:
+                    logger.error("#=- Unable to report the lifesign of %s: %s", workermodule["name"], e)
+            time.sleep(0.1)
+    finally:
+        conn.shutdown(server.get("shutdowntimeout", 5))
+
+
+class AMQSupervisor():
+    """
+    AMQSupervisor runs the consumers in worker processes, to use several cores when the callbacks
+    are CPU bound.
+
+    Each worker runs its own AMQClient with the same server, module and subscription configuration
+    and the client-id <module name>-<worker number>. Crashed workers (including the exit of
+    general_error) are restarted with an exponential backoff, reset once a worker ran "stable"
+    seconds. The workers report their lifesign to the supervisor, which aggregates them in a
+    module level lifesign sent through its own connection when the module dictionary contains
+    a "lifesigninterval" entry.
+
+    The workers are started by a fork server by default (spawned where it is not available): the
+    supervisor restarts them from its own thread, and forking a process running other threads can
+    leave their locks held in the child. The callbacks must then be module level functions (or
+    picklable objects) and the program must be guarded by if __name__ == "__main__". The fork
+    start method lifts these constraints, at the expense of this risk.
 
     Args:
-        amqconn: The AMQ connection object, used for acknowledging messages and handling errors.
-        callback: A callable to process received messages. It should accept (destination, message, headers).
+        server (dict): Server connection parameters, plus:
+            workers (int): Number of worker processes. Default is the number of CPUs.
+            restart (dict): Restart backoff (see RESTART_DEFAULTS).
+            startmethod (str): multiprocessing start method. Default is forkserver when available, else spawn.
+        module (dict): Module information.
+        subscription (list): Subscriptions of every worker.
+        callback (callable, optional): Callback function for message handling.
+        heart_beat_receive_scale (float, optional): Heartbeat receive scale factor. Default is 2.0.
+        listener_class (type, optional): Listener class of the workers. Default is AMQListener.
+        batch_callback (callable, optional): Batch callback of the workers.
 
     Attributes:
-        internal_conn: Reference to the AMQ connection object.
-        callback: The message processing callback function.
-        globalerrors: Counter for global errors encountered.
-        errors: Counter for errors received via the on_error handler.
-        globalmessages: Counter for total messages received.
-        received: Dictionary tracking the number of messages received per destination.
+        workers (list): Worker processes, None while waiting for a restart.
+        restarts (list): Number of restarts per worker.
+        lifesigns (dict): Last lifesign reported by each worker.
+        client (AMQClient): Connection sending the aggregated lifesigns, None without lifesign.
 
     Methods:
-        on_error(frame):
-            Handles error frames received from the STOMP server. Logs the error, increments error counters, and notifies the connection.
-        on_heartbeat_timeout():
-            Handles heartbeat timeout events. Logs a warning and notifies the connection.
-        on_message(frame):
-            Handles incoming messages. Optionally acknowledges early, logs and tracks message statistics, invokes the callback, handles exceptions, and acknowledges the message if not early ack.
+        start_worker(index): Starts a worker process.
+        supervise(): Collects the lifesigns and restarts the crashed workers until stopped.
+        generate_life_sign(): Aggregates the lifesigns of the workers.
+        send_message(destination, message, headers=None): Sends a message through the supervisor connection.
+        send_life_sign(variables=None): Sends the aggregated lifesign.
+        join(): Blocks until SIGTERM, SIGINT or stop.
+        stop(timeout=30): Stops the workers, letting them shut down within timeout seconds.
     """
 
-    def __init__(self, amqconn,  callback):
-        self.internal_conn = amqconn
+    def __init__(self, server, module, subscription, callback=None, heart_beat_receive_scale=2.0,
+                 listener_class=AMQListener, batch_callback=None):
+        size = max(1, int(server.get("workers", os.cpu_count() or 1)))
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context(server.get("startmethod",
+                                                              "forkserver" if "forkserver" in methods else "spawn"))
+        logger.debug("#=- Starting AMQ Supervisor of %d workers (%s)", size, self.context.get_start_method())
+
+        self.starttime = datetime.datetime.now()
+        self.server = server
+        self.module = module
+        self.subscription = subscription
         self.callback = callback
-        self.globalerrors = 0
-        self.errors = 0
-        self.globalmessages = 0
-        self.received = {}
+        self.batch_callback = batch_callback
+        self.heart_beat_receive_scale = heart_beat_receive_scale
+        self.listener_class = listener_class
+        self.restart = dict(RESTART_DEFAULTS)
+        self.restart.update(server.get("restart", {}))
+        self.interval = min(10.0, module.get("lifesigninterval", 10.0))
 
-    def on_error(self,  frame:stomp.utils.Frame):
-        logger.error('#=- Received an error "%s"' % frame)
-        self.errors += 1
-        self.internal_conn.general_error()
+        self.queue = self.context.Queue()
+        self.stopping = self.context.Event()
+        self.stopped = threading.Event()
+        self.workers = [None] * size
+        self.started = [0.0] * size
+        self.failures = [0] * size
+        self.restarts = [0] * size
+        self.restartat = [None] * size
+        self.pids = [None] * size
+        self.lifesigns = {}
+        for index in range(size):
+            self.start_worker(index)
 
-    def on_heartbeat_timeout(self):
-        logger.warning("#=- HEART BEAT TIMEOUT ERROR")
-        self.internal_conn.heartbeat_timeout()
+        self.thread = threading.Thread(target=self.supervise, name="amq-supervisor", daemon=True)
+        self.thread.start()
 
-    def on_message(self,  frame:stomp.utils.Frame):
-        headers = frame.headers
-        message = frame.body
-        if self.internal_conn.earlyack:
-            logger.debug("Early ack")
-            self.internal_conn.conn.ack(
-                headers["message-id"], headers["subscription"])
-
-        destination = "NA"
-        if("destination" in headers):
-            destination = headers["destination"]
-        logger.debug("#=->>>> Message received (%s) PAYLOAD=%d", destination, len(message))
-
-        if destination not in self.received:
-            self.received[destination] = 1
+        self.client = None
+        self.lifesigner = None
+        if "lifesign" in module and "lifesigninterval" in module:
+            clientserver = dict(server)
+            for key in WORKER_ENTRIES:
+                clientserver.pop(key, None)
+            clientmodule = dict(module)
+            clientmodule["name"] = "%s-supervisor" % module["name"]
+            clientmodule.pop("lifesigninterval", None)
+            self.client = AMQClient(clientserver, clientmodule, [], heart_beat_receive_scale=heart_beat_receive_scale)
+            self.lifesigner = AMQLifeSigner(self, module["lifesigninterval"], module.get("lifesignfull", 12),
+                                            module.get("lifesigntop", 10))
+
+    def start_worker(self, index):
+        worker = self.context.Process(target=run_worker, name="%s-%d" % (self.module["name"], index + 1),
+                                      args=(index, self.server, self.module, self.subscription, self.callback,
+                                            self.batch_callback, self.heart_beat_receive_scale,
+                                            self.listener_class, self.queue, self.stopping, self.interval))
+        worker.start()
+        self.workers[index] = worker
+        self.pids[index] = worker.pid
+        self.started[index] = time.monotonic()
+        self.restartat[index] = None
+        logger.info("#=- Worker %d started (pid %d).", index + 1, worker.pid)
+
+    def supervise(self):
+        while not self.stopped.is_set():
+            try:
+                index, pid, lifesign = self.queue.get(timeout=0.2)
+                if pid == self.pids[index]:
+                    self.lifesigns[index] = lifesign
+            except queue.Empty:
+                pass
+            except Exception as e:
+                logger.error("#=- Unable to read a worker lifesign: %s", e)
+            if self.stopping.is_set():
+                continue
+            now = time.monotonic()
+            for index, worker in enumerate(self.workers):
+                if worker is not None and not worker.is_alive():
+                    worker.join()
+                    self.failures[index] = 1 if now - self.started[index] >= self.restart["stable"] \
+                        else self.failures[index] + 1
+                    if 0 < self.restart["attempts"] < self.failures[index]:
+                        logger.error("#=- Worker %d exited with %s. Giving up after %d restarts.", index + 1,
+                                     worker.exitcode, self.failures[index] - 1)
+                        self.workers[index] = None
+                        continue
+                    delay = reconnect_delay(self.restart, self.failures[index])
+                    logger.error("#=- Worker %d exited with %s. Restarting in %.1fs.", index + 1, worker.exitcode,
+                                 delay)
+                    self.workers[index] = None
+                    self.restartat[index] = now + delay
+                elif worker is None and self.restartat[index] is not None and now >= self.restartat[index]:
+                    self.start_worker(index)
+                    # Counted once started, a lifesign never shows a restarted worker as dead.
+                    self.restarts[index] += 1
+
+    def generate_life_sign(self):
+        lifesigns = [self.lifesigns[index] for index in sorted(self.lifesigns)]
+        lifesign = aggregate_life_signs(self.module, self.starttime, lifesigns, None)
+        lifesign["restarts"] = sum(self.restarts)
+        lifesign["workers"] = []
+        for index, worker in enumerate(self.workers):
+            lifesign["workers"].append({"worker": index + 1, "pid": self.pids[index],
+                                        "alive": worker is not None and worker.is_alive(),
+                                        "restarts": self.restarts[index]})
+        return lifesign
+
+    def send_message(self, destination, message, headers=None):
+        self.client.send_message(destination, message, headers)
+
+    def send_life_sign(self, variables=None):
+        logger.debug("#=- Send Module Life Sign.")
+        if "lifesign" in self.module and self.client is not None:
+            lifesignstruct = self.generate_life_sign()
+            if variables is not None:
+                lifesignstruct.update(variables)
+            self.send_message(self.module["lifesign"], json_encode(lifesignstruct))
         else:
-            self.received[destination] += 1
+            logger.error("Unable to send life sign. Target queue not defined in module parameters.")
 
-        self.globalmessages += 1
+    def join(self):
+        signals = []
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda signum, frame: signals.append(signum))
+        while not signals and not self.stopping.is_set():
+            time.sleep(0.2)
+        self.stop()
 
-        try:
-            if self.callback is not None:
-                self.callback(destination, message, headers)
-            else:
-                logger.warning("#=- No call back defined")
+    def stop(self, timeout=30):
+        logger.info("#=- Stopping the workers...")
+        self.stopping.set()
+        if self.lifesigner is not None:
+            self.lifesigner.stop()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker is not None:
+                worker.join(max(0.0, deadline - time.monotonic()))
+        for index, worker in enumerate(self.workers):
+            if worker is not None and worker.is_alive():
+                logger.warning("#=- Worker %d did not stop in time. Terminating.", index + 1)
+                worker.terminate()
+                worker.join()
+        self.stopped.set()
+        self.thread.join()
+        if self.client is not None:
+            self.client.disconnect()
 
-        except Exception as e:
-            self.globalerrors += 1
 
-            logger.error(f"ERROR:{e}", exc_info=True)
-            err = sys.exc_info()
-            errstr = str(err[0]) + str(err[1]) + str(err[2])
-            logger.error(f"ERROR:{errstr}" )
+##################################################################################
+# Async AMQ Client
+##################################################################################
+
+def escape_header(value):
+    """
+    Escapes a STOMP 1.2 header key or value (STOMP 1.1 escapes plus carriage returns).
+    """
+    return str(value).replace("\\", "\\\\").replace("\r", "\\r").replace("\n", "\\n").replace(":", "\\c")
 
-        if not self.internal_conn.earlyack:
-            self.internal_conn.conn.ack(
-                headers["message-id"], headers["subscription"])
-        logger.debug("#=-<<<< Message handled")
 
+HEADER_UNESCAPES = {"\\\\": "\\", "\\n": "\n", "\\c": ":", "\\r": "\r"}
 
-class AMQClient():
+
+def unescape_header(value):
     """
-    AMQClient is a client for connecting to an AMQ (ActiveMQ) server using the STOMP protocol.
-    This class manages the connection lifecycle, subscriptions, message sending, and heartbeat monitoring.
-    It supports automatic reconnection, error handling, and sending periodic life sign messages.
+    Unescapes a STOMP 1.2 header key or value.
+    """
+    if "\\" not in value:
+        return value
+    return re.sub(r"\\.", lambda mat: HEADER_UNESCAPES.get(mat.group(0), mat.group(0)), value)
+
+
+def encode_frame(cmd, headers=None, body=b""):
+    """
+    Encodes a STOMP frame.
+
+    Args:
+        cmd (str): Frame command (SEND, ACK, ...).
+        headers (dict, optional): Frame headers. None values are skipped.
+        body (str or bytes, optional): Frame body. Strings are encoded in UTF-8.
+
+    Returns:
+        bytes: The encoded frame, including the NULL terminator.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    lines = [cmd]
+    if headers is not None:
+        for key, value in headers.items():
+            if value is not None and key != "content-length":
+                if cmd == "CONNECT":
+                    lines.append("%s:%s" % (key, value))
+                else:
+                    lines.append("%s:%s" % (escape_header(key), escape_header(value)))
+    if body:
+        lines.append("content-length:%d" % len(body))
+    lines.append("\n")
+    return "\n".join(lines).encode("utf-8") + body + b"\x00"
+
+
+def encode_send_frames(messages, transaction=False):
+    """
+    Encodes a list of (destination, message, headers) tuples as consecutive SEND frames.
+
+    Args:
+        messages (list): The messages to send. headers can be None.
+        transaction (bool, optional): Wraps the frames between BEGIN and COMMIT frames.
+
+    Returns:
+        tuple: (encoded frames as bytes, number of messages per destination)
+    """
+    frames = []
+    counts = {}
+    txid = None
+    if transaction:
+        txid = "tx-%s" % uuid.uuid4()
+        frames.append(encode_frame("BEGIN", {"transaction": txid}))
+    for destination, message, headers in messages:
+        counts[destination] = counts.get(destination, 0) + 1
+        frameheaders = dict(headers) if headers is not None else {}
+        frameheaders["destination"] = destination
+        if txid is not None:
+            frameheaders["transaction"] = txid
+        frames.append(encode_frame("SEND", frameheaders, message))
+    if txid is not None:
+        frames.append(encode_frame("COMMIT", {"transaction": txid}))
+    return b"".join(frames), counts
+
+
+async def read_frame(reader):
+    """
+    Reads a STOMP frame from an asyncio stream.
+
+    Args:
+        reader (asyncio.StreamReader): The stream to read from.
+
+    Returns:
+        tuple: (command, headers, body as bytes), or None when a heartbeat was received.
+
+    Raises:
+        ConnectionError: If the stream is closed.
+    """
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed by the broker.")
+    line = line.rstrip(b"\r\n").lstrip(b"\x00")
+    if len(line) == 0:
+        return None
+
+    cmd = line.decode("utf-8")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the broker.")
+        line = line.rstrip(b"\r\n")
+        if len(line) == 0:
+            break
+        key, _, value = line.decode("utf-8").partition(":")
+        key = unescape_header(key)
+        if key not in headers:
+            headers[key] = unescape_header(value)
+
+    if "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+        await reader.readexactly(1)
+    else:
+        body = (await reader.readuntil(b"\x00"))[:-1]
+    return cmd, headers, body
+
+
+class AsyncAMQClient():
+    """
+    AsyncAMQClient is an asyncio native version of AMQClient.
+
+    It speaks STOMP 1.1 directly over an asyncio stream, without stomp.py threads, and accepts
+    the same server, module and subscription parameters as AMQClient. Messages are either
+    handed to an async callback or consumed with an async iterator:
+
+        client = AsyncAMQClient(server, module, ["/queue/QTEST1"])
+        await client.create_connection()
+        async for destination, message, headers in client:
+            await client.send("/queue/QTEST2", message)
+
+    When iterating, a message is acknowledged when the next one is requested. The messages
+    still queued when the connection is lost are dropped, the broker redelivers them.
+
     Args:
         server (dict): Server connection parameters (ip, port, login, password, etc.).
         module (dict): Module information (name, version, lifesign queue, etc.).
-        subscription (list): List of subscription destinations (queues/topics).
-        callback (callable, optional): Callback function for message handling.
+        subscription (list): List of subscription destinations or subscription specs.
+        callback (coroutine function, optional): Awaited with (destination, message, headers).
         heart_beat_receive_scale (float, optional): Heartbeat receive scale factor. Default is 2.0.
-        listener_class (type, optional): Listener class to handle incoming messages. Default is AMQListener.
     Attributes:
-        starttime (datetime): Timestamp when the client was started.
-        heart_beat_receive_scale (float): Heartbeat receive scale factor.
-        listener_class (type): Listener class used for message handling.
-        conn (stomp.Connection): STOMP connection object.
-        sent (dict): Counter of sent messages per destination.
-        subscription (list): List of subscription destinations.
-        callback (callable): Callback function for message handling.
-        server (dict): Server connection parameters.
-        module (dict): Module information.
-        heartbeaterrors (int): Number of heartbeat errors encountered.
-        connections (int): Number of connection attempts.
-        earlyack (bool): Whether early acknowledgment is enabled.
-        listener (AMQListener): Listener instance for handling messages.
+        Same counters as AMQClient and AMQListener (sent, received, globalmessages,
+        globalerrors, errors, heartbeaterrors, connections).
     Methods:
-        disconnect(): Disconnects from the AMQ server.
-        create_connection(): Establishes a new connection and subscribes to destinations.
+        create_connection(): Connects, subscribes and starts the reader and heartbeat tasks.
+        subscribe(destination, **options): Adds a subscription (same options as the subscription specs)
+            and returns its id, or the id of the existing subscription to the same destination and selector.
+        unsubscribe(destination): Removes the subscriptions to a destination, or the subscription with
+            this id. Returns the number of removed subscriptions.
+        disconnect(): Disconnects from the AMQ server and ends the message iteration.
+        send(destination, message, headers=None): Sends a message. send_message is an alias.
+        send_many(messages, transaction=False), send_batch(destination, messages, headers=None, transaction=False):
+            Same as the AMQClient batch methods.
+        ack_message(headers): Acknowledges a message.
         send_life_sign(variables=None): Sends a life sign message to the configured queue.
         generate_life_sign(): Generates a dictionary with life sign information.
-        send_message(destination, message, headers=None): Sends a message to a destination.
-        heartbeat_timeout(): Handles heartbeat timeout events and triggers reconnection.
-        general_error(): Handles unrecoverable errors and exits the process.
-        listener_disconnect(): Handles listener disconnect events and triggers reconnection.
-        reconnect_and_listen(): Attempts to reconnect to the server with retries.
+        reconnect_and_listen(): Reconnects with the same exponential backoff as AMQClient, after a lost
+            connection or a recoverable ERROR frame. Fatal errors (see classify_error) disconnect the client.
     """
 
-    def __init__(self, server, module, subscription, callback=None,heart_beat_receive_scale=2.0,
-                 listener_class=AMQListener):
-        
-        logger.debug("#=-" * 20)
-        logger.debug("#=- Starting AMQ Connection%s", amqclientversion)
-        logger.debug("#=-" * 20)
-        logger.debug("#=- Module       :%s", module["name"])
-        logger.debug("#=- IP           :%s", server["ip"])
-        logger.debug("#=- Port         :%s", server["port"])
-        logger.debug("#=- Login        :%s", server["login"])
-        logger.debug("#=- Password     :%s", "*" * len(server["password"]))
-        logger.debug("#=- Subscription :%s", subscription)
-        logger.debug("#=- Beat         :%s", heart_beat_receive_scale)
-        logger.debug("#=- Listener     :%s", listener_class)
-        
+    def __init__(self, server, module, subscription, callback=None, heart_beat_receive_scale=2.0):
+        logger.debug("#=- Starting Async AMQ Connection%s", amqclientversion)
         self.starttime = datetime.datetime.now()
-        self.heart_beat_receive_scale=heart_beat_receive_scale
-        self.listener_class = listener_class
-
-        self.conn = None
+        self.heart_beat_receive_scale = heart_beat_receive_scale
         self.sent = {}
+        self.received = {}
         self.subscription = subscription
         self.callback = callback
         self.server = server
         self.module = module
         self.heartbeaterrors = 0
         self.connections = 0
-        self.earlyack=False
+        self.globalerrors = 0
+        self.errors = 0
+        self.globalmessages = 0
+        self.earlyack = server.get("earlyack", False)
+        self.fatalerrors = list(FATAL_ERRORS) + list(server.get("fatalerrors", []))
 
-        if "earlyack" in server:
-            logger.info("Early ack set to true.")
-            self.earlyack=server["earlyack"]
+        self.codec = parse_codec(server.get("codec"))
+        self.codecs = {}
+        for destination, codec in server.get("codecs", {}).items():
+            self.codecs[destination] = parse_codec(codec)
 
-        logger.debug("#=- Subscription :%s", subscription)
-        logger.debug("#=- Early Ack    :%s", self.earlyack)
-        logger.debug("#=-" * 20)
-        
-        self.create_connection()
+        self.subscriptions = {}
+        self.subscriptionids = itertools.count(1)
+        for sub in subscription:
+            spec = parse_subscription(sub, server.get("prefetch", 1))
+            if spec is not None:
+                self.register_subscription(spec)
 
-    def disconnect(self):
-        logger.info("#=- Disconnecting...")
-        self.conn.disconnect()
+        self.reconnect = dict(RECONNECT_DEFAULTS)
+        self.reconnect.update(server.get("reconnect", {}))
+        self.reader = None
+        self.writer = None
+        self.messages = None
+        self.pendingack = None
+        self.tasks = []
+        self.reconnecting = None
+        self.closing = False
+        self.lastreceived = 0
+        self.lastsent = 0
 
-    def create_connection(self):
-        logger.info("#=- Creating connection.")
-        heartbeats = (10000, 20000)
+    async def __aenter__(self):
+        await self.create_connection()
+        return self
 
-        if "heartbeats" in self.server:
-            heartbeats = self.server["heartbeats"]
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.disconnect()
+
+    async def create_connection(self):
+        logger.info("#=- Creating async connection.")
+        heartbeats = self.server.get("heartbeats", (10000, 20000))
+        if self.messages is None:
+            self.messages = asyncio.Queue(maxsize=self.server.get("prefetch", 1) * 2 + 100)
 
-        self.conn = stomp.Connection(
-            [(self.server["ip"], self.server["port"])], heartbeats=heartbeats,heart_beat_receive_scale=self.heart_beat_receive_scale)
-
-        self.listener = self.listener_class(self, self.callback)
-        self.conn.set_listener('simplelistener', self.listener)
-        logger.debug("#=- Starting connection...")
-#        self.conn.start()
-        logger.debug("#=- Connection started.")
-        self.conn.connect(self.server["login"],
-                          self.server["password"],
-                          wait=True,
-                          headers={"client-id": self.module["name"]})
+        lasterror = None
+        for endpoint in parse_endpoints(self.server):
+            try:
+                self.reader, self.writer = await asyncio.open_connection(endpoint[0], endpoint[1], limit=2 ** 24)
+                break
+            except OSError as e:
+                logger.error("#=- Unable to connect to %s:%s: %s", endpoint[0], endpoint[1], e)
+                lasterror = e
+        else:
+            raise lasterror
+        await self.write(encode_frame("CONNECT", {"accept-version": "1.1", "host": endpoint[0],
+                                                  "login": self.server["login"],
+                                                  "passcode": self.server["password"],
+                                                  "heart-beat": "%d,%d" % tuple(heartbeats),
+                                                  "client-id": self.module["name"]}))
+        frame = None
+        while frame is None:
+            frame = await read_frame(self.reader)
+        if frame[0] != "CONNECTED":
+            self.writer.close()
+            raise ConnectionError("Unable to connect: %s" % frame[1].get("message", frame[0]))
         logger.debug("#=- Login passed.")
+        self.lastreceived = time.monotonic()
+        self.connections += 1
 
-        self.connections+=1
-        curid = 1
+        serverbeats = [int(val) for val in frame[1].get("heart-beat", "0,0").split(",")]
+        sendinterval = max(heartbeats[0], serverbeats[1]) / 1000.0 if heartbeats[0] and serverbeats[1] else 0
+        receivetimeout = max(heartbeats[1], serverbeats[0]) / 1000.0 if heartbeats[1] and serverbeats[0] else 0
 
-        if(len(self.subscription) > 0):
-            for sub in self.subscription:
-                if len(sub) > 0:
-                    logger.debug("#=- Subscribing to:" + sub)
-                    
-                    self.conn.subscribe(destination=sub, id=curid, ack='client', headers={
-                                        "activemq.prefetchSize": 1})
-                    curid += 1
+        for spec in self.subscriptions.values():
+            await self.subscribe_spec(spec)
 
-    def send_life_sign(self,variables=None):
-        if(self.listener != None):
-            logger.debug("#=- Send Module Life Sign.")
-            if("lifesign" in self.module):
-                lifesignstruct = self.generate_life_sign()
+        self.tasks = [asyncio.ensure_future(self.read_loop())]
+        if sendinterval or receivetimeout:
+            self.tasks.append(asyncio.ensure_future(
+                self.heartbeat_loop(sendinterval, receivetimeout * self.heart_beat_receive_scale)))
 
-                if variables !=None:
-                    for key in variables:
-                        lifesignstruct[key]=variables[key]
+    def register_subscription(self, spec):
+        spec["id"] = str(next(self.subscriptionids))
+        if spec.get("codec") is not None:
+            self.codecs[spec["destination"]] = parse_codec(spec["codec"])
+        self.subscriptions[spec["id"]] = spec
+        return spec
+
+    async def subscribe(self, destination, **options):
+        options["destination"] = destination
+        spec = parse_subscription(options, self.server.get("prefetch", 1))
+        if spec is None:
+            raise ValueError("Invalid subscription destination %r" % (destination,))
+        for existing in self.subscriptions.values():
+            if existing["destination"] == destination and existing["selector"] == spec["selector"]:
+                return existing["id"]
+        spec = self.register_subscription(spec)
+        if self.writer is not None:
+            try:
+                await self.subscribe_spec(spec)
+            except Exception as e:
+                # The reconnection subscribes the registered subscriptions.
+                logger.warning("#=- Unable to subscribe to %s: %s", destination, e)
+                self.start_reconnect()
+        logger.info("#=- Subscribed to %s (id=%s).", destination, spec["id"])
+        return spec["id"]
+
+    async def unsubscribe(self, destination):
+        ids = [subscription_id for subscription_id, spec in self.subscriptions.items()
+               if destination in (subscription_id, spec["destination"])]
+        for subscription_id in ids:
+            spec = self.subscriptions.pop(subscription_id)
+            if self.writer is None:
+                continue
+            try:
+                if self.pendingack is not None and self.pendingack.get("subscription") == subscription_id:
+                    headers = self.pendingack
+                    self.pendingack = None
+                    await self.ack_message(headers)
+                await self.write(encode_frame("UNSUBSCRIBE", {"id": subscription_id}))
+            except Exception as e:
+                logger.warning("#=- Unable to unsubscribe from %s: %s", spec["destination"], e)
+                self.start_reconnect()
+            logger.info("#=- Unsubscribed from %s (id=%s).", spec["destination"], subscription_id)
+        return len(ids)
+
+    async def subscribe_spec(self, spec):
+        logger.debug("#=- Subscribing to:%s (id=%s ack=%s prefetch=%d)", spec["destination"], spec["id"],
+                     spec["ack"], spec["prefetch"])
+        headers = dict(spec["headers"])
+        headers["destination"] = spec["destination"]
+        headers["id"] = spec["id"]
+        headers["ack"] = spec["ack"]
+        headers["activemq.prefetchSize"] = spec["prefetch"]
+        if spec["selector"]:
+            headers["selector"] = spec["selector"]
+        await self.write(encode_frame("SUBSCRIBE", headers))
+
+    def ack_mode(self, subscription_id):
+        spec = self.subscriptions.get(subscription_id)
+        if spec is None:
+            return "client"
+        return spec["ack"]
+
+    async def write(self, data):
+        self.writer.write(data)
+        self.lastsent = time.monotonic()
+        await self.writer.drain()
+
+    async def ack_message(self, headers):
+        await self.write(encode_frame("ACK", {"message-id": headers["message-id"],
+                                              "subscription": headers["subscription"]}))
 
+    async def send(self, destination, message, headers=None):
+        message, headers = encode_payload(message, self.codecs.get(destination, self.codec), headers)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("#=- Send Message to %s. LEN=%d", destination, len(message))
+        self.sent[destination] = self.sent.get(destination, 0) + 1
+
+        frameheaders = dict(headers) if headers is not None else {}
+        frameheaders["destination"] = destination
+        try:
+            await self.write(encode_frame("SEND", frameheaders, message))
+        except Exception as e:
+            logger.error("#=- Error raised while sending: %s", e)
+            self.start_reconnect()
+
+    send_message = send
+
+    async def send_many(self, messages, transaction=False):
+        if len(messages) == 0:
+            return
+        messages = [(destination,) + encode_payload(message, self.codecs.get(destination, self.codec), headers)
+                    for destination, message, headers in messages]
+        data, counts = encode_send_frames(messages, transaction)
+        for destination, count in counts.items():
+            self.sent[destination] = self.sent.get(destination, 0) + count
+        try:
+            await self.write(data)
+        except Exception as e:
+            logger.error("#=- Error raised while sending a batch: %s", e)
+            self.start_reconnect()
+
+    async def send_batch(self, destination, messages, headers=None, transaction=False):
+        await self.send_many([(destination, message, headers) for message in messages], transaction)
+
+    async def read_loop(self):
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                self.lastreceived = time.monotonic()
+                if frame is None:
+                    continue
+                if frame[0] == "MESSAGE":
+                    await self.on_message(frame[1], frame[2])
+                elif frame[0] == "ERROR":
+                    logger.error('#=- Received an error "%s"', frame[1].get("message", frame[2]))
+                    self.errors += 1
+                    if classify_error(frame, self.fatalerrors) == "fatal":
+                        logger.error("#=- General Error. Disconnecting")
+                        asyncio.ensure_future(self.disconnect())
+                    else:
+                        self.start_reconnect()
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not self.closing:
+                logger.warning("#=- Connection lost: %s", e)
+                self.start_reconnect()
+
+    async def on_message(self, headers, body):
+        if headers.get("subscription") not in self.subscriptions:
+            # Unsubscribed while the message was in flight, the broker redelivers it.
+            logger.debug("#=- Message of a removed subscription (%s) dropped.", headers.get("subscription"))
+            return
+        message = decode_payload(body, headers, self.codecs.get(headers.get("destination"), self.codec))
+        mustack = self.ack_mode(headers.get("subscription")) != "auto"
+        if mustack and self.earlyack:
+            await self.ack_message(headers)
+
+        destination = headers.get("destination", "NA")
+        logger.debug("#=->>>> Message received (%s) PAYLOAD=%d", destination, len(body))
+        self.received[destination] = self.received.get(destination, 0) + 1
+        self.globalmessages += 1
+
+        if self.callback is None:
+            await self.messages.put((destination, message, headers, mustack and not self.earlyack, self.connections))
+            return
+
+        try:
+            await self.callback(destination, message, headers)
+        except Exception as e:
+            self.globalerrors += 1
+            logger.error(f"ERROR:{e}", exc_info=True)
+
+        if mustack and not self.earlyack:
+            await self.ack_message(headers)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.pendingack is not None:
+            headers = self.pendingack
+            self.pendingack = None
+            await self.ack_message(headers)
+        item = await self.messages.get()
+        # Unacked messages of a removed subscription or of a previous connection are redelivered by the broker.
+        while item is not None and item[3] and (item[4] != self.connections
+                                               or item[2].get("subscription") not in self.subscriptions):
+            item = await self.messages.get()
+        if item is None:
+            raise StopAsyncIteration
+        if item[3]:
+            self.pendingack = item[2]
+        return item[0], item[1], item[2]
+
+    async def heartbeat_loop(self, sendinterval, receivetimeout):
+        tick = min([val for val in (sendinterval, receivetimeout) if val > 0]) / 2
+        while True:
+            await asyncio.sleep(tick)
+            now = time.monotonic()
+            if sendinterval and now - self.lastsent >= sendinterval:
                 try:
-                    self.send_message(self,self.module["lifesign"], json.dumps(lifesignstruct))
-                except:
-                    self.send_message(self.module["lifesign"], json.dumps(lifesignstruct))
-            else:
-                logger.error(
-                    "Unable to send life sign. Target queue not defined in module parameters.")
+                    await self.write(b"\n")
+                except Exception as e:
+                    logger.warning("#=- Unable to send heartbeat: %s", e)
+            if receivetimeout and now - self.lastreceived > receivetimeout:
+                logger.warning("#=- HEART BEAT TIMEOUT ERROR")
+                self.heartbeaterrors += 1
+                self.start_reconnect()
+                return
+
+    def start_reconnect(self):
+        if self.closing or (self.reconnecting is not None and not self.reconnecting.done()):
+            return
+        self.reconnecting = asyncio.ensure_future(self.reconnect_and_listen())
+
+    async def close_connection(self):
+        current = asyncio.current_task()
+        for task in self.tasks:
+            if task is not current:
+                task.cancel()
+        self.tasks = []
+        self.pendingack = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def reconnect_and_listen(self):
+        await self.close_connection()
+        attempt = 0
+        while not self.closing:
+            attempt += 1
+            if 0 < self.reconnect["attempts"] < attempt:
+                logger.error("#=- Giving up reconnection after %d attempts.", attempt - 1)
+                return
+            delay = reconnect_delay(self.reconnect, attempt)
+            logger.debug("#=- Reconnecting: Attempt %d in %.2fs", attempt, delay)
+            await asyncio.sleep(delay)
+            try:
+                await self.create_connection()
+                return
+            except Exception as e:
+                logger.error("#=- Reconnect attempt failed: %s" % e)
+
+    async def disconnect(self):
+        logger.info("#=- Disconnecting...")
+        self.closing = True
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+        if self.pendingack is not None and self.writer is not None:
+            await self.ack_message(self.pendingack)
+            self.pendingack = None
+        try:
+            if self.writer is not None:
+                await self.write(encode_frame("DISCONNECT"))
+        except Exception:
+            logger.error("#=- Unable to disconnect.")
+        await self.close_connection()
+        if self.messages is not None:
+            await self.messages.put(None)
+
+    async def send_life_sign(self, variables=None):
+        logger.debug("#=- Send Module Life Sign.")
+        if "lifesign" in self.module:
+            lifesignstruct = self.generate_life_sign()
+            if variables is not None:
+                lifesignstruct.update(variables)
+            await self.send(self.module["lifesign"], json_encode(lifesignstruct))
         else:
-            logger.error("#=- Unable to send life sign. No listener defined.")
+            logger.error("Unable to send life sign. Target queue not defined in module parameters.")
 
     def generate_life_sign(self):
         return {
@@ -240,64 +4326,14 @@ class AMQClient():
             "module": self.module["name"],
             "version": self.module["version"],
             "alive": 1,
-            "errors": self.listener.globalerrors,
-            "internalerrors": self.listener.errors,
+            "errors": self.globalerrors,
+            "internalerrors": self.errors,
             "heartbeaterrors": self.heartbeaterrors,
-            "messages": self.listener.globalmessages,
-            "received": self.listener.received,
+            "messages": self.globalmessages,
+            "received": self.received,
             "sent": self.sent,
             "amqclientversion": amqclientversion,
             "starttimets": self.starttime.timestamp(),
             "starttime": str(self.starttime),
             "connections": self.connections
         }
-
-    def send_message(self, destination, message, headers=None):
-        logger.debug("#=- Send Message to " + destination +
-                     ". LEN=" + str(len(message)))
-        if destination not in self.sent:
-            self.sent[destination] = 1
-        else:
-            self.sent[destination] += 1
-
-        try:
-            self.conn.send(
-                body=message, destination=destination, headers=headers)
-        except Exception:            
-            
-            logger.error("#=- Error raised while sending. ")
-            logger.info("Sleeping 5 seconds and disconnects.")
-            time.sleep(5)
-            err = sys.exc_info()
-            errstr = str(err[0]) + str(err[1]) + str(err[2])
-            logger.error("ERROR:" + errstr)
-            try:
-                self.disconnect()
-            except Exception:
-                logger.error("#=- Unable to disconnect.")
-            logger.info("Sleeping 5 seconds and reconnects.")
-            time.sleep(5)
-            self.create_connection()
-
-    def heartbeat_timeout(self):
-        self.heartbeaterrors += 1
-        self.reconnect_and_listen()
-
-    def general_error(self):        
-        logger.error("#=- General Error. Exiting")
-        time.sleep(5)
-        os._exit(1)
-
-    def listener_disconnect(self):
-        self.reconnect_and_listen()
-
-    def reconnect_and_listen(self):
-        for n in range(1, 31):
-            try:
-                logger.debug("#=- Reconnecting: Attempt %d" % n)
-                time.sleep(5)
-                self.create_connection()
-
-                break
-            except Exception as e:
-                logger.error("#=- Reconnect attempt failed: %s" % e)
@@ -0,0 +1,224 @@
+"""
+Benchmark suite of amqstompclient, run against the in-process fake broker (see fakebroker.py).
+
+Each scenario (payload size x ack mode x callback cost) measures:
+    send: msgs/s and p50/p99 duration of AMQClient.send_message.
+    roundtrip: msgs/s and p50/p99 latency from send_message to the callback.
+    on_message: msgs/s and p50/p99 duration of AMQListener.on_message called with synthetic frames.
+
+The results are written as JSON so that versions can be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+The micro benchmark only measures the cost of AMQListener.on_message per message (ns/msg), with a no-op callback:
+
+    python benchmark.py --micro
+"""
+import amqstompclient
+import fakebroker
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+
+import stomp.utils
+
+logger = logging.getLogger(__name__)
+
+PAYLOAD_SIZES = [64, 4096, 65536]
+ACK_MODES = ["auto", "client-individual", "client+ackbatch"]
+CALLBACK_COSTS = [0.0, 0.001]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def statistics(durations, elapsed):
+    """
+    Summarizes a list of durations (seconds) measured during elapsed seconds.
+    """
+    return {"count": len(durations), "rate": round(len(durations) / elapsed, 1) if elapsed > 0 else None,
+            "p50_ms": round(percentile(durations, 0.5) * 1000, 4) if durations else None,
+            "p99_ms": round(percentile(durations, 0.99) * 1000, 4) if durations else None}
+
+
+def create_client(broker, destination, ackmode, prefetch, callback):
+    server = {"ip": "127.0.0.1", "port": broker.port, "login": "admin", "password": "admin",
+              "heartbeats": (0, 0)}
+    ack = ackmode
+    if ackmode == "client+ackbatch":
+        ack = "client"
+        server["ackbatch"] = {"size": min(100, prefetch), "interval": 100}
+    subscription = [{"destination": destination, "ack": ack, "prefetch": prefetch}]
+    return amqstompclient.AMQClient(server, {"name": "benchmark"}, subscription, callback=callback)
+
+
+def run_scenario(broker, size, ackmode, cost, messages, prefetch, timeout):
+    latencies = []
+    done = threading.Event()
+
+    def callback(destination, message, headers):
+        if cost:
+            time.sleep(cost)
+        if "bench-sent" in headers:
+            latencies.append(time.perf_counter() - float(headers["bench-sent"]))
+            if len(latencies) >= messages:
+                done.set()
+
+    # every scenario has its own queue so that redelivered messages do not leak into the next one
+    destination = "/queue/BENCH.%d.%s.%d" % (size, ackmode, cost * 1000000)
+    client = create_client(broker, destination, ackmode, prefetch, callback)
+    try:
+        payload = "x" * size
+        durations = []
+        start = time.perf_counter()
+        for _ in range(messages):
+            sendstart = time.perf_counter()
+            client.send_message(destination, payload, {"bench-sent": repr(sendstart)})
+            durations.append(time.perf_counter() - sendstart)
+        sendelapsed = time.perf_counter() - start
+        done.wait(timeout)
+        roundtripelapsed = time.perf_counter() - start
+
+        # on_message alone, without the network and the broker
+        listener = client.listener
+        frames = [stomp.utils.Frame("MESSAGE", {"destination": destination, "subscription": "1",
+                                                "message-id": "ID:bench-%d" % index,
+                                                "ack": "ID:bench-%d" % index}, payload)
+                  for index in range(messages)]
+        client.callback = listener.callback = lambda destination, message, headers: time.sleep(cost) if cost else None
+        ondurations = []
+        onstart = time.perf_counter()
+        for frame in frames:
+            framestart = time.perf_counter()
+            listener.on_message(frame)
+            ondurations.append(time.perf_counter() - framestart)
+        onelapsed = time.perf_counter() - onstart
+    finally:
+        client.disconnect()
+
+    return {"payload": size, "ack": ackmode, "callback_cost_ms": cost * 1000,
+            "send": statistics(durations, sendelapsed),
+            "roundtrip": statistics(latencies, roundtripelapsed),
+            "on_message": statistics(ondurations, onelapsed),
+            "lost": messages - len(latencies)}
+
+
+def run(messages=2000, sizes=PAYLOAD_SIZES, ackmodes=ACK_MODES, costs=CALLBACK_COSTS, prefetch=100,
+        latency=0.0, timeout=60):
+    """
+    Runs all the scenarios against a fresh fake broker and returns the results dictionary.
+    """
+    results = []
+    with fakebroker.FakeStompBroker(latency=latency) as broker:
+        for size in sizes:
+            for ackmode in ackmodes:
+                for cost in costs:
+                    # slow callbacks are measured on fewer messages to keep the suite short
+                    count = messages if not cost else max(1, min(messages, int(1 / cost)))
+                    result = run_scenario(broker, size, ackmode, cost, count, prefetch, timeout)
+                    logger.info("%6d bytes %-18s %5.1fms: send %s msgs/s, roundtrip %s msgs/s p99 %sms, "
+                                "on_message %s msgs/s", size, ackmode, cost * 1000, result["send"]["rate"],
+                                result["roundtrip"]["rate"], result["roundtrip"]["p99_ms"],
+                                result["on_message"]["rate"])
+                    results.append(result)
+    return {"version": amqstompclient.amqclientversion, "python": platform.python_version(),
+            "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "messages": messages, "prefetch": prefetch, "broker_latency": latency, "results": results}
+
+
+def micro(messages=200000, size=64, ackmodes=("auto", "client-individual")):
+    """
+    Measures the nanoseconds spent per message in AMQListener.on_message with a no-op callback.
+    """
+    results = {}
+    with fakebroker.FakeStompBroker() as broker:
+        for ackmode in ackmodes:
+            destination = "/queue/MICRO.%s" % ackmode
+            client = create_client(broker, destination, ackmode, 1, lambda destination, message, headers: None)
+            try:
+                frames = [stomp.utils.Frame("MESSAGE", {"destination": destination, "subscription": "1",
+                                                        "message-id": "ID:micro-%d" % index,
+                                                        "ack": "ID:micro-%d" % index}, "x" * size)
+                          for index in range(messages)]
+                on_message = client.listener.on_message
+                start = time.perf_counter()
+                for frame in frames:
+                    on_message(frame)
+                results[ackmode] = round((time.perf_counter() - start) / messages * 1e9)
+            finally:
+                client.disconnect()
+            logger.info("%-18s %6d ns/msg", ackmode, results[ackmode])
+    return {"version": amqstompclient.amqclientversion, "python": platform.python_version(),
+            "messages": messages, "payload": size, "ns_per_message": results}
+
+
+def compare(current, baseline):
+    """
+    Returns the rate ratios (current / baseline) of the scenarios present in both results.
+    """
+    def key(result):
+        return (result["payload"], result["ack"], result["callback_cost_ms"])
+
+    previous = {key(result): result for result in baseline["results"]}
+    ratios = []
+    for result in current["results"]:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        entry = {"payload": result["payload"], "ack": result["ack"],
+                 "callback_cost_ms": result["callback_cost_ms"]}
+        for stage in ("send", "roundtrip", "on_message"):
+            if result[stage]["rate"] and old[stage]["rate"]:
+                entry[stage] = round(result[stage]["rate"] / old[stage]["rate"], 3)
+        ratios.append(entry)
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="amqstompclient benchmark suite")
+    parser.add_argument("--messages", type=int, help="messages per scenario (default 2000, 200000 with --micro)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=PAYLOAD_SIZES, help="payload sizes in bytes")
+    parser.add_argument("--ack", nargs="+", default=ACK_MODES, choices=ACK_MODES, help="ack modes")
+    parser.add_argument("--costs", type=float, nargs="+", default=CALLBACK_COSTS, help="callback costs in seconds")
+    parser.add_argument("--prefetch", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0, help="broker latency in seconds")
+    parser.add_argument("--output", help="JSON result file")
+    parser.add_argument("--compare", help="JSON result file of a previous run")
+    parser.add_argument("--micro", action="store_true", help="only measure the on_message cost in ns/msg")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    amqstompclient.logger.setLevel(logging.WARNING)
+
+    if args.micro:
+        results = micro(args.messages or 200000, args.sizes[0], args.ack)
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=2)
+        return
+
+    results = run(args.messages or 2000, args.sizes, args.ack, args.costs, args.prefetch, args.latency)
+    if args.compare:
+        with open(args.compare) as file:
+            results["comparison"] = compare(results, json.load(file))
+        for entry in results["comparison"]:
+            logger.info("%s", entry)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
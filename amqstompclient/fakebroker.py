@@ -0,0 +1,510 @@
+"""
+In-process STOMP broker stand-in, used to test and benchmark the client without ActiveMQ.
+
+It implements the subset of STOMP 1.0/1.1/1.2 used by amqstompclient: queues (round robin
+between consumers) and topics (ActiveMQ wildcards > and * included), auto/client/
+client-individual acks with activemq.prefetchSize, NACK redelivery, transactions, receipts
+and heartbeats. Unacked queue messages are redelivered when a consumer disconnects.
+
+Faults can be injected while a test runs:
+    latency: seconds added to every frame sent by the broker (pipelined, not serialized).
+    pause_heartbeats: stops sending heartbeats to simulate a stalled broker.
+    rejected: destinations whose SEND frames are answered with an ERROR frame.
+    drop_connections(): closes all the client sockets.
+    send_error(message): sends an ERROR frame to all the clients and closes their connections.
+
+Selectors are accepted but not evaluated.
+
+    broker = FakeStompBroker()
+    broker.start()
+    server = {"ip": "127.0.0.1", "port": broker.port, "login": "admin", "password": "admin"}
+    ...
+    broker.stop()
+"""
+import collections
+import itertools
+import logging
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+VERSIONS = ("1.0", "1.1", "1.2")
+HEADER_ESCAPES = {"\\\\": "\\", "\\n": "\n", "\\c": ":", "\\r": "\r"}
+
+
+def escape_header(value):
+    return str(value).replace("\\", "\\\\").replace("\r", "\\r").replace("\n", "\\n").replace(":", "\\c")
+
+
+def unescape_header(value):
+    if "\\" not in value:
+        return value
+    res = []
+    index = 0
+    while index < len(value):
+        pair = value[index:index + 2]
+        if pair in HEADER_ESCAPES:
+            res.append(HEADER_ESCAPES[pair])
+            index += 2
+        else:
+            res.append(value[index])
+            index += 1
+    return "".join(res)
+
+
+def encode_frame(cmd, headers, body=b""):
+    lines = [cmd]
+    for key, value in headers.items():
+        lines.append("%s:%s" % (escape_header(key), escape_header(value)))
+    if body:
+        lines.append("content-length:%d" % len(body))
+    lines.append("\n")
+    return "\n".join(lines).encode("utf-8") + body + b"\x00"
+
+
+class FrameReader():
+    """
+    Incremental STOMP frame parser. feed returns the complete frames as (command, headers, body)
+    tuples, heartbeats being returned as None.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while True:
+            while self.buffer[:1] in (b"\n", b"\r"):
+                if self.buffer[:1] == b"\n":
+                    frames.append(None)
+                del self.buffer[:1]
+            end = self.buffer.find(b"\n\n")
+            if end < 0:
+                return frames
+            lines = self.buffer[:end].decode("utf-8").split("\n")
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.rstrip("\r").partition(":")
+                key = unescape_header(key)
+                if key not in headers:
+                    headers[key] = unescape_header(value)
+            start = end + 2
+            if "content-length" in headers:
+                stop = start + int(headers["content-length"])
+                if len(self.buffer) < stop + 1:
+                    return frames
+            else:
+                stop = self.buffer.find(b"\x00", start)
+                if stop < 0:
+                    return frames
+            body = bytes(self.buffer[start:stop])
+            del self.buffer[:stop + 1]
+            frames.append((lines[0].rstrip("\r"), headers, body))
+
+
+def destination_matches(pattern, destination):
+    """
+    Matches a destination against an ActiveMQ wildcard pattern (. separated, * for one
+    element, > for all the remaining elements).
+    """
+    if pattern == destination:
+        return True
+    patternparts = pattern.split(".")
+    parts = destination.split(".")
+    for index, part in enumerate(patternparts):
+        if part == ">":
+            return True
+        if index >= len(parts) or (part != "*" and part != parts[index]):
+            return False
+    return len(parts) == len(patternparts)
+
+
+class FakeMessage():
+    __slots__ = ("destination", "headers", "body", "redeliveries")
+
+    def __init__(self, destination, headers, body):
+        self.destination = destination
+        self.headers = headers
+        self.body = body
+        self.redeliveries = 0
+
+
+class FakeSubscription():
+    __slots__ = ("session", "id", "destination", "ack", "prefetch", "unacked", "pending")
+
+    def __init__(self, session, id, destination, ack, prefetch):
+        self.session = session
+        self.id = id
+        self.destination = destination
+        self.ack = ack
+        self.prefetch = max(1, prefetch)
+        self.unacked = collections.OrderedDict()
+        self.pending = collections.deque()
+
+    def has_capacity(self):
+        return self.ack == "auto" or len(self.unacked) < self.prefetch
+
+
+class FakeSession(socketserver.BaseRequestHandler):
+    """
+    One client connection of the fake broker.
+    """
+
+    def setup(self):
+        self.broker = self.server.broker
+        self.version = "1.0"
+        self.clientid = None
+        self.subscriptions = {}
+        self.transactions = {}
+        self.outgoing = queue.Queue()
+        self.lastread = time.monotonic()
+        self.lastwrite = time.monotonic()
+        self.sendinterval = 0
+        self.receivetimeout = 0
+        self.closed = False
+        self.writer = threading.Thread(target=self.write_loop, name="fakebroker-writer", daemon=True)
+        self.writer.start()
+
+    def handle(self):
+        self.broker.register(self)
+        reader = FrameReader()
+        try:
+            while not self.closed:
+                data = self.request.recv(65536)
+                if not data:
+                    break
+                self.lastread = time.monotonic()
+                for frame in reader.feed(data):
+                    if frame is not None and not self.process(*frame):
+                        return
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def finish(self):
+        self.close()
+        self.writer.join(5)
+
+    def close(self, flush=True):
+        """
+        Closes the connection, once the queued frames are written if flush is set.
+        """
+        if not self.closed:
+            self.closed = True
+            self.outgoing.put(None)
+            self.broker.unregister(self)
+        if not flush:
+            self.shutdown()
+
+    def shutdown(self):
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send_frame(self, cmd, headers, body=b""):
+        if self.version == "1.0":
+            data = ("\n".join([cmd] + ["%s:%s" % entry for entry in headers.items()]
+                              + (["content-length:%d" % len(body)] if body else []) + ["\n"])).encode("utf-8")
+            data += body + b"\x00"
+        else:
+            data = encode_frame(cmd, headers, body)
+        self.outgoing.put((time.monotonic() + self.broker.latency, data))
+
+    def write_loop(self):
+        while True:
+            try:
+                item = self.outgoing.get(timeout=min(self.sendinterval or 3600, self.receivetimeout or 3600) / 2)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                self.shutdown()
+                return
+            try:
+                if item:
+                    delay = item[0] - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.request.sendall(item[1])
+                    self.lastwrite = time.monotonic()
+                now = time.monotonic()
+                if self.sendinterval and now - self.lastwrite >= self.sendinterval \
+                        and not self.broker.pause_heartbeats:
+                    self.request.sendall(b"\n")
+                    self.lastwrite = now
+                if self.receivetimeout and now - self.lastread > self.receivetimeout:
+                    logger.info("fakebroker: client heartbeat timeout")
+                    self.close(flush=False)
+            except OSError:
+                self.close(flush=False)
+
+    def process(self, cmd, headers, body):
+        if cmd in ("CONNECT", "STOMP"):
+            return self.connect(headers)
+
+        transaction = headers.get("transaction")
+        if transaction is not None and cmd in ("SEND", "ACK", "NACK"):
+            if transaction not in self.transactions:
+                self.error("Unknown transaction %s" % transaction, headers)
+                return False
+            self.transactions[transaction].append((cmd, headers, body))
+        elif cmd == "SEND":
+            if headers.get("destination") in self.broker.rejected:
+                self.error("Destination %s rejected" % headers.get("destination"), headers)
+                return False
+            self.broker.publish(headers, body)
+        elif cmd == "SUBSCRIBE":
+            subscription = FakeSubscription(self, headers.get("id", headers["destination"]), headers["destination"],
+                                            headers.get("ack", "auto"),
+                                            int(headers.get("activemq.prefetchSize", 1000)))
+            self.subscriptions[subscription.id] = subscription
+            self.broker.subscribe(subscription)
+        elif cmd == "UNSUBSCRIBE":
+            subscription = self.subscriptions.pop(headers.get("id", headers.get("destination")), None)
+            if subscription is not None:
+                self.broker.unsubscribe(subscription)
+        elif cmd in ("ACK", "NACK"):
+            self.broker.acknowledge(self, cmd, headers)
+        elif cmd == "BEGIN":
+            self.transactions[headers["transaction"]] = []
+        elif cmd == "COMMIT":
+            for entry in self.transactions.pop(headers["transaction"], []):
+                entry[1].pop("transaction", None)
+                self.process(*entry)
+        elif cmd == "ABORT":
+            self.transactions.pop(headers["transaction"], None)
+        elif cmd == "DISCONNECT":
+            self.receipt(headers)
+            return False
+        self.receipt(headers)
+        return True
+
+    def connect(self, headers):
+        accepted = headers.get("accept-version", "1.0").split(",")
+        self.version = max([version for version in VERSIONS if version in accepted] or ["1.0"])
+        self.clientid = headers.get("client-id")
+        connected = {"version": self.version, "server": "fakebroker/1.0",
+                     "session": "session-%d" % next(self.broker.ids)}
+        if self.version != "1.0":
+            clientbeats = [int(val) for val in headers.get("heart-beat", "0,0").split(",")]
+            brokerbeats = self.broker.heartbeats
+            if clientbeats[1] and brokerbeats[0]:
+                self.sendinterval = max(clientbeats[1], brokerbeats[0]) / 1000.0
+            if clientbeats[0] and brokerbeats[1]:
+                self.receivetimeout = max(clientbeats[0], brokerbeats[1]) * 2 / 1000.0
+            connected["heart-beat"] = "%d,%d" % tuple(brokerbeats)
+        self.send_frame("CONNECTED", connected)
+        self.outgoing.put(())
+        return True
+
+    def receipt(self, headers):
+        if "receipt" in headers:
+            self.send_frame("RECEIPT", {"receipt-id": headers["receipt"]})
+
+    def error(self, message, headers):
+        errorheaders = {"message": message}
+        if "receipt" in headers:
+            errorheaders["receipt-id"] = headers["receipt"]
+        self.broker.stats["errors"] += 1
+        self.send_frame("ERROR", errorheaders, message.encode("utf-8"))
+
+    def deliver(self, subscription, message):
+        headers = dict(message.headers)
+        headers["destination"] = message.destination
+        headers["subscription"] = subscription.id
+        if message.redeliveries > 0:
+            headers["redelivered"] = "true"
+        if self.version == "1.2":
+            headers["ack"] = headers["message-id"]
+        self.send_frame("MESSAGE", headers, message.body)
+
+
+class FakeServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeStompBroker():
+    """
+    FakeStompBroker runs a STOMP broker stand-in in background threads.
+
+    Args:
+        host (str, optional): Listening address. Default is 127.0.0.1.
+        port (int, optional): Listening port, 0 for a free port. Default is 0.
+        heartbeats (tuple, optional): Heartbeats (send, receive) offered by the broker in ms.
+        latency (float, optional): Seconds added to every frame sent by the broker.
+
+    Attributes:
+        port (int): The listening port, once started.
+        stats (dict): Number of published, delivered, acked, nacked and redelivered messages,
+            of errors and of connections.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, heartbeats=(0, 0), latency=0.0):
+        self.host = host
+        self.port = port
+        self.heartbeats = heartbeats
+        self.latency = latency
+        self.pause_heartbeats = False
+        self.rejected = set()
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.queues = collections.defaultdict(collections.deque)
+        self.subscriptions = []
+        self.sessions = []
+        self.roundrobin = collections.defaultdict(int)
+        self.stats = collections.Counter()
+        self.server = None
+
+    def start(self):
+        self.server = FakeServer((self.host, self.port), FakeSession)
+        self.server.broker = self
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name="fakebroker", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.drop_connections()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def drop_connections(self):
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.close(flush=False)
+
+    def send_error(self, message):
+        """
+        Sends an ERROR frame to all the clients and closes their connections, as brokers do.
+        """
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.error(message, {})
+            session.close()
+
+    def queue_depth(self, destination):
+        with self.lock:
+            return len(self.queues.get(destination, ()))
+
+    def register(self, session):
+        with self.lock:
+            self.sessions.append(session)
+            self.stats["connections"] += 1
+
+    def unregister(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+            for subscription in list(session.subscriptions.values()):
+                self.unsubscribe(subscription)
+            session.subscriptions = {}
+
+    def subscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.append(subscription)
+            if not subscription.destination.startswith("/topic/"):
+                self.pump(subscription.destination)
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+            if not subscription.destination.startswith("/topic/"):
+                # Unacked messages go back to the queue, in order.
+                for message in reversed(list(subscription.unacked.values())):
+                    message.redeliveries += 1
+                    self.stats["redelivered"] += 1
+                    self.queues[subscription.destination].appendleft(message)
+                subscription.unacked.clear()
+                self.pump(subscription.destination)
+
+    def publish(self, headers, body):
+        headers = dict(headers)
+        destination = headers.pop("destination")
+        headers.pop("content-length", None)
+        headers.pop("receipt", None)
+        headers["message-id"] = "ID:fakebroker-%d" % next(self.ids)
+        headers["timestamp"] = str(int(time.time() * 1000))
+        message = FakeMessage(destination, headers, body)
+        with self.lock:
+            self.stats["published"] += 1
+            if destination.startswith("/topic/"):
+                for subscription in self.subscriptions:
+                    if destination_matches(subscription.destination, destination):
+                        subscription.pending.append(message)
+                        self.pump_topic(subscription)
+            else:
+                self.queues[destination].append(message)
+                self.pump(destination)
+
+    def send(self, subscription, message):
+        if subscription.ack != "auto":
+            subscription.unacked[message.headers["message-id"]] = message
+        self.stats["delivered"] += 1
+        subscription.session.deliver(subscription, message)
+
+    def pump(self, destination):
+        messages = self.queues.get(destination)
+        if not messages:
+            return
+        consumers = [subscription for subscription in self.subscriptions if subscription.destination == destination]
+        while messages and consumers:
+            available = [subscription for subscription in consumers if subscription.has_capacity()]
+            if not available:
+                return
+            index = self.roundrobin[destination] % len(available)
+            self.roundrobin[destination] += 1
+            self.send(available[index], messages.popleft())
+
+    def pump_topic(self, subscription):
+        while subscription.pending and subscription.has_capacity():
+            self.send(subscription, subscription.pending.popleft())
+
+    def acknowledge(self, session, cmd, headers):
+        messageid = headers.get("id") if session.version == "1.2" else headers.get("message-id")
+        with self.lock:
+            subscriptions = list(session.subscriptions.values())
+            if "subscription" in headers and headers["subscription"] in session.subscriptions:
+                subscriptions = [session.subscriptions[headers["subscription"]]]
+            for subscription in subscriptions:
+                if messageid not in subscription.unacked:
+                    continue
+                if subscription.ack == "client":
+                    # Cumulative ack: all the messages delivered before are acknowledged too.
+                    acked = []
+                    for key in list(subscription.unacked.keys()):
+                        acked.append(subscription.unacked.pop(key))
+                        if key == messageid:
+                            break
+                else:
+                    acked = [subscription.unacked.pop(messageid)]
+                if cmd == "ACK":
+                    self.stats["acked"] += len(acked)
+                else:
+                    self.stats["nacked"] += len(acked)
+                    if not subscription.destination.startswith("/topic/"):
+                        for message in reversed(acked):
+                            message.redeliveries += 1
+                            self.stats["redelivered"] += 1
+                            self.queues[subscription.destination].appendleft(message)
+                if subscription.destination.startswith("/topic/"):
+                    self.pump_topic(subscription)
+                else:
+                    self.pump(subscription.destination)
+                return
@@ -6,7 +6,8 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s.%(msecs)03d %(level
 logger = logging.getLogger()
 
 server={"ip":"localhost","port":"61613","login":"admin"
-,"password":"******","heartbeats":(10000,10000),"earlyack":True}
+,"password":"******","heartbeats":(10000,10000),"earlyack":True
+,"dispatcher":{"workers":4,"queue":10}}
 
 def mymessage(destination,message,headers):
     
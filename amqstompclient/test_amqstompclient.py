@@ -1,7 +1,17 @@
 import amqstompclient
+import fakebroker
 import unittest
+import asyncio
+import json
 import logging
+import functools
+import os
+import queue
+import stomp
+import tempfile
+import threading
 import time
+import types
 
 #git tag 1.0.1 -m "PyPi tag"
 #git push --tags origin master
@@ -289,6 +299,1272 @@ class TestClient(unittest.TestCase):
             conn1.disconnect()
             conn2.disconnect()
 
+class TestSubscriptionSpec(unittest.TestCase):
+    """
+    Test subscription spec parsing
+    """
+
+    def test_legacy_string(self):
+        """
+        String subscriptions keep the client ack / prefetch 1 defaults
+        """
+        spec=amqstompclient.parse_subscription("/queue/QTEST1")
+        self.assertEqual(spec["destination"], "/queue/QTEST1")
+        self.assertEqual(spec["ack"], "client")
+        self.assertEqual(spec["prefetch"], 1)
+        self.assertEqual(amqstompclient.parse_subscription(""), None)
+
+    def test_dict_spec(self):
+        """
+        Dictionary subscriptions
+        """
+        spec=amqstompclient.parse_subscription({"destination":"/queue/QTEST1","prefetch":200
+                ,"ack":"client-individual","selector":"type='A'","headers":{"activemq.priority":5}})
+        self.assertEqual(spec["prefetch"], 200)
+        self.assertEqual(spec["ack"], "client-individual")
+        self.assertEqual(spec["selector"], "type='A'")
+        self.assertEqual(spec["headers"], {"activemq.priority":5})
+
+        with self.assertRaises(ValueError):
+            amqstompclient.parse_subscription({"destination":"/queue/QTEST1","ack":"never"})
+
+class RecordingConnection():
+    """
+    Stomp connection stand-in recording the acks
+    """
+    def __init__(self):
+        self.acks=[]
+
+    def ack(self, id, subscription):
+        self.acks.append((id,subscription))
+
+class RecordingClient():
+    def __init__(self):
+        self.conn=RecordingConnection()
+
+class TestAckBatcher(unittest.TestCase):
+    """
+    Test cumulative ack batching
+    """
+
+    def test_batch_size(self):
+        """
+        One ack every size messages
+        """
+        client=RecordingClient()
+        batcher=amqstompclient.AMQAckBatcher(client,size=3,interval=60000)
+        try:
+            for i in range(1,8):
+                batcher.add("m%d" %(i),"1","/queue/QTEST1")
+            self.assertEqual(client.conn.acks, [("m3","1"),("m6","1")])
+            self.assertEqual(batcher.pending(), {"/queue/QTEST1":1})
+        finally:
+            batcher.stop()
+        self.assertEqual(client.conn.acks[-1], ("m7","1"))
+        self.assertEqual(batcher.pending(), {})
+
+    def test_batch_interval(self):
+        """
+        Pending acks are flushed by the timer
+        """
+        client=RecordingClient()
+        batcher=amqstompclient.AMQAckBatcher(client,size=100,interval=50)
+        try:
+            batcher.add("m1","1","/queue/QTEST1")
+            batcher.add("m2","2","/queue/QTEST2")
+            time.sleep(0.3)
+            self.assertEqual(sorted(client.conn.acks), [("m1","1"),("m2","2")])
+        finally:
+            batcher.stop()
+
+class TestDispatcher(unittest.TestCase):
+    """
+    Test the worker pool dispatcher
+    """
+
+    def test_ordering(self):
+        """
+        Jobs sharing a key run in order, other keys run in parallel
+        """
+        dispatcher=amqstompclient.AMQDispatcher(workers=4,queuesize=2)
+        results={"1":[],"2":[]}
+
+        def job(key,i):
+            if key=="1":
+                time.sleep(0.01)
+            results[key].append(i)
+
+        start=time.time()
+        for i in range(0,20):
+            dispatcher.submit("1",job,"1",i)
+            dispatcher.submit("2",job,"2",i)
+        dispatcher.stop()
+
+        self.assertEqual(results["1"], list(range(0,20)))
+        self.assertEqual(results["2"], list(range(0,20)))
+        self.assertTrue(dispatcher.saturated > 0)
+        self.assertTrue(time.time()-start < 1)
+
+    def test_stop_timeout(self):
+        """
+        stop returns after its timeout and abandons the queued jobs
+        """
+        dispatcher=amqstompclient.AMQDispatcher(workers=1,queuesize=10)
+        results=[]
+        for i in range(0,10):
+            dispatcher.submit("1",lambda i:(time.sleep(0.2),results.append(i)),i)
+        start=time.time()
+        dispatcher.stop(0.1)
+        self.assertTrue(time.time()-start < 0.5)
+        self.assertTrue(wait_for(lambda:not dispatcher.threads[0].is_alive()))
+        self.assertEqual(results,[0])
+        self.assertEqual(dispatcher.abandoned,9)
+
+    def test_process_mode(self):
+        """
+        Raw bodies are copied to bytes for the process workers, message views are rejected
+        """
+        dispatcher=amqstompclient.AMQDispatcher(workers=1,mode="process")
+        results=[]
+        dispatcher.submit("1",lambda:results.append(dispatcher.call(bytes,memoryview(b"RAW"))))
+        dispatcher.submit("1",lambda:results.append(dispatcher.call(len,[memoryview(b"A"),memoryview(b"B")])))
+        dispatcher.stop(10)
+        self.assertEqual(results,[b"RAW",2])
+        self.assertRaises(ValueError,amqstompclient.AMQClient
+            ,{"ip":"127.0.0.1","port":1,"login":"admin","password":"admin","messageview":True
+            ,"dispatcher":{"mode":"process"}},{"name":"TEST"},["/queue/QTEST1"])
+
+class TestEndpoints(unittest.TestCase):
+    """
+    Test the broker endpoints parsing
+    """
+
+    def test_endpoints(self):
+        """
+        Single broker and network of brokers
+        """
+        self.assertEqual(amqstompclient.parse_endpoints(server), [("localhost",61613)])
+        self.assertEqual(amqstompclient.parse_endpoints({"hosts":["amq1:61613",("amq2","61614"),{"ip":"amq3","port":61615}]})
+                , [("amq1",61613),("amq2",61614),("amq3",61615)])
+
+class TestCodecs(unittest.TestCase):
+    """
+    Test the payload codecs
+    """
+
+    def roundtrip(self, codec, message):
+        codec=amqstompclient.parse_codec(codec)
+        body,headers=amqstompclient.encode_payload(message,codec)
+        if isinstance(body,str):
+            body=body.encode("utf-8")
+        return amqstompclient.decode_payload(body,headers or {},codec),headers
+
+    def test_codecs(self):
+        """
+        Text, raw, json and compressed payloads
+        """
+        self.assertEqual(self.roundtrip("text","0123456789"), ("0123456789",None))
+        message,headers=self.roundtrip("raw",b"\x00\x01\x02")
+        self.assertTrue(isinstance(message,memoryview))
+        self.assertEqual(bytes(message), b"\x00\x01\x02")
+        message,headers=self.roundtrip("json",{"myvalue1":100,"myvalue2":"petitlapin"})
+        self.assertEqual(message, {"myvalue1":100,"myvalue2":"petitlapin"})
+        self.assertEqual(headers["content-type"], "application/json")
+        message,headers=self.roundtrip("json+zlib",{"values":list(range(0,1000))})
+        self.assertEqual(message, {"values":list(range(0,1000))})
+        self.assertEqual(headers["content-encoding"], "zlib")
+
+        with self.assertRaises(ValueError):
+            amqstompclient.parse_codec("xml")
+        with self.assertRaises(ValueError):
+            amqstompclient.parse_codec("json+brotli")
+
+class TestMetrics(unittest.TestCase):
+    """
+    Test the metrics
+    """
+
+    def test_metrics(self):
+        """
+        Counters, quantiles and Prometheus rendering
+        """
+        metrics=amqstompclient.AMQMetrics()
+        for i in range(0,100):
+            metrics.observe_received("/queue/QTEST1",10)
+            metrics.observe_callback("/queue/QTEST1",0.002 if i<90 else 0.2)
+        metrics.observe_sent("/topic/TTEST1",5,50,0.0001)
+        metrics.observe_reconnect(1.5)
+
+        summary=metrics.summary()
+        self.assertEqual(summary["destinations"]["/queue/QTEST1"]["received"], 100)
+        self.assertEqual(summary["destinations"]["/queue/QTEST1"]["receivedbytes"], 1000)
+        self.assertEqual(summary["destinations"]["/queue/QTEST1"]["callbackp50"], 0.0025)
+        self.assertEqual(summary["destinations"]["/queue/QTEST1"]["callbackp99"], 0.25)
+        self.assertEqual(summary["destinations"]["/topic/TTEST1"]["sent"], 5)
+        self.assertEqual(summary["reconnects"], 1)
+
+        text=metrics.render()
+        self.assertTrue('amq_received_messages_total{destination="/queue/QTEST1"} 100' in text)
+        self.assertTrue('amq_callback_seconds_bucket{destination="/queue/QTEST1",le="+Inf"} 100' in text)
+        self.assertTrue(text.endswith("# EOF\n"))
+
+        metrics.observe_received('/queue/Q"A\\B\nC',10)
+        text=metrics.render()
+        self.assertIn('amq_received_messages_total{destination="/queue/Q\\"A\\\\B\\nC"} 1\n',text)
+        self.assertIn('amq_callback_seconds_count{destination="/queue/Q\\"A\\\\B\\nC"} 0\n',text)
+
+class LifeSignClient():
+    """
+    Client stand-in generating lifesigns from plain counters
+    """
+    def __init__(self):
+        self.module={"name":"TEST","version":"1.0.0","lifesign":"/topic/RPN_MODULE_INFO"}
+        self.received={}
+        self.sent={}
+        self.messages=[]
+
+    def generate_life_sign(self):
+        return {"module":"TEST","version":"1.0.0","errors":0,"messages":sum(self.received.values())
+                ,"received":self.received,"sent":self.sent}
+
+    def send_message(self, destination, message):
+        self.messages.append(json.loads(message))
+
+class TestLifeSigner(unittest.TestCase):
+    """
+    Test the background lifesign deltas
+    """
+
+    def test_deltas(self):
+        """
+        Full, delta, skipped and periodic full lifesigns
+        """
+        client=LifeSignClient()
+        signer=amqstompclient.AMQLifeSigner(client,3600,full=4,top=2)
+        try:
+            client.received["/queue/QTEST1"]=10
+            signer.beat()
+            self.assertEqual(client.messages[-1]["full"], True)
+            self.assertEqual(client.messages[-1]["received"], {"/queue/QTEST1":10})
+
+            client.received["/queue/QTEST1"]=15
+            client.received["/queue/QTEST2"]=20
+            client.received["/queue/QTEST3"]=1
+            signer.beat()
+            self.assertEqual(client.messages[-1]["full"], False)
+            self.assertEqual(client.messages[-1]["received"], {"/queue/QTEST2":20,"/queue/QTEST1":5})
+            self.assertEqual(client.messages[-1]["messages"], 26)
+
+            signer.beat()
+            signer.beat()
+            self.assertEqual(len(client.messages), 2)
+            self.assertEqual(signer.skipped, 2)
+
+            signer.beat()
+            self.assertEqual(client.messages[-1]["full"], True)
+        finally:
+            signer.stop()
+
+class TestReconnectDelay(unittest.TestCase):
+    """
+    Test the reconnection backoff
+    """
+
+    def test_backoff(self):
+        """
+        Exponential, capped and jittered
+        """
+        reconnect={"initial":0.5,"max":30.0,"factor":2.0,"jitter":0.2,"attempts":0}
+        for i in range(0,100):
+            self.assertTrue(0.4 <= amqstompclient.reconnect_delay(reconnect,1) <= 0.6)
+            self.assertTrue(3.2 <= amqstompclient.reconnect_delay(reconnect,4) <= 4.8)
+            self.assertTrue(24 <= amqstompclient.reconnect_delay(reconnect,20) <= 36)
+
+class TestTimerWheel(unittest.TestCase):
+    """
+    Test the timer wheel of the delayed retries
+    """
+
+    def test_schedule(self):
+        """
+        Jobs run in delay order, including delays longer than a turn of the wheel
+        """
+        wheel=amqstompclient.AMQTimerWheel(tick=0.01,slots=8)
+        fired=[]
+        try:
+            for delay in [0.25,0.05,0.12]:
+                wheel.schedule(delay,fired.append,delay)
+            self.assertEqual(wheel.pending(),3)
+            time.sleep(0.5)
+            self.assertEqual(fired,[0.05,0.12,0.25])
+            self.assertEqual(wheel.pending(),0)
+        finally:
+            wheel.stop()
+
+class TestJournal(unittest.TestCase):
+    """
+    Test the memory-mapped outbox journal
+    """
+
+    def test_segments(self):
+        """
+        Records survive a reopen, roll over segments, and confirmed segments are removed
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            journal=amqstompclient.AMQJournal(directory,segmentsize=1024,fsync="always",interval=10,maxdisk=2048)
+            for i in range(0,20):
+                journal.append("/queue/QTEST1","MESSAGE %d" % i,{"myvalue":i})
+            journal.append("/queue/QTEST1","X"*900)
+            journal.append("/queue/QTEST2",b"\x00\x01")
+            self.assertRaises(amqstompclient.AMQOutboxFull,journal.append,"/queue/QTEST1","X"*900)
+            self.assertEqual(journal.depth(),22)
+            journal.close()
+
+            journal=amqstompclient.AMQJournal(directory,segmentsize=1024,interval=10,maxdisk=2048)
+            position=journal.head
+            records=[]
+            while True:
+                record=journal.read(position)
+                if record is None:
+                    break
+                position=record[0]
+                records.append(record[1:])
+            self.assertEqual(journal.depth(),22)
+            self.assertEqual(records[0],("/queue/QTEST1","MESSAGE 0",{"myvalue":0}))
+            self.assertEqual(records[21],("/queue/QTEST2",b"\x00\x01",{}))
+            self.assertEqual(position[0],1)
+
+            journal.truncate(position,22)
+            journal.commit()
+            self.assertEqual(len(os.listdir(directory)),2)
+            journal.close()
+            journal=amqstompclient.AMQJournal(directory,segmentsize=1024,interval=10)
+            self.assertEqual(journal.depth(),0)
+            journal.close()
+
+    def test_torn_write(self):
+        """
+        A corrupted record ends the journal
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            journal=amqstompclient.AMQJournal(directory,segmentsize=1024,interval=10)
+            for i in range(0,3):
+                journal.append("/queue/QTEST1","MESSAGE %d" % i)
+            journal.close()
+            with open(os.path.join(directory,"outbox-000000000000.seg"),"r+b") as file:
+                file.seek(60)
+                file.write(b"\xff")
+            journal=amqstompclient.AMQJournal(directory,segmentsize=1024,interval=10)
+            self.assertEqual(journal.depth(),1)
+            journal.close()
+
+class TestRouter(unittest.TestCase):
+    """
+    Test the content-based router
+    """
+
+    def test_routes(self):
+        """
+        Wildcards, header conditions, registration order and default callback
+        """
+        handled=[]
+        def handler(name):
+            return lambda destination,message,headers:handled.append((name,message))
+
+        router=amqstompclient.AMQRouter(handler("default"))
+        router.add("/topic/PRICE.STOCK.>",handler("trade"),{"type":"trade"})
+        router.add("/topic/PRICE.*.NASDAQ",handler("nasdaq"))
+        router.add("/topic/PRICE.>",handler("big"),{"size":lambda value:value is not None and int(value)>100})
+        router.add("/topic/PRICE.>",handler("any"),name="any")
+        for i in range(0,1000):
+            router.add("/topic/OTHER.%d" % i,handler("other"),{"type":"trade"})
+
+        router("/topic/PRICE.STOCK.NASDAQ","A",{"type":"trade"})
+        router("/topic/PRICE.STOCK.NASDAQ","B",{"type":"quote"})
+        router("/topic/PRICE.BOND.NYSE","C",{"size":"500"})
+        router("/topic/PRICE","D",{})
+        router("/topic/NEWS.STOCK","E",{"type":"trade"})
+        self.assertEqual(handled,[("trade","A"),("nasdaq","B"),("big","C"),("any","D"),("default","E")])
+        self.assertEqual(router.hits["/topic/PRICE.STOCK.>[type=trade]"],1)
+        self.assertEqual(router.hits["any"],1)
+        self.assertEqual(router.unrouted,1)
+        self.assertRaises(ValueError,router.add,"/topic/PRICE.>",handler("any"),name="any")
+
+        self.assertTrue(router.remove("/topic/PRICE.*.NASDAQ"))
+        self.assertFalse(router.remove("/topic/PRICE.*.NASDAQ"))
+        router("/topic/PRICE.STOCK.NASDAQ","F",{"type":"quote"})
+        self.assertEqual(handled[-1],("any","F"))
+        indexed,unindexed=router.table("/topic/OTHER.5")
+        self.assertEqual(len(indexed["type"]["trade"]),1)
+
+class TestDeduplicator(unittest.TestCase):
+    """
+    Test the duplicate detection
+    """
+
+    def test_lru(self):
+        """
+        The most recent keys are remembered, the oldest evicted
+        """
+        dedup=amqstompclient.AMQDeduplicator({"size":100})
+        for i in range(0,150):
+            dedup.add("ID:%d" % i)
+        self.assertTrue(dedup.seen("ID:149"))
+        self.assertTrue(dedup.seen("ID:50"))
+        self.assertFalse(dedup.seen("ID:49"))
+        self.assertEqual(dedup.stats(),{"hits":2,"misses":1,"evictions":50,"entries":100})
+
+        dedup=amqstompclient.AMQDeduplicator({"size":100,"window":0.05})
+        dedup.add("ID:1")
+        time.sleep(0.1)
+        self.assertFalse(dedup.seen("ID:1"))
+
+    def test_bloom(self):
+        """
+        The rotating Bloom filters keep between size and twice size keys in a fixed memory
+        """
+        dedup=amqstompclient.AMQDeduplicator({"mode":"bloom","size":1000,"errorrate":0.001})
+        for i in range(0,5000):
+            dedup.add("ID:%d" % i)
+        self.assertTrue(all(dedup.seen("ID:%d" % i) for i in range(4000,5000)))
+        false=sum(1 for i in range(0,3000) if dedup.seen("ID:%d" % i))
+        self.assertTrue(false<30)
+        self.assertEqual(dedup.entries(),1000+1000)
+        self.assertEqual(dedup.evictions,3000)
+
+class TestFrames(unittest.TestCase):
+    """
+    Test the asyncio frame codec
+    """
+
+    def test_roundtrip(self):
+        """
+        Encode and read back frames, heartbeats and escaped headers
+        """
+        async def roundtrip():
+            reader=asyncio.StreamReader()
+            reader.feed_data(encode_frame("SEND",{"destination":"/queue/QTEST1","myvalue":"a:b\nc","crvalue":"a\r\nb\\r"},"0123456789"*10))
+            reader.feed_data(b"\n")
+            reader.feed_data(encode_frame("RECEIPT",{"receipt-id":"12"}))
+            reader.feed_eof()
+            return [await read_frame(reader),await read_frame(reader),await read_frame(reader)]
+
+        encode_frame=amqstompclient.encode_frame
+        read_frame=amqstompclient.read_frame
+        frames=asyncio.run(roundtrip())
+
+        self.assertEqual(frames[0][0], "SEND")
+        self.assertEqual(frames[0][1]["myvalue"], "a:b\nc")
+        self.assertEqual(frames[0][1]["crvalue"], "a\r\nb\\r")
+        self.assertNotIn(b"\r", encode_frame("SEND",{"crvalue":"a\r\nb"}))
+        self.assertEqual(frames[0][2], b"0123456789"*10)
+        self.assertEqual(frames[1], None)
+        self.assertEqual(frames[2], ("RECEIPT",{"receipt-id":"12"},b""))
+
+    def test_send_frames(self):
+        """
+        Batches are encoded as consecutive SEND frames inside a transaction
+        """
+        async def readall(data):
+            reader=asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return [await amqstompclient.read_frame(reader) for i in range(0,5)]
+
+        data,counts=amqstompclient.encode_send_frames([("/queue/QTEST1","A",None),("/queue/QTEST1","B",{"myvalue1":100})
+                ,("/topic/TTEST1","C",None)],transaction=True)
+        frames=asyncio.run(readall(data))
+
+        self.assertEqual(counts, {"/queue/QTEST1":2,"/topic/TTEST1":1})
+        self.assertEqual([frame[0] for frame in frames], ["BEGIN","SEND","SEND","SEND","COMMIT"])
+        self.assertEqual(frames[2][1]["myvalue1"], "100")
+        self.assertEqual(frames[3][2], b"C")
+        self.assertEqual(len(set(frame[1]["transaction"] for frame in frames)), 1)
+
+    def test_write_frames(self):
+        """
+        Encoded frames are written on the socket, or queued for the receiver thread of stomp.py 9 TLS connections
+        """
+        class Transport():
+            def __init__(self,**attributes):
+                self.sent=[]
+                self.__dict__.update(attributes)
+            def send(self,data):
+                self.sent.append(data)
+
+        for attributes,direct in (({},True),({"blocking":None},True),({"blocking":True},True)
+                ,({"blocking":False,"send_queue":queue.Queue()},False)):
+            transport=Transport(**attributes)
+            client=types.SimpleNamespace(conn=types.SimpleNamespace(transport=transport))
+            amqstompclient.AMQClient.write_frames(client,b"FRAMES")
+            self.assertEqual(transport.sent,[b"FRAMES"] if direct else [])
+            if not direct:
+                self.assertEqual(transport.send_queue.get_nowait(),b"FRAMES")
+
+def wait_for(predicate, timeout=5):
+    end=time.monotonic()+timeout
+    while not predicate() and time.monotonic()<end:
+        time.sleep(0.01)
+    return predicate()
+
+def crash_once(marker,destination,message,headers):
+    """
+    Worker callback: the first worker receiving CRASH exits, the redelivery is handled by a restarted one
+    """
+    if message=="CRASH" and not os.path.exists(marker):
+        open(marker,"w").close()
+        os._exit(3)
+
+class TestFakeBroker(unittest.TestCase):
+    """
+    Test the client against the in-process fake broker
+    """
+
+    def setUp(self):
+        self.broker=fakebroker.FakeStompBroker(heartbeats=(1000,1000)).start()
+        self.server={"ip":"127.0.0.1","port":self.broker.port,"login":"admin","password":"admin"
+            ,"heartbeats":(1000,1000),"reconnect":{"initial":0.1}}
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def test_sendreceive(self):
+        """
+        Queue and topic messages reach the callback and are acknowledged
+        """
+        messages=[]
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"}
+            ,[{"destination":"/queue/QTEST1","ack":"client-individual","prefetch":5},"/topic/TTEST.>"]
+            ,callback=lambda destination,message,headers:messages.append((destination,message)))
+        try:
+            for i in range(0,20):
+                conn.send_message("/queue/QTEST1","MESSAGE%d" %(i))
+            conn.send_message("/topic/TTEST.A","TOPIC")
+            self.assertTrue(wait_for(lambda:len(messages)==21))
+            self.assertEqual(messages[0],("/queue/QTEST1","MESSAGE0"))
+            self.assertIn(("/topic/TTEST.A","TOPIC"),messages)
+            self.assertTrue(wait_for(lambda:self.broker.stats["acked"]==21),self.broker.stats)
+        finally:
+            conn.disconnect()
+
+    def test_custom_listener(self):
+        """
+        Listener classes only need the stomp.py interface and the lifesign counters
+        """
+        messages=[]
+        class Listener(stomp.ConnectionListener):
+            def __init__(self,amqconn,callback):
+                self.globalerrors=self.errors=self.globalmessages=0
+                self.received={}
+            def on_message(self,frame):
+                messages.append(frame.body)
+
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"}
+            ,[{"destination":"/queue/QTEST1","ack":"auto"}],callback=None,listener_class=Listener)
+        try:
+            conn.send_message("/queue/QTEST1","MESSAGE")
+            self.assertTrue(wait_for(lambda:messages==["MESSAGE"]))
+            self.assertEqual(conn.generate_life_sign()["sent"],{"/queue/QTEST1":1})
+        finally:
+            conn.disconnect()
+
+    def test_prefetch(self):
+        """
+        The broker does not deliver more unacked messages than the prefetch
+        """
+        messages=[]
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"}
+            ,[{"destination":"/queue/QTEST1","ack":"client-individual","prefetch":2}]
+            ,callback=lambda destination,message,headers:(messages.append(message),time.sleep(0.05)))
+        try:
+            for i in range(0,10):
+                conn.send_message("/queue/QTEST1","MESSAGE%d" %(i))
+            self.assertTrue(wait_for(lambda:len(messages)==1))
+            self.assertLessEqual(self.broker.stats["delivered"],2)
+            self.assertTrue(wait_for(lambda:len(messages)==10))
+        finally:
+            conn.disconnect()
+
+    def test_confirmed(self):
+        """
+        Confirmed sends are resolved by receipts and failed by errors
+        """
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"},[])
+        try:
+            self.assertIsNotNone(conn.send_confirmed("/queue/QTEST1","OK").result(5))
+            self.broker.rejected.add("/queue/REJECTED")
+            future=conn.send_confirmed("/queue/REJECTED","KO")
+            self.assertRaises(amqstompclient.AMQSendError,future.result,5)
+            # the broker closes the connection after an error
+            self.assertTrue(wait_for(lambda:conn.connections==2 and conn.connected))
+        finally:
+            conn.disconnect()
+
+    def test_confirmed_window(self):
+        """
+        send_confirmed blocks while the window is full, rejected messages release their slot
+        """
+        self.server["confirmwindow"]=2
+        self.server["codecs"]={"/queue/QJSON":"json"}
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"},[])
+        try:
+            self.broker.latency=0.3
+            futures=[conn.send_confirmed("/queue/QTEST1","MESSAGE%d" %(i)) for i in range(0,2)]
+            self.assertRaises(TimeoutError,conn.send_confirmed,"/queue/QTEST1","FULL",timeout=0.05)
+            start=time.monotonic()
+            futures.append(conn.send_confirmed("/queue/QTEST1","MESSAGE2"))
+            self.assertGreater(time.monotonic()-start,0.15)
+            self.assertTrue(all(future.result(5) for future in futures))
+            self.assertEqual(len(conn.receipts),0)
+
+            self.broker.latency=0
+            self.broker.rejected.add("/queue/REJECTED")
+            rejected=conn.send_confirmed("/queue/REJECTED","KO")
+            self.assertRaises(amqstompclient.AMQSendError,rejected.result,5)
+            self.assertTrue(wait_for(lambda:conn.connections==2 and conn.connected))
+            # codec errors do not take a slot
+            for i in range(0,3):
+                self.assertRaises(TypeError,conn.send_confirmed,"/queue/QJSON",{"value":object()},timeout=0.1)
+            # both slots are free again
+            self.assertIsNotNone(conn.send_confirmed("/queue/QTEST1","OK1",timeout=1).result(5))
+            self.assertIsNotNone(conn.send_confirmed("/queue/QTEST1","OK2",timeout=1).result(5))
+        finally:
+            conn.disconnect()
+
+    def test_pool(self):
+        """
+        The pool spreads the subscriptions, routes the sends, aggregates the lifesigns and closes every connection
+        """
+        messages=[]
+        self.server["connections"]=2
+        pool=amqstompclient.AMQClientPool(self.server, {"name":"TEST","version":"1.0.0"}
+            ,["/queue/QTEST1","/queue/QTEST2","/queue/QTEST3","/queue/QTEST4"]
+            ,callback=lambda destination,message,headers:messages.append((destination,message)))
+        try:
+            self.assertEqual([sorted(spec["destination"] for spec in client.subscriptions.values()) for client in pool.clients]
+                ,[["/queue/QTEST1","/queue/QTEST3"],["/queue/QTEST2","/queue/QTEST4"]])
+            self.assertTrue(wait_for(lambda:len(self.broker.sessions)==2))
+            self.assertEqual(sorted(session.clientid for session in self.broker.sessions),["TEST-1","TEST-2"])
+
+            # hash routing: a destination always uses the same connection
+            for i in range(0,3):
+                for destination in ("/queue/QTEST1","/queue/QTEST2","/queue/QTEST3","/queue/QTEST4"):
+                    pool.send_message(destination,"MESSAGE%d" %(i))
+            for destination in ("/queue/QTEST1","/queue/QTEST2","/queue/QTEST3","/queue/QTEST4"):
+                self.assertEqual([client.sent.get(destination,0) for client in pool.clients].count(3),1)
+                self.assertEqual(pool.client_for(destination).sent[destination],3)
+            self.assertTrue(wait_for(lambda:len(messages)==12))
+            self.assertEqual([message for destination,message in messages if destination=="/queue/QTEST2"]
+                ,["MESSAGE0","MESSAGE1","MESSAGE2"])
+
+            lifesign=pool.generate_life_sign()
+            self.assertEqual(lifesign["messages"],12)
+            self.assertEqual(sum(lifesign["sent"].values()),12)
+            self.assertEqual(lifesign["subscriptions"],4)
+            self.assertEqual(sorted(client["module"] for client in lifesign["pool"]),["TEST-1","TEST-2"])
+            self.assertEqual(sum(client["messages"] for client in lifesign["pool"]),12)
+            self.assertEqual([client["sent"] for client in lifesign["pool"]]
+                ,[sum(client.sent.values()) for client in pool.clients])
+        finally:
+            pool.disconnect()
+        self.assertTrue(wait_for(lambda:len(self.broker.sessions)==0))
+
+        self.server["routing"]="roundrobin"
+        pool=amqstompclient.AMQClientPool(self.server, {"name":"TEST","version":"1.0.0"},[])
+        try:
+            for i in range(0,4):
+                pool.send_message("/queue/QTEST1","MESSAGE%d" %(i))
+            self.assertEqual([client.sent.get("/queue/QTEST1") for client in pool.clients],[2,2])
+            self.assertTrue(wait_for(lambda:self.broker.queue_depth("/queue/QTEST1")==4))
+        finally:
+            pool.disconnect()
+        self.assertTrue(wait_for(lambda:len(self.broker.sessions)==0))
+
+    def test_reconnect(self):
+        """
+        The client reconnects after a broker disconnect and unacked messages are redelivered
+        """
+        messages=[]
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"}
+            ,[{"destination":"/queue/QTEST1","ack":"client-individual"}]
+            ,callback=lambda destination,message,headers:messages.append(message))
+        try:
+            conn.send_message("/queue/QTEST1","BEFORE")
+            self.assertTrue(wait_for(lambda:messages==["BEFORE"]))
+            self.broker.drop_connections()
+            self.assertTrue(wait_for(lambda:conn.connections==2 and conn.connected))
+            conn.send_message("/queue/QTEST1","AFTER")
+            self.assertTrue(wait_for(lambda:messages==["BEFORE","AFTER"]))
+        finally:
+            conn.disconnect()
+
+    def test_failover(self):
+        """
+        Only unexpected disconnections mark the broker as failed
+        """
+        other=fakebroker.FakeStompBroker(heartbeats=(1000,1000)).start()
+        self.server["hosts"]=[("127.0.0.1",self.broker.port),("127.0.0.1",other.port)]
+        self.server["exitonerror"]=False
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"},["/queue/QTEST1"])
+        try:
+            brokers={self.broker.port:self.broker,other.port:other}
+            brokers[conn.endpoint[1]].send_error("Unexpected ACK received for message-id [ID:1]")
+            self.assertTrue(wait_for(lambda:conn.connections==2 and conn.connected))
+            self.assertEqual(conn.recoverederrors,1)
+            self.assertEqual(conn.unhealthy,{})
+
+            endpoint=conn.endpoint
+            brokers[endpoint[1]].drop_connections()
+            self.assertTrue(wait_for(lambda:conn.connections==3 and conn.connected))
+            self.assertEqual(list(conn.unhealthy),[endpoint])
+            self.assertNotEqual(conn.endpoint,endpoint)
+        finally:
+            conn.disconnect()
+            other.stop()
+
+    def test_subscribe(self):
+        """
+        Subscriptions added and removed at runtime keep their ids across reconnections
+        """
+        messages=[]
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"},["/queue/QTEST1"]
+            ,callback=lambda destination,message,headers:messages.append((destination,message,headers["subscription"])))
+        try:
+            subscription_id=conn.subscribe("/queue/QTEST2",ack="client-individual",prefetch=10)
+            self.assertEqual(subscription_id,"2")
+            self.assertEqual(conn.subscribe("/queue/QTEST2"),"2")
+            self.assertEqual(conn.subscribe("/queue/QTEST3"),"3")
+            conn.send_message("/queue/QTEST2","A")
+            self.assertTrue(wait_for(lambda:messages==[("/queue/QTEST2","A","2")]))
+
+            self.assertEqual(conn.unsubscribe("/queue/QTEST1"),1)
+            self.broker.drop_connections()
+            self.assertTrue(wait_for(lambda:conn.connections==2 and conn.connected))
+            self.assertEqual(sorted(conn.subscriptions),["2","3"])
+            conn.send_message("/queue/QTEST3","B")
+            conn.send_message("/queue/QTEST1","C")
+            self.assertTrue(wait_for(lambda:len(messages)==2))
+            self.assertEqual(messages[1],("/queue/QTEST3","B","3"))
+
+            self.assertEqual(conn.unsubscribe("2"),1)
+            self.assertEqual(conn.unsubscribe("/queue/QTEST2"),0)
+            self.assertEqual(conn.subscribe("/queue/QTEST1"),"4")
+            self.assertTrue(wait_for(lambda:len(messages)==3))
+            self.assertEqual(messages[2],("/queue/QTEST1","C","4"))
+            self.assertRaises(ValueError,conn.subscribe,"/queue/QTEST4",codec="json")
+        finally:
+            conn.disconnect()
+
+    def test_outbox(self):
+        """
+        Messages are spooled to the journal while the broker is down and forwarded in order
+        """
+        messages=[]
+        with tempfile.TemporaryDirectory() as directory:
+            self.server["outbox"]={"directory":directory,"segmentsize":4096,"window":10}
+            conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"}
+                ,[{"destination":"/queue/QTEST1","ack":"client-individual"}]
+                ,callback=lambda destination,message,headers:messages.append(message))
+            try:
+                for i in range(0,100):
+                    conn.send_message("/queue/QTEST1","MESSAGE %d" % i)
+                self.assertTrue(wait_for(lambda:len(messages)==100))
+                self.assertTrue(wait_for(lambda:conn.outbox.depth()==0))
+                self.assertEqual(messages,["MESSAGE %d" % i for i in range(0,100)])
+                self.assertRaises(ValueError,conn.send_batch,"/queue/QTEST1",["TX"],transaction=True)
+            finally:
+                conn.disconnect()
+
+            # a client restarted with the same directory forwards what the previous one left
+            journal=amqstompclient.AMQJournal(directory,segmentsize=4096)
+            journal.append("/queue/QTEST1","LEFTOVER")
+            journal.close()
+            conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"}
+                ,[{"destination":"/queue/QTEST1","ack":"client-individual"}]
+                ,callback=lambda destination,message,headers:messages.append(message))
+            try:
+                self.assertTrue(wait_for(lambda:messages[-1:]==["LEFTOVER"]))
+                self.assertTrue(wait_for(lambda:conn.generate_life_sign()["outbox"]==0))
+                self.assertEqual(self.broker.stats["published"],101)
+            finally:
+                conn.disconnect()
+
+    def test_pool_outbox(self):
+        """
+        Each pooled connection forwards its own outbox journal
+        """
+        messages=[]
+        with tempfile.TemporaryDirectory() as directory:
+            self.server["outbox"]={"directory":directory,"segmentsize":4096}
+            self.server["connections"]=5
+            self.server["routing"]="roundrobin"
+            pool=amqstompclient.AMQClientPool(self.server, {"name":"TEST","version":"1.0.0"}
+                ,["/queue/QTEST1"],callback=lambda destination,message,headers:messages.append(message))
+            try:
+                for i in range(0,50):
+                    pool.send_message("/queue/QTEST1","MESSAGE %d" % i)
+                self.assertTrue(wait_for(lambda:len(messages)==50))
+                self.assertEqual(sorted(messages),sorted("MESSAGE %d" % i for i in range(0,50)))
+                self.assertEqual(sorted(os.listdir(directory)),["connection-%d" % i for i in range(1,6)])
+            finally:
+                pool.disconnect()
+
+    def test_route(self):
+        """
+        Messages of a wildcard subscription are routed by header and counted in the lifesign
+        """
+        handled=[]
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"},["/topic/PRICE.>"]
+            ,callback=lambda destination,message,headers:handled.append(("default",message)))
+        try:
+            conn.route("/topic/PRICE.*",lambda destination,message,headers:handled.append(("trade",message))
+                ,{"type":"trade"},name="trades")
+            conn.send_message("/topic/PRICE.STOCK","A",{"type":"trade"})
+            conn.send_message("/topic/PRICE.STOCK","B",{"type":"quote"})
+            self.assertTrue(wait_for(lambda:len(handled)==2))
+            self.assertEqual(handled,[("trade","A"),("default","B")])
+            lifesign=conn.generate_life_sign()
+            self.assertEqual(lifesign["routes"],{"trades":1})
+            self.assertEqual(lifesign["unrouted"],1)
+        finally:
+            conn.disconnect()
+
+        # the router holds a lock, it cannot be pickled for the process workers
+        self.server["dispatcher"]={"workers":1,"mode":"process"}
+        self.assertRaises(ValueError,amqstompclient.AMQClient,self.server,{"name":"TEST","version":"1.0.0"}
+            ,["/topic/PRICE.>"],callback=amqstompclient.AMQRouter())
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"},["/topic/PRICE.>"],callback=print)
+        try:
+            self.assertRaises(ValueError,conn.route,"/topic/PRICE.*",print)
+            self.assertIsNone(conn.router)
+        finally:
+            conn.disconnect()
+
+    def test_dedup(self):
+        """
+        Messages redelivered after a reconnection are acked without calling the callback again
+        """
+        messages=[]
+        self.server["dedup"]={"size":1000}
+        # the acks are still pending when the connection drops
+        self.server["ackbatch"]={"size":100,"interval":60000}
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"}
+            ,[{"destination":"/queue/QTEST1","ack":"client","prefetch":100}]
+            ,callback=lambda destination,message,headers:messages.append(message))
+        try:
+            for i in range(0,5):
+                conn.send_message("/queue/QTEST1","MESSAGE %d" % i)
+            self.assertTrue(wait_for(lambda:len(messages)==5))
+            self.broker.drop_connections()
+            self.assertTrue(wait_for(lambda:conn.deduplicator.hits==5))
+            self.assertEqual(messages,["MESSAGE %d" % i for i in range(0,5)])
+            self.assertEqual(self.broker.stats["redelivered"],5)
+            self.assertEqual(conn.generate_life_sign()["dedup"]["entries"],5)
+        finally:
+            conn.disconnect()
+
+    def test_dedup_earlyack(self):
+        """
+        Duplicates of early ack subscriptions are acked on receipt
+        """
+        messages=[]
+        self.server["dedup"]={"size":1000,"header":"key"}
+        self.server["earlyack"]=True
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"}
+            ,[{"destination":"/queue/QTEST1","ack":"client-individual","prefetch":1}]
+            ,callback=lambda destination,message,headers:messages.append(message))
+        try:
+            conn.send_message("/queue/QTEST1","MESSAGE",{"key":"A"})
+            conn.send_message("/queue/QTEST1","MESSAGE",{"key":"A"})
+            conn.send_message("/queue/QTEST1","LAST")
+            # the unacked duplicate would hold the only prefetch slot
+            self.assertTrue(wait_for(lambda:messages[-1:]==["LAST"]))
+            self.assertEqual(conn.deduplicator.hits,1)
+            self.assertTrue(wait_for(lambda:self.broker.stats["acked"]==3))
+        finally:
+            conn.disconnect()
+
+    def test_supervisor(self):
+        """
+        Worker processes consume the queue, a crashed worker is restarted and the lifesigns are aggregated
+        """
+        marker=tempfile.mktemp()
+        server=dict(self.server,workers=2,restart={"initial":0.1})
+        supervisor=amqstompclient.AMQSupervisor(server, {"name":"TEST","version":"1.0.0","lifesigninterval":0.2}
+            ,[{"destination":"/queue/QTEST1","ack":"client-individual"}],callback=functools.partial(crash_once,marker))
+        conn=amqstompclient.AMQClient(self.server, {"name":"PRODUCER"},[])
+        try:
+            self.assertTrue(wait_for(lambda:len(supervisor.lifesigns)==2))
+            conn.send_message("/queue/QTEST1","CRASH")
+            for i in range(0,50):
+                conn.send_message("/queue/QTEST1","MESSAGE %d" % i)
+            self.assertTrue(wait_for(lambda:self.broker.stats["acked"]==51,10))
+            self.assertTrue(wait_for(lambda:supervisor.generate_life_sign()["restarts"]==1))
+            self.assertTrue(wait_for(lambda:supervisor.generate_life_sign()["messages"]>=1))
+            lifesign=supervisor.generate_life_sign()
+            self.assertEqual(sorted(client["module"] for client in lifesign["pool"]),["TEST-1","TEST-2"])
+            self.assertTrue(all(worker["alive"] for worker in lifesign["workers"]))
+        finally:
+            conn.disconnect()
+            supervisor.stop(5)
+            if os.path.exists(marker):
+                os.remove(marker)
+        self.assertTrue(all(not worker.is_alive() for worker in supervisor.workers))
+
+    def test_message_view(self):
+        """
+        Callbacks receive views decoded on demand, oversized bodies can only be streamed
+        """
+        views=[]
+        server=dict(self.server,messageview={"maxsize":1000,"oversize":"stream"},codecs={"/queue/QTEST1":"json+zlib"})
+        conn=amqstompclient.AMQClient(server, {"name":"TEST"},["/queue/QTEST1","/queue/QTEST2"]
+            ,callback=lambda destination,message,headers:views.append(message))
+        try:
+            large=[os.urandom(50).hex() for i in range(0,200)]
+            conn.send_message("/queue/QTEST1",{"small":True})
+            conn.send_message("/queue/QTEST1",large)
+            conn.send_message("/queue/QTEST2","TEXT")
+            self.assertTrue(wait_for(lambda:len(views)==3))
+            views.sort(key=lambda view:(view.destination,view.size))
+
+            self.assertIsInstance(views[0],amqstompclient.AMQMessage)
+            self.assertEqual(views[0].body,{"small":True})
+            self.assertTrue(views[1].size>1000)
+            self.assertRaises(amqstompclient.AMQMessageTooLarge,lambda:views[1].body)
+            self.assertEqual(json.loads(b"".join(views[1].chunks(4096))),large)
+            self.assertEqual(views[2].body,"TEXT")
+            self.assertEqual(views[2].headers["destination"],"/queue/QTEST2")
+
+            # a view is forwarded as received
+            body,headers=conn.encode_message("/queue/QTEST3",views[1])
+            self.assertEqual(body,views[1].raw)
+            self.assertEqual(headers["content-encoding"],"zlib")
+        finally:
+            conn.disconnect()
+
+    def test_batch_callback(self):
+        """
+        Messages are handed over in batches, acked cumulatively and redelivered when the batch fails
+        """
+        batches=[]
+        def batch_callback(destination,messages,headers):
+            batches.append(list(messages))
+            if len(batches)==1:
+                raise Exception("Sink unavailable")
+
+        self.server["batch"]={"size":5,"interval":200}
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"},[{"destination":"/queue/QTEST1","ack":"client"}]
+            ,batch_callback=batch_callback)
+        try:
+            self.assertEqual(conn.subscriptions["1"]["prefetch"],5)
+            for i in range(0,12):
+                conn.send_message("/queue/QTEST1","MESSAGE%d" %(i))
+            self.assertTrue(wait_for(lambda:self.broker.stats["acked"]==12))
+            self.assertEqual(batches[0],batches[1])
+            self.assertEqual(self.broker.stats["redelivered"],5)
+            self.assertEqual([len(batch) for batch in batches],[5,5,5,2])
+            self.assertEqual(conn.batcher.failed,1)
+        finally:
+            conn.disconnect()
+
+    def test_flowcontrol(self):
+        """
+        The prefetch follows the callback latency
+        """
+        messages=[]
+        slow=[0.05]
+        def callback(destination,message,headers):
+            time.sleep(slow[0])
+            messages.append(message)
+
+        self.server["flowcontrol"]={"high":20,"low":5,"interval":100}
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"}
+            ,[{"destination":"/queue/QTEST1","ack":"client-individual","prefetch":8}],callback=callback)
+        try:
+            for i in range(0,40):
+                conn.send_message("/queue/QTEST1","MESSAGE%d" %(i))
+            self.assertTrue(wait_for(lambda:conn.subscriptions["1"]["prefetch"]<8))
+            self.assertEqual(conn.generate_life_sign()["throttle"],"throttled")
+            self.assertEqual(conn.generate_life_sign()["flowcontrol"]["/queue/QTEST1"]["prefetch"]
+                ,conn.subscriptions["1"]["prefetch"])
+            slow[0]=0
+            self.assertTrue(wait_for(lambda:conn.generate_life_sign()["throttle"]=="normal",10))
+            self.assertTrue(wait_for(lambda:len(set(messages))==40))
+            self.assertEqual(conn.subscriptions["1"]["prefetch"],8)
+        finally:
+            conn.disconnect()
+
+    def test_flowcontrol_topic(self):
+        """
+        Topic subscriptions are never resubscribed, their in-flight messages survive a reconnection
+        """
+        messages=[]
+        def callback(destination,message,headers):
+            time.sleep(0.05)
+            messages.append(message)
+
+        self.server["flowcontrol"]={"high":20,"low":5,"interval":100}
+        self.server["dispatcher"]={"workers":1,"queue":100}
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"}
+            ,[{"destination":"/topic/TTEST1","ack":"client-individual","prefetch":100}],callback=callback)
+        try:
+            for i in range(0,40):
+                conn.send_message("/topic/TTEST1","MESSAGE%d" %(i))
+            self.assertTrue(wait_for(lambda:len(messages)>5))
+            self.broker.drop_connections()
+            self.assertTrue(wait_for(lambda:len(messages)==40,10))
+            self.assertEqual(messages,["MESSAGE%d" %(i) for i in range(0,40)])
+            self.assertEqual(conn.flowcontroller.changes,0)
+            self.assertEqual(conn.subscriptions["1"]["prefetch"],100)
+            self.assertEqual(conn.generate_life_sign()["throttle"],"normal")
+        finally:
+            conn.disconnect()
+
+    def test_pause(self):
+        """
+        Subscriptions are paused while the local queue is above the pause depth
+        """
+        messages=[]
+        self.server["flowcontrol"]={"lowdepth":2,"pausedepth":10,"interval":50}
+        self.server["dispatcher"]={"workers":1,"queue":1000}
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"},[{"destination":"/queue/QTEST1","ack":"auto"}]
+            ,callback=lambda destination,message,headers:(time.sleep(0.01),messages.append(message)))
+        try:
+            for i in range(0,100):
+                conn.send_message("/queue/QTEST1","MESSAGE%d" %(i))
+            self.assertTrue(wait_for(lambda:conn.flowcontroller.throttle()=="paused"))
+            self.assertTrue(wait_for(lambda:len(messages)==100,10))
+            self.assertEqual(len(set(messages)),100)
+            self.assertTrue(wait_for(lambda:conn.flowcontroller.throttle()=="normal"))
+        finally:
+            conn.disconnect()
+
+    def test_dispatcher_autoack(self):
+        """
+        Auto ack subscriptions on a dispatcher without a pause depth are reported
+        """
+        self.server["dispatcher"]={"workers":1,"queue":10}
+        with self.assertLogs(amqstompclient.logger,"WARNING") as logs:
+            conn=amqstompclient.AMQClient(self.server, {"name":"TEST"},[{"destination":"/queue/QTEST1","ack":"auto"}
+                ,{"destination":"/queue/QTEST2","ack":"client-individual"}])
+        conn.disconnect()
+        warnings=[line for line in logs.output if "not throttled" in line]
+        self.assertEqual(len(warnings),1)
+        self.assertIn("/queue/QTEST1",warnings[0])
+
+    def test_errors(self):
+        """
+        Recoverable errors reconnect, fatal errors shut the client down
+        """
+        self.server["exitonerror"]=False
+        self.server["shutdowntimeout"]=1
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"},["/queue/QTEST1"])
+        try:
+            self.broker.send_error("Unexpected ACK received for message-id [ID:1]")
+            self.assertTrue(wait_for(lambda:conn.connections==2 and conn.connected))
+            self.assertEqual(conn.recoverederrors,1)
+            self.broker.send_error("User name [TEST] or password is invalid.")
+            self.assertTrue(wait_for(lambda:conn.closing and len(self.broker.sessions)==0))
+            self.assertEqual(conn.connections,2)
+        finally:
+            conn.disconnect()
+
+    def test_shutdown(self):
+        """
+        A shutdown handles and acknowledges the in-flight messages and leaves the others to the broker
+        """
+        messages=[]
+        self.server["dispatcher"]={"workers":1,"queue":10}
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"}
+            ,[{"destination":"/queue/QTEST1","ack":"client-individual","prefetch":5}]
+            ,callback=lambda destination,message,headers:(time.sleep(0.05),messages.append(message)))
+        for i in range(0,20):
+            conn.send_message("/queue/QTEST1","MESSAGE%d" %(i))
+        self.assertTrue(wait_for(lambda:len(messages)>0))
+        self.assertTrue(conn.shutdown(5))
+        self.assertTrue(wait_for(lambda:self.broker.queue_depth("/queue/QTEST1")==20-len(messages)))
+        self.assertEqual(self.broker.stats["acked"],len(messages))
+
+    def test_shutdown_error(self):
+        """
+        An ERROR frame received during a shutdown does not start a second shutdown
+        """
+        messages=[]
+        exits=[]
+        self.server["dispatcher"]={"workers":1,"queue":10}
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST"}
+            ,[{"destination":"/queue/QTEST1","ack":"client-individual","prefetch":5}]
+            ,callback=lambda destination,message,headers:(time.sleep(0.1),messages.append(message)))
+        conn.shutdown_and_exit=lambda:exits.append(True)
+        for i in range(0,5):
+            conn.send_message("/queue/QTEST1","MESSAGE%d" %(i))
+        self.assertTrue(wait_for(lambda:len(messages)>0))
+        shutdown=threading.Thread(target=conn.shutdown,args=(5,))
+        shutdown.start()
+        self.assertTrue(wait_for(lambda:conn.draining))
+        self.broker.send_error("User name [TEST] or password is invalid.")
+        shutdown.join(10)
+        self.assertFalse(shutdown.is_alive())
+        self.assertEqual(exits,[])
+        self.assertTrue(conn.closing)
+
+    def test_retry(self):
+        """
+        Failed messages are retried after a delay, or NACKed and forwarded to a DLQ after the last attempt
+        """
+        calls=[]
+        deadletters=[]
+        def callback(destination,message,headers):
+            if destination=="/queue/DLQ":
+                deadletters.append((message,headers))
+                return
+            calls.append((destination,message))
+            if message=="POISON" or len(calls)<3:
+                raise ValueError("Invalid message")
+
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"}
+            ,[{"destination":"/queue/QTEST1","ack":"client-individual","retry":{"attempts":3,"delay":0.1}}
+            ,{"destination":"/queue/QTEST2","ack":"client-individual","retry":{"attempts":2,"mode":"nack","dlq":"/queue/DLQ"}}
+            ,"/queue/DLQ"],callback=callback)
+        try:
+            conn.send_message("/queue/QTEST1","RETRY")
+            self.assertTrue(wait_for(lambda:self.broker.stats["acked"]==1))
+            self.assertEqual(calls,[("/queue/QTEST1","RETRY")]*3)
+            self.assertEqual(self.broker.stats["redelivered"],0)
+
+            conn.send_message("/queue/QTEST2","POISON")
+            self.assertTrue(wait_for(lambda:len(deadletters)==1 and self.broker.stats["acked"]==3))
+            self.assertEqual(self.broker.stats["redelivered"],1)
+            message,headers=deadletters[0]
+            self.assertEqual(message,"POISON")
+            self.assertEqual(headers["dlq-original-destination"],"/queue/QTEST2")
+            self.assertEqual(headers["dlq-exception"],"ValueError")
+            self.assertEqual(headers["dlq-attempts"],"2")
+            lifesign=conn.generate_life_sign()
+            self.assertEqual(lifesign["retried"],3)
+            self.assertEqual(lifesign["retry"]["deadlettered"],{"/queue/QTEST2":1})
+        finally:
+            conn.disconnect()
+
+    def test_retry_cumulative(self):
+        """
+        Client ack subscriptions reject delayed retries and dead letters, their acks are cumulative
+        """
+        calls=[]
+        def callback(destination,message,headers):
+            calls.append(message)
+            if message=="FAIL" and calls.count("FAIL")==1:
+                raise ValueError("Invalid message")
+
+        for policy in [{"attempts":3,"delay":5},{"attempts":3,"mode":"nack","dlq":"/queue/DLQ"}]:
+            self.assertRaises(ValueError,amqstompclient.AMQClient,self.server,{"name":"TEST","version":"1.0.0"}
+                ,[{"destination":"/queue/QTEST1","ack":"client","retry":policy}],callback=callback)
+        self.assertRaises(ValueError,amqstompclient.AMQClient,dict(self.server,retry={"attempts":3})
+            ,{"name":"TEST","version":"1.0.0"},["/queue/QTEST1"],callback=callback)
+        conn=amqstompclient.AMQClient(self.server, {"name":"TEST","version":"1.0.0"}
+            ,[{"destination":"/queue/QTEST1","ack":"client","prefetch":10,"retry":{"attempts":3,"mode":"nack"}}]
+            ,callback=callback)
+        try:
+            self.assertRaises(ValueError,conn.subscribe,"/queue/QTEST2",ack="client",retry={"attempts":2})
+            self.assertEqual(len(conn.subscriptions),1)
+            conn.send_message("/queue/QTEST1","FAIL")
+            conn.send_message("/queue/QTEST1","OK1")
+            self.assertTrue(wait_for(lambda:calls.count("FAIL")==2 and "OK1" in calls))
+            self.assertEqual(self.broker.stats["nacked"],1)
+            self.assertEqual(self.broker.stats["redelivered"],1)
+            self.assertTrue(wait_for(lambda:self.broker.stats["acked"]==2))
+            self.assertEqual(conn.retrier.scheduled,0)
+            self.assertEqual(conn.generate_life_sign()["retried"],1)
+        finally:
+            conn.disconnect()
+
+    def test_request(self):
+        """
+        Requests are answered through the temporary reply queue or time out
+        """
+        server=dict(self.server,codecs={"/queue/RPC":"json"})
+        responder=amqstompclient.AMQClient(server, {"name":"RESPONDER"},["/queue/RPC"]
+            ,callback=lambda destination,message,headers:responder.reply(headers,{"sum":sum(message)}) if message else None)
+        conn=amqstompclient.AMQClient(server, {"name":"TEST","version":"1.0.0"},[])
+        try:
+            futures=[conn.request("/queue/RPC",[i,i]) for i in range(0,200)]
+            results=[future.result(5) for future in futures]
+            self.assertEqual([result[0]["sum"] for result in results],[i*2 for i in range(0,200)])
+            self.assertEqual(len(conn.requests),0)
+            late=conn.request("/queue/RPC",[],timeout=0.2)
+            self.assertRaises(TimeoutError,late.result,5)
+            self.assertEqual(conn.generate_life_sign()["requesttimeouts"],1)
+        finally:
+            conn.disconnect()
+            responder.disconnect()
+
+    def test_async(self):
+        """
+        The asyncio client exchanges messages with the fake broker
+        """
+        async def run():
+            async with amqstompclient.AsyncAMQClient(self.server, {"name":"TEST"},["/queue/QTEST1"]) as conn:
+                await conn.send_message("/queue/QTEST1","ASYNC")
+                async for destination,message,headers in conn:
+                    return destination,message
+
+        self.assertEqual(asyncio.run(asyncio.wait_for(run(),5)),("/queue/QTEST1","ASYNC"))
+
+    def test_async_reconnect(self):
+        """
+        Messages queued before a reconnection are dropped, the broker redelivers them
+        """
+        async def run():
+            received=[]
+            async with amqstompclient.AsyncAMQClient(self.server, {"name":"TEST"}
+                    ,[{"destination":"/queue/QTEST1","ack":"client-individual","prefetch":10}]) as conn:
+                for i in range(0,5):
+                    await conn.send_message("/queue/QTEST1","MESSAGE%d" %(i))
+                async for destination,message,headers in conn:
+                    received.append(message)
+                    if len(received)==1:
+                        while conn.messages.qsize()<4:
+                            await asyncio.sleep(0.01)
+                        self.broker.drop_connections()
+                        while conn.connections<2:
+                            await asyncio.sleep(0.01)
+                    if len(received)==6:
+                        break
+            return received
+
+        received=asyncio.run(asyncio.wait_for(run(),5))
+        # the first message was handed over before the connection was lost
+        self.assertEqual(received,["MESSAGE0"]+["MESSAGE%d" %(i) for i in range(0,5)])
+        self.assertTrue(wait_for(lambda:self.broker.stats["acked"]==5))
+
+    def test_async_subscribe(self):
+        """
+        The asyncio client subscribes and unsubscribes at runtime
+        """
+        async def run():
+            received=[]
+            async with amqstompclient.AsyncAMQClient(self.server, {"name":"TEST"},[]) as conn:
+                subscription_id=await conn.subscribe("/queue/QTEST2",ack="client-individual",codec="json")
+                self.assertEqual(await conn.subscribe("/queue/QTEST2"),subscription_id)
+                await conn.send_message("/queue/QTEST2",{"value":1})
+                async for destination,message,headers in conn:
+                    received.append((destination,message,headers["subscription"]))
+                    break
+                self.assertEqual(await conn.unsubscribe("/queue/QTEST2"),1)
+                self.assertEqual(await conn.unsubscribe(subscription_id),0)
+                await conn.send_message("/queue/QTEST2",{"value":2})
+                self.assertEqual(await conn.subscribe("/queue/QTEST3"),"2")
+                await conn.send_message("/queue/QTEST3","TEXT")
+                async for destination,message,headers in conn:
+                    received.append((destination,message,headers["subscription"]))
+                    break
+            return received
+
+        self.assertEqual(asyncio.run(asyncio.wait_for(run(),5))
+            ,[("/queue/QTEST2",{"value":1},"1"),("/queue/QTEST3","TEXT","2")])
+        self.assertTrue(wait_for(lambda:self.broker.stats["acked"]==2))
+        self.assertEqual(self.broker.queue_depth("/queue/QTEST2"),1)
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
     logger = logging.getLogger()